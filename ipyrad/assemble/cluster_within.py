@@ -16,6 +16,8 @@ from __future__ import print_function
 # pylint: disable=R0912
 
 import os
+import re
+import array
 import sys
 import gzip
 import glob
@@ -24,6 +26,7 @@ import subprocess
 import numpy as np
 import ipyrad
 import time
+import numba
 import datetime
 import networkx as nx
 
@@ -42,10 +45,6 @@ def sample_cleanup(data, sample):
     sample.files.clusters = os.path.join(data.dirs.clusts,
                                          sample.name+".clustS.gz")
     
-    ## get new clustered loci 
-    infile = gzip.open(data.samples[sample.name].files.clusters)
-    loci = infile.read().strip("//\n//\n").split("//\n//\n")
-
     ## get number of merged reads, updated dynamically
     ## TODO: this won't capture merged reads that are merged during refmap
     if 'pair' in data.paramsdict["datatype"]:
@@ -53,31 +52,22 @@ def sample_cleanup(data, sample):
                                            sample.name+"_merged_.fastq")
         ## record how many read pairs were merged
         with open(sample.files.merged, 'r') as tmpf:
-            sample.stats.reads_merged = len(tmpf.readlines()) // 4
-
-    ## arrays for storing data
-    maxlen = np.zeros(len(loci), dtype=np.uint32)
-    depths = np.zeros(len(loci), dtype=np.uint32)
-
-    ## get depth stats
-    for iloc in xrange(depths.shape[0]):
-        lines = loci[iloc].strip().split("\n")
-        maxlen[iloc] = np.uint32(len(lines[1]))
-        tdepth = np.uint32(0)
-        for line in lines[::2]:
-            tdepth += np.uint32(line.split(";")[-2][5:])
-        depths[iloc] = tdepth
+            sample.stats.reads_merged = sum(1 for _ in tmpf) // 4
 
-    infile.close()
+    ## depth and length of each cluster, recorded by muscle_align/reconcat 
+    ## so we don't need to reread the clusters (unless it is missing)
+    sizes = load_clust_sizes(sample.files.clusters)
+    maxlen = sizes[:, 2]
+    depths = sizes[:, 1]
 
     ## If our longest sequence is longer than the current max_fragment_length
     ## then update max_fragment_length. For assurance we require that 
     ## max len is 4 greater than maxlen, to allow for pair separators.
-    max_len = maxlen.max()
+    max_len = maxlen.max() if maxlen.shape[0] else 0
     if max_len > data._hackersonly["max_fragment_length"]:
         data._hackersonly["max_fragment_length"] = max_len + 4
 
-    if depths.max():
+    if depths.shape[0] and depths.max():
         ## make sense of stats
         keepmj = depths[depths >= data.paramsdict["mindepth_majrule"]]    
         keepstat = depths[depths >= data.paramsdict["mindepth_statistical"]]
@@ -136,6 +126,9 @@ def muscle_align(data, sample, chunk, maxindels):
     out = []
     highindels = 0
 
+    ## (nseqs, depth, length) of each aligned cluster for sample_cleanup
+    sizes = []
+
     ## iterate over clusters and align
     for clust in clusts:
         stack = []
@@ -144,6 +137,11 @@ def muscle_align(data, sample, chunk, maxindels):
         seqs = lines[1::2]
         badalign = 0
 
+        ## build_clusters marks seeds whose hits all aligned without indels
+        gapfree = names[0].endswith("*=")
+        if gapfree:
+            names[0] = names[0][:-1]
+
         ## append counter to end of names b/c muscle doesn't retain order
         names = [j+str(i) for i, j in enumerate(names)]
 
@@ -155,12 +153,11 @@ def muscle_align(data, sample, chunk, maxindels):
             try:
                 seqs1 = [i.split("nnnn")[0] for i in seqs] 
                 seqs2 = [i.split("nnnn")[1] for i in seqs]
-                ## muscle align
-                string1 = muscle_call(data, names[:200], seqs1[:200])
-                string2 = muscle_call(data, names[:200], seqs2[:200])
-                ## resort so they're in same order as original
-                anames, aseqs1 = parsemuscle(data, string1)
-                anames, aseqs2 = parsemuscle(data, string2)
+                ## halves are only gap-free if the first reads are all the same length
+                gapfree = gapfree and (len(set([len(i) for i in seqs1])) == 1)
+                ## align in-process or with muscle, returns original order
+                anames, aseqs1 = align_cluster(data, names[:200], seqs1[:200], gapfree)
+                anames, aseqs2 = align_cluster(data, names[:200], seqs2[:200], gapfree)
                 ## get leftlimit of seed, no hits can go left of this 
                 ## this can save pairgbs from garbage
                 idxs = [i for i, j in enumerate(aseqs1[0]) if j != "-"]
@@ -187,8 +184,7 @@ def muscle_align(data, sample, chunk, maxindels):
                               """, aseqs[i], intindels1, intindels2, maxindels)
 
             except IndexError:
-                string1 = muscle_call(data, names[:200], seqs[:200])
-                anames, aseqs = parsemuscle(data, string1)
+                anames, aseqs = align_cluster(data, names[:200], seqs[:200], gapfree)
 
                 ## Get left and right limits, no hits can go outside of this. 
                 ## This can save gbs overlap data significantly. 
@@ -235,11 +231,16 @@ def muscle_align(data, sample, chunk, maxindels):
         if stack:
             if not badalign:
                 out.append("\n".join(stack))
+                depth = sum([int(i.split("\n", 1)[0].split(";")[-2][5:]) \
+                             for i in stack])
+                sizes.append((len(stack), depth, 
+                              len(stack[0].split("\n", 1)[1])))
 
     ## write to file after
     outhandle = handle.rsplit(".", 1)[0]+".aligned"
     with open(outhandle, 'wb') as outfile:
         outfile.write("\n//\n//\n".join(out)+"\n")
+    write_clust_sizes(outhandle, sizes)
 
     ## remove the old tmp file
     os.remove(handle)
@@ -294,6 +295,201 @@ def muscle_call(data, names, seqs):
 
 
 
+def align_cluster(data, names, seqs, gapfree=False):
+    """
+    Aligns a cluster in-process against its seed if it is small enough,
+    else (or if the seed alignment is ambiguous) falls back to muscle.
+    Returns names and aligned seqs in their original order like parsemuscle.
+    If vsearch found no indels in any hit (gapfree) the left-justified
+    seqs are already aligned and only need padding.
+    """
+    if gapfree:
+        maxlen = max([len(i) for i in seqs])
+        return names, [i.ljust(maxlen, "-") for i in seqs]
+
+    ## reference clusters use a modified muscle gap penalty
+    if (len(seqs) <= ALIGN_MAXSEQS) and \
+       (not any(["_REF;+0" in i for i in names])) and all(seqs):
+        aseqs = star_align(seqs)
+        if aseqs:
+            return names, aseqs
+
+    ## too big or needs a true msa
+    return parsemuscle(data, muscle_call(data, names, seqs))
+
+
+
+def star_align(seqs):
+    """
+    Aligns each hit to the seed (first seq) and merges the pairwise
+    alignments into one alignment. Returns None if two hits insert bases
+    at the same internal seed position, since those require a real MSA.
+    """
+    seed = np.fromstring(seqs[0], dtype=np.uint8)
+    slen = seed.shape[0]
+
+    ## align hits to seed, count bases inserted before each seed position
+    hits = []
+    inserts = np.zeros((len(seqs), slen+1), dtype=np.int32)
+    for idx in xrange(1, len(seqs)):
+        query = np.fromstring(seqs[idx], dtype=np.uint8)
+        qmap, qins = pairalign(seed, query, ALIGN_MATCH, ALIGN_MISMATCH,
+                               ALIGN_GAPOPEN, ALIGN_GAPEXTEND)
+        inserts[idx] = np.bincount(qmap[qins >= 0], minlength=slen+1)
+        hits.append((query, qmap, qins))
+
+    ## insertions shared by several hits (not overhangs) need a real msa
+    if np.any(np.sum(inserts[:, 1:-1] > 0, axis=0) > 1):
+        return None
+
+    ## column of the first inserted base before each seed pos, and seed cols
+    maxins = inserts.max(axis=0)
+    blocks = np.arange(slen+1) + np.concatenate([[0], np.cumsum(maxins)[:-1]])
+    scols = blocks[:-1] + maxins[:-1]
+    ncols = slen + maxins.sum()
+
+    ## fill the seed row and hit rows with gaps (45)
+    arr = np.zeros((len(seqs), ncols), dtype=np.uint8)
+    arr.fill(45)
+    arr[0, scols] = seed
+    for idx in xrange(1, len(seqs)):
+        query, qmap, qins = hits[idx-1]
+        aligned = qins < 0
+        arr[idx, scols[qmap[aligned]]] = query[aligned]
+        ## leading overhangs are right-justified against the seed start
+        cols = blocks[qmap[~aligned]] + qins[~aligned]
+        cols[qmap[~aligned] == 0] += maxins[0] - inserts[idx, 0]
+        arr[idx, cols] = query[~aligned]
+
+    return [i.tostring() for i in arr]
+
+
+
+@numba.jit(nopython=True)
+def pairalign(seed, query, match, mismatch, gapopen, gapextend):
+    """
+    Affine-gap alignment of query to seed with free end gaps. Returns for
+    each query base the seed position it is aligned to, or that it is
+    inserted before (qmap), and -1 if aligned or else its rank within the
+    insertion (qins). Bases overhanging the seed end map to len(seed).
+    """
+    slen = seed.shape[0]
+    qlen = query.shape[0]
+    neg = -1000000
+
+    ## score matrices for seed-query match (0), gap in query (1), and
+    ## gap in seed (2), and traceback of which matrix each came from.
+    scores = np.zeros((3, slen+1, qlen+1), dtype=np.int32)
+    trace = np.zeros((3, slen+1, qlen+1), dtype=np.int8)
+    for i in xrange(slen+1):
+        for j in xrange(qlen+1):
+            scores[0, i, j] = neg
+            scores[1, i, j] = neg
+            scores[2, i, j] = neg
+    scores[0, 0, 0] = 0
+    ## leading overhangs are free
+    for i in xrange(1, slen+1):
+        scores[1, i, 0] = 0
+    for j in xrange(1, qlen+1):
+        scores[2, 0, j] = 0
+
+    for i in xrange(1, slen+1):
+        for j in xrange(1, qlen+1):
+            ## diagonal, Ns score zero
+            if (seed[i-1] == 78) or (query[j-1] == 78):
+                sub = 0
+            elif seed[i-1] == query[j-1]:
+                sub = match
+            else:
+                sub = mismatch
+            best = 0
+            for state in xrange(1, 3):
+                if scores[state, i-1, j-1] > scores[best, i-1, j-1]:
+                    best = state
+            scores[0, i, j] = scores[best, i-1, j-1] + sub
+            trace[0, i, j] = best
+
+            ## seed base against a gap
+            best = 0
+            bscore = scores[0, i-1, j] + gapopen
+            if scores[1, i-1, j] + gapextend > bscore:
+                best = 1
+                bscore = scores[1, i-1, j] + gapextend
+            if scores[2, i-1, j] + gapopen > bscore:
+                best = 2
+                bscore = scores[2, i-1, j] + gapopen
+            scores[1, i, j] = bscore
+            trace[1, i, j] = best
+
+            ## query base against a gap
+            best = 0
+            bscore = scores[0, i, j-1] + gapopen
+            if scores[2, i, j-1] + gapextend > bscore:
+                best = 2
+                bscore = scores[2, i, j-1] + gapextend
+            if scores[1, i, j-1] + gapopen > bscore:
+                best = 1
+                bscore = scores[1, i, j-1] + gapopen
+            scores[2, i, j] = bscore
+            trace[2, i, j] = best
+
+    ## trailing overhangs are free, best end is on the last row or column
+    bi = slen
+    bj = qlen
+    bstate = 0
+    bscore = neg
+    for state in xrange(3):
+        for j in xrange(qlen+1):
+            if scores[state, slen, j] > bscore:
+                bscore = scores[state, slen, j]
+                bi = slen
+                bj = j
+                bstate = state
+        for i in xrange(slen+1):
+            if scores[state, i, qlen] > bscore:
+                bscore = scores[state, i, qlen]
+                bi = i
+                bj = qlen
+                bstate = state
+
+    ## trace back, query bases past the seed end are inserts at slen
+    qmap = np.zeros(qlen, dtype=np.int32)
+    qins = np.zeros(qlen, dtype=np.int32)
+    for j in xrange(bj, qlen):
+        qmap[j] = slen
+        qins[j] = j - bj
+    i = bi
+    j = bj
+    state = bstate
+    while (i > 0) and (j > 0):
+        prev = trace[state, i, j]
+        if state == 0:
+            qmap[j-1] = i-1
+            qins[j-1] = -1
+            i -= 1
+            j -= 1
+        elif state == 1:
+            i -= 1
+        else:
+            qmap[j-1] = i
+            j -= 1
+        state = prev
+
+    ## query bases before the seed start are inserts at 0
+    for jdx in xrange(j):
+        qmap[jdx] = 0
+
+    ## rank inserted bases within each insertion
+    for jdx in xrange(qlen):
+        if qins[jdx] >= 0:
+            if (jdx > 0) and (qins[jdx-1] >= 0) and (qmap[jdx-1] == qmap[jdx]):
+                qins[jdx] = qins[jdx-1] + 1
+            else:
+                qins[jdx] = 0
+    return qmap, qins
+
+
+
 def build_clusters(data, sample, maxindels):
     """ 
     Combines information from .utemp and .htemp files to create .clust files, 
@@ -319,18 +515,18 @@ def build_clusters(data, sample, maxindels):
     proc = subprocess.Popen(cmd)
     _ = proc.communicate()[0]
 
-    ## load ALL derep reads into a dictionary (this can be a few GB of RAM)
-    ## and is larger if names are larger. We are grabbing two lines at a time.
-    alldereps = {}
-    with open(derepfile, 'rb') as ioderep:
-        dereps = itertools.izip(*[iter(ioderep)]*2)
-        for namestr, seq in dereps:
-            nnn, sss = [i.strip() for i in namestr, seq]
-            alldereps[nnn[1:]] = sss
+    ## index derep reads by a hash of their names instead of loading them
+    ## all into memory (which took a few GB of RAM). Seqs are read from disk
+    ## as the clusters are built.
+    derepidx = index_dereps(derepfile)
+    ioderep = open(derepfile, 'rb')
 
     ## store observed seeds (this could count up to >million in bad data sets)
     seedsseen = set()
 
+    ## (nseqs, depth, maxlen) of each cluster in the order they are written
+    sizes = array.array("I")
+
     ## Iterate through the usort file grabbing matches to build clusters
     with open(usort, 'rb') as insort:
         ## iterator, seed null, seqlist null
@@ -339,10 +535,14 @@ def build_clusters(data, sample, maxindels):
         fseqs = []
         seqlist = []
         seqsize = 0
+        gapfree = True
+        fdepth = 0
+        flen = 0
         while 1:
-            ## grab the next line
+            ## grab the next line, split on tabs to keep empty fields (caln)
             try:
-                hit, seed, _, ind, ori, _ = isort.next().strip().split()
+                hit, seed, _, ind, ori, _, caln = \
+                    isort.next().rstrip("\n").split("\t")
             except StopIteration:
                 break
 
@@ -351,7 +551,10 @@ def build_clusters(data, sample, maxindels):
                 seedsseen.add(seed)
                 ## store the last fseq, count it, and clear fseq
                 if fseqs:
+                    if gapfree:
+                        fseqs[0] = fseqs[0].replace("*\n", "*=\n", 1)
                     seqlist.append("\n".join(fseqs))
+                    sizes.extend((len(fseqs), fdepth, flen))
                     seqsize += 1
                     fseqs = []
 
@@ -363,23 +566,33 @@ def build_clusters(data, sample, maxindels):
                         seqlist = []
 
                 ## store the new seed on top of fseq
-                fseqs.append(">{}*\n{}".format(seed, alldereps[seed]))
+                sseq = get_derep(ioderep, derepidx, seed)
+                fseqs.append(">{}*\n{}".format(seed, sseq))
                 lastseed = seed
+                gapfree = True
+                fdepth = int(seed.split(";")[-2][5:])
+                flen = len(sseq)
 
             ## add match to the seed
-            seq = alldereps[hit]
+            seq = get_derep(ioderep, derepidx, hit)
             ## revcomp if orientation is reversed (comp preserves nnnn)
             if ori == "-":
                 seq = comp(seq)[::-1]
             ## only save if not too many indels
             if int(ind) <= maxindels:                
                 fseqs.append(">{}{}\n{}".format(hit, ori, seq))
+                gapfree = gapfree and gapless(caln)
+                fdepth += int(hit.split(";")[-2][5:])
+                flen = max(flen, len(seq))
             else:
                 LOGGER.info("filtered by maxindels: %s %s", ind, seq)
 
     ## write whatever is left over to the clusts file
     if fseqs:
+        if gapfree:
+            fseqs[0] = fseqs[0].replace("*\n", "*=\n", 1)
         seqlist.append("\n".join(fseqs))
+        sizes.extend((len(fseqs), fdepth, flen))
     if seqlist:
         clustsout.write("\n//\n//\n".join(seqlist)+"\n//\n//\n")
 
@@ -403,7 +616,9 @@ def build_clusters(data, sample, maxindels):
 
             ## append to list if new seed
             if nnn[1:] not in seedsseen:
-                seqlist.append("{}*\n{}".format(nnn, alldereps[nnn[1:]]))
+                sseq = get_derep(ioderep, derepidx, nnn[1:])
+                seqlist.append("{}*\n{}".format(nnn, sseq))
+                sizes.extend((1, int(nnn.split(";")[-2][5:]), len(sseq)))
                 seqsize += 1            
 
     ## write whatever is left over to the clusts file
@@ -412,7 +627,120 @@ def build_clusters(data, sample, maxindels):
 
     ## close the file handle
     clustsout.close()
-    del alldereps
+    ioderep.close()
+
+    ## store the number of seqs, depth and length of each cluster
+    write_clust_sizes(sample.files.clusters, sizes)
+
+
+
+def index_dereps(derepfile):
+    """
+    Returns the hashes of the read names in a (two lines per read) derep
+    file, sorted, and the file offset of each read. This takes 16 bytes per
+    read, and seqs are fetched from the file with get_derep.
+    """
+    hashes = []
+    offsets = []
+    with open(derepfile, 'rb') as ioderep:
+        dereps = itertools.izip(*[iter(ioderep)]*2)
+        offset = 0
+        hblock = []
+        oblock = []
+        for namestr, seq in dereps:
+            hblock.append(hash(namestr.strip()[1:]))
+            oblock.append(offset)
+            offset += len(namestr) + len(seq)
+            ## store as arrays in blocks to keep python ints out of memory
+            if len(hblock) == 100000:
+                hashes.append(np.array(hblock, dtype=np.int64))
+                offsets.append(np.array(oblock, dtype=np.uint64))
+                hblock = []
+                oblock = []
+        hashes.append(np.array(hblock, dtype=np.int64))
+        offsets.append(np.array(oblock, dtype=np.uint64))
+
+    ## sort by hash for lookups
+    hashes = np.concatenate(hashes)
+    offsets = np.concatenate(offsets)
+    order = np.argsort(hashes, kind="mergesort")
+    return hashes[order], offsets[order]
+
+
+
+def get_derep(ioderep, derepidx, name):
+    """
+    Returns the seq of the read 'name' from an open derep file using the
+    index from index_dereps. Hash collisions are resolved by the name line.
+    """
+    hashes, offsets = derepidx
+    nhash = hash(name)
+    idx = np.searchsorted(hashes, nhash)
+    while (idx < hashes.shape[0]) and (hashes[idx] == nhash):
+        ioderep.seek(offsets[idx])
+        if ioderep.readline().strip()[1:] == name:
+            return ioderep.readline().strip()
+        idx += 1
+    raise IPyradError("read {} not found in derep file".format(name))
+
+
+
+def gapless(caln):
+    """
+    Returns True if a vsearch CIGAR string (caln) has no indels, except
+    for a trailing overhang, so that the hit is aligned to its seed just by
+    left-justifying them. "=" or an empty caln mean identical to the seed.
+    """
+    ops = re.findall(r"\d*([MDI])", caln.strip())
+    if ops and ops[-1] != "M":
+        ops = ops[:-1]
+    return all([i == "M" for i in ops])
+
+
+
+def get_host_budgets(data, ipyclient):
+    """
+    Returns a dict of engine ids on each host, and a dict of the memory 
+    budget (bytes) of each host for concurrent step 3 jobs. The budget is
+    _hackersonly["max_host_memory"] (GB), capped at the physical memory of
+    the host. If it is not set all engines are one unlimited group and 
+    hosts are not probed.
+    """
+    maxmem = data._hackersonly["max_host_memory"]
+    if not maxmem:
+        return {None: list(ipyclient.ids)}, {None: float("inf")}
+
+    dview = ipyclient.direct_view()
+    hostmems = dview.apply_sync(host_memory)
+
+    hosts = {}
+    budgets = {}
+    for (host, mem), eid in zip(hostmems, ipyclient.ids):
+        hosts.setdefault(host, []).append(eid)
+        budgets[host] = int(maxmem * 1e9)
+        if mem:
+            budgets[host] = min(budgets[host], mem)
+    return hosts, budgets
+
+
+
+def estimate_memory(data, sample, funcstr, nchunks):
+    """
+    Rough estimate of the peak memory (bytes) of a step 3 job, scaled from
+    the size of the sample's edited reads files by MEMORY_FACTORS. Align 
+    and reconcat jobs handle one chunk at a time, and mapping also holds
+    the reference index.
+    """
+    insize = sum([os.path.getsize(i) for i in \
+                  itertools.chain(*sample.files.edits) if os.path.exists(i)])
+    mem = insize * MEMORY_FACTORS[funcstr]
+    if funcstr in ["muscle_align", "reconcat"]:
+        mem /= nchunks
+    if funcstr == "mapreads":
+        refseq = data.paramsdict["reference_sequence"]
+        if os.path.exists(refseq):
+            mem += os.path.getsize(refseq)
+    return int(mem)
 
 
 
@@ -444,17 +772,27 @@ def new_apply_jobs(data, samples, ipyclient, nthreads, maxindels):
     """
     Create a DAG of prealign jobs to be run in order for each sample. Track 
     Progress, report errors. Each assembly method has a slightly different
-    DAG setup, calling different functions.
+    DAG setup, calling different functions. Jobs are submitted once their
+    dependencies finish and their estimated memory fits in a host's budget,
+    if _hackersonly["max_host_memory"] is set.
     """
 
-    ## Two view objects, threaded and unthreaded
-    lbview = ipyclient.load_balanced_view()
-    ## for HPC systems this should be done to make sure targets are spread
-    ## among different nodes. 
-    if nthreads:
-        thview = ipyclient.load_balanced_view(targets=ipyclient.ids[::nthreads])
+    ## Two view objects per host, threaded and unthreaded, so that the
+    ## memory of jobs running on each host can be tracked. For HPC systems 
+    ## threaded targets should be spread among different nodes. 
+    hosts, budgets = get_host_budgets(data, ipyclient)
+    lbviews = {}
+    thviews = {}
+    for host in hosts:
+        lbviews[host] = ipyclient.load_balanced_view(targets=hosts[host])
+        if nthreads:
+            thviews[host] = ipyclient.load_balanced_view(
+                                targets=hosts[host][::nthreads])
     snames = [i.name for i in samples]
 
+    ## number of align jobs per sample, set by muscle_chunker
+    nchunks = max(1, int(data._hackersonly["align_chunks"]))
+
     ## Create DAGs for the assembly method being used, store jobs in nodes
     dag = nx.DiGraph()
     nodes = []
@@ -476,8 +814,8 @@ def new_apply_jobs(data, samples, ipyclient, nthreads, maxindels):
         for func in joborder:
             nodes.append("{}-{}-{}".format(func, 0, sname))
 
-        ## add jobs for the align funcs, each will have max 10
-        for chunk in range(10):
+        ## add jobs for the align funcs, one for each chunk
+        for chunk in range(nchunks):
             nodes.append("{}-{}-{}".format("muscle_align", chunk, sname))
 
         ## add final reconcat jobs
@@ -510,17 +848,21 @@ def new_apply_jobs(data, samples, ipyclient, nthreads, maxindels):
 
         ## add the first align job for each sample such that it cannot start
         ## until all samples have finished chunking, and then add remaining
-        ## 9 align jobs that can't start until after the first chunk is 
-        ## finished. This is nice because it makes the largest chunks go first, 
-        ## and it *greatly* simplifies the dag. However, it slows performance
-        ## if there are fewer than four samples, since it will wait on the 
-        ## first chunk, but such small jobs are uncommon.
+        ## align jobs that can't start until after the first chunk is 
+        ## finished. Chunks are balanced by alignment cost, and this *greatly* 
+        ## simplifies the dag. However, it slows performance if there are 
+        ## fewer than four samples, since it will wait on the first chunk, 
+        ## but such small jobs are uncommon.
         for sname2 in snames:
             dag.add_edge("{}-{}-{}".format("muscle_chunker", 0, sname2), 
                          "{}-{}-{}".format("muscle_align", 0, sname))
 
-        ## add remaining 9 align jobs dependent on first (0) being finished
-        for chunk in range(1, 10):
+        ## reconcat can't start until the first chunk has aligned
+        dag.add_edge("{}-{}-{}".format("muscle_align", 0, sname), 
+                     "{}-{}-{}".format("reconcat", 0, sname))
+
+        ## add remaining align jobs dependent on first (0) being finished
+        for chunk in range(1, nchunks):
             dag.add_edge("{}-{}-{}".format("muscle_align", 0, sname), 
                          "{}-{}-{}".format("muscle_align", chunk, sname))
 
@@ -532,14 +874,28 @@ def new_apply_jobs(data, samples, ipyclient, nthreads, maxindels):
     ## dicts for storing submitted jobs and results
     results = {}
 
-    ## submit jobs to the engines in single or threaded views. The topological
-    ## sort makes sure jobs are input with all dependencies found.
-    for node in nx.topological_sort(dag):
-        ## get list of async results leading to this job
-        deps = [results[n] for n in dag.predecessors(node)]
+    ## estimated memory of each job, from the size of its sample's inputs.
+    ## Only needed when jobs are held back to fit in a memory budget.
+    memory = {}
+    throttled = bool(data._hackersonly["max_host_memory"])
+    for node in dag:
+        funcstr, chunk, sname = node.split("-", 2)
+        if throttled:
+            memory[node] = estimate_memory(data, data.samples[sname], 
+                                           funcstr, nchunks)
+        else:
+            memory[node] = 0
+    LOGGER.info("host memory budgets: %s", budgets)
+
+    ## jobs waiting to be submitted in topological order, so all 
+    ## dependencies are found, and memory in use by running jobs on each host
+    pending = list(nx.topological_sort(dag))
+    running = {}
+    used = {host: 0 for host in hosts}
 
+    def submit(node, host, deps):
+        """ submit a job to the single or threaded view of a host """
         ## get func, sample, and args for this func (including [data, sample])
-        #print(node, deps)
         funcstr, chunk, sname = node.split("-", 2)
         func = FUNCDICT[funcstr]
         sample = data.samples[sname]
@@ -556,20 +912,56 @@ def new_apply_jobs(data, samples, ipyclient, nthreads, maxindels):
 
         # submit and store AsyncResult object. Some jobs are threaded.
         if nthreads and (funcstr in THREADED_FUNCS):
-            #LOGGER.info('submitting %s to %s-threaded view', funcstr, nthreads)
-            with thview.temp_flags(after=deps, block=False):
-                results[node] = thview.apply(func, *args)
-        else:   
-            #LOGGER.info('submitting %s to single-threaded view', funcstr)            
-            with lbview.temp_flags(after=deps, block=False):
-                results[node] = lbview.apply(func, *args)
+            view = thviews[host]
+        else:
+            view = lbviews[host]
+        with view.temp_flags(after=deps, block=False):
+            results[node] = view.apply(func, *args)
+
+    def schedule():
+        """ 
+        Submits jobs whose dependencies are finished to the host with the 
+        most free memory if they fit in it. A job larger than any budget
+        runs when its host is otherwise empty. Once a ready job does not 
+        fit, no later jobs are started until it is, so that smaller jobs 
+        can't keep refilling the host and hold it back forever. Jobs with a
+        failed dependency are submitted right away and fail with an 
+        ImpossibleDependency.
+        """
+        ## free the memory of finished jobs
+        for node in running.keys():
+            if results[node].ready():
+                used[running.pop(node)] -= memory[node]
+
+        blocked = False
+        for node in list(pending):
+            deps = [results.get(n) for n in dag.predecessors(node)]
+            if not all([(i is not None) and i.ready() for i in deps]):
+                continue
+            host = max(hosts, key=lambda x: budgets[x] - used[x])
+            if all([i.successful() for i in deps]):
+                if blocked or (used[host] and \
+                              (memory[node] > budgets[host] - used[host])):
+                    blocked = True
+                    continue
+                running[node] = host
+                used[host] += memory[node]
+            submit(node, host, deps)
+            pending.remove(node)
+
+    ## without a memory budget submit the whole DAG up front, the engines
+    ## hold back each job until its dependencies are done.
+    if not throttled:
+        for node in pending:
+            submit(node, None, [results[n] for n in dag.predecessors(node)])
+        del pending[:]
 
     ## track jobs as they finish, abort if someone fails. This blocks here 
     ## until all jobs are done. Keep track of which samples have failed so 
     ## we only print the first error message.
     sfailed = set()
     for funcstr in joborder + ["muscle_align", "reconcat"]:
-        errfunc, sfails, msgs = trackjobs(funcstr, results)
+        errfunc, sfails, msgs = trackjobs(funcstr, results, dag, schedule)
         if errfunc:
             for sidx in xrange(len(sfails)):
                 sname = sfails[sidx]
@@ -589,7 +981,8 @@ def new_apply_jobs(data, samples, ipyclient, nthreads, maxindels):
             func, chunk, sname = async.split("-", 2)
             if (func == "muscle_align") and (sname == sample.name):
                 if results[async].successful():
-                    badaligns[sample] = int(results[async].get())
+                    badaligns[sample] = badaligns.get(sample, 0) + \
+                                        int(results[async].get())
 
     ## for the samples that were successful:
     for sample in badaligns:
@@ -657,21 +1050,25 @@ def _plot_dag(dag, results, snames):
 
 
 
-def trackjobs(func, results):
+def trackjobs(func, results, dag, schedule):
     """ 
     Blocks and prints progress for just the func being requested from a list
-    of submitted engine jobs. Returns whether any of the jobs failed. 
+    of engine jobs, calling schedule to submit jobs as they become ready. 
+    Returns whether any of the jobs failed. 
     """
     LOGGER.info("inside trackjobs of %s", func)
 
-    ## get just the jobs from results that are relevant to this func
-    asyncs = [(i, results[i]) for i in results if i.split("-", 2)[0] == func]
+    ## get just the jobs from the dag that are relevant to this func
+    names = [i for i in dag if i.split("-", 2)[0] == func]
 
     ## get start time for progress bar
     start = time.time()
     while 1:
+        ## submit jobs that are ready and fit in memory
+        schedule()
+
         ## how many of this func have finished so far
-        ready = [i[1].ready() for i in asyncs]
+        ready = [(i in results) and results[i].ready() for i in names]
 
         ## get time so far
         elapsed = datetime.timedelta(seconds=int(time.time()-start))
@@ -689,6 +1086,9 @@ def trackjobs(func, results):
             break
         time.sleep(0.1)
 
+    ## get just the jobs from results that are relevant to this func
+    asyncs = [(i, results[i]) for i in names]
+
     ## did any samples fail?
     success = [i[1].successful() for i in asyncs]
     
@@ -960,7 +1360,7 @@ def cluster(data, sample, nthreads):
            "-id", str(data.paramsdict["clust_threshold"]), 
            "-minsl", str(minsl), 
            "-userout", uhandle, 
-           "-userfields", "query+target+id+gaps+qstrand+qcov", 
+           "-userfields", "query+target+id+gaps+qstrand+qcov+caln", 
            "-maxaccepts", "1", 
            "-maxrejects", "0", 
            "-threads", str(nthreads), 
@@ -992,40 +1392,62 @@ def cluster(data, sample, nthreads):
 
 def muscle_chunker(data, sample):
     """ 
-    Splits the muscle alignment into chunks. Each runs on N clusters at a time.
+    Splits the clusters into chunks for alignment. The number of chunks is
+    set by _hackersonly["align_chunks"], and chunk boundaries are chosen so
+    that each has about the same alignment cost, which grows with the
+    number of seqs in each cluster (recorded when clusters were written).
     """
     ## log our location for debugging
     LOGGER.info("inside muscle_chunker")
 
-    ## get the number of clusters
+    ## load clusters
     clustfile = os.path.join(data.dirs.clusts, sample.name+".clust.gz")
     with gzip.open(clustfile, 'rb') as clustio:
-        tclust = clustio.read().count("//")//2
-        optim = (tclust//10) + (tclust%10)
-        LOGGER.info("optim for align chunks: %s", optim)
-
-    ## write optim clusters to each tmp file
-    clustio = gzip.open(clustfile, 'rb')
-    inclusts = iter(clustio.read().strip().split("//\n//\n"))
-    grabchunk = list(itertools.islice(inclusts, optim))
-
-    idx = 0
-    while grabchunk:
-        tmpfile = os.path.join(data.tmpdir, sample.name+"_chunk_{}.ali".format(idx)) 
-        with open(tmpfile, 'wb') as out:
-            out.write("//\n//\n".join(grabchunk))
-        idx += 1
-        grabchunk = list(itertools.islice(inclusts, optim))
-    clustio.close()
+        inclusts = clustio.read().strip().split("//\n//\n")
+
+    ## get the number of seqs in each cluster. muscle aligns at most 200. 
+    ## If sizes were not recorded (e.g., clusters from an older version) 
+    ## split into chunks with equal numbers of clusters.
+    sizehandle = clust_sizes_path(clustfile)
+    if os.path.exists(sizehandle):
+        sizes = np.load(sizehandle)
+        cost = np.cumsum(np.minimum(sizes[:, 0], 200), dtype=np.float64)
+    else:
+        LOGGER.info("no cluster sizes for %s, chunking by count", clustfile)
+        cost = np.arange(1, len(inclusts)+1, dtype=np.float64)
+
+    ## index of the first cluster in each chunk after the first
+    nchunks = max(1, int(data._hackersonly["align_chunks"]))
+    if cost.shape[0]:
+        targets = cost[-1] * np.arange(1, nchunks) / nchunks
+        bounds = [int(i) for i in np.searchsorted(cost, targets, side="right")]
+    else:
+        bounds = []
+    LOGGER.debug("align chunk bounds: %s", bounds)
+
+    ## write clusters to each tmp file, leftovers go in the last chunk
+    inclusts = iter(inclusts)
+    start = 0
+    for idx, end in enumerate(bounds + [None]):
+        if end is None:
+            grabchunk = list(inclusts)
+        else:
+            grabchunk = list(itertools.islice(inclusts, end-start))
+            start = end
+        if grabchunk:
+            tmpfile = os.path.join(data.tmpdir, 
+                                   sample.name+"_chunk_{}.ali".format(idx)) 
+            with open(tmpfile, 'wb') as out:
+                out.write("//\n//\n".join(grabchunk))
 
 
 
 def reconcat(data, sample):
-    """ takes aligned chunks (usually 10) and concatenates them """
+    """ takes aligned chunks (align_chunks) and concatenates them """
 
     ## get chunks
     chunks = glob.glob(os.path.join(data.tmpdir,
-             sample.name+"_chunk_[0-9].aligned"))
+             sample.name+"_chunk_[0-9]*.aligned"))
    
     ## sort by chunk number, cuts off last 8 =(aligned)
     chunks.sort(key=lambda x: int(x.rsplit("_", 1)[-1][:-8]))
@@ -1033,7 +1455,8 @@ def reconcat(data, sample):
     ## concatenate finished reads
     sample.files.clusters = os.path.join(data.dirs.clusts,
                                          sample.name+".clustS.gz")
-    ## reconcats aligned clusters
+    ## reconcats aligned clusters and their sizes
+    sizes = []
     with gzip.open(sample.files.clusters, 'wb') as out:
         for fname in chunks:
             with open(fname) as infile:
@@ -1044,6 +1467,12 @@ def reconcat(data, sample):
                 else:
                     out.write(dat+"\n//\n//\n")
             os.remove(fname)
+            if os.path.exists(clust_sizes_path(fname)):
+                sizes.append(np.load(clust_sizes_path(fname)))
+                os.remove(clust_sizes_path(fname))
+    if sizes:
+        sizes = np.concatenate(sizes)
+    write_clust_sizes(sample.files.clusters, sizes)
 
 
 
@@ -1242,9 +1671,48 @@ DENOVO_MINUS = ["derep_concat_split",
                 "build_clusters", 
                 "muscle_chunker"]
 
-ALIGNFUNCS = ["muscle_align", 
+ALIGNFUNCS = ["muscle_align",
               "reconcat"]
 
+## rough estimate of the peak memory of each job as a multiple of the size
+## of the sample's edited reads. They are not calibrated against measured 
+## usage, but are upper-end guesses from what each job holds in memory, so 
+## they are only used to hold back jobs when the user sets a budget with 
+## _hackersonly["max_host_memory"]. 
+MEMORY_FACTORS = {
+    ## vsearch derep holds every unique read
+    "derep_concat_split" : 1.0,
+    ## smalt streams reads, the reference index is added separately
+    "mapreads" :           0.5,
+    ## vsearch cluster_smallmem holds the seeds (unique reads that don't 
+    ## match another), at most the derep reads, usually much fewer
+    "cluster" :            0.5,
+    ## streams the sorted hits, holding the derep index and seen seeds
+    "build_clusters" :     0.1,
+    ## streams the bam, holds a chunk of regions and the PE merge files
+    "ref_muscle_chunker" : 0.5,
+    ## reads the whole (uncompressed) clust file to split it
+    "muscle_chunker" :     1.0,
+    ## hold one chunk of clusters (divided by the number of chunks)
+    "muscle_align" :       1.0,
+    "reconcat" :           1.0
+    }
+
+## in-process aligner (star_align) scores. Match/mismatch are the +5/-4 of
+## the EDNAFULL matrix (as in EMBOSS needle). Opening a gap (-12, the first 
+## gap base) costs more than one mismatch but less than two base swings 
+## (match -> mismatch is 9), so a read is only gapped if that recovers at 
+## least two mismatches. End gaps are free since hits overhang the seed.
+## Each further gap base costs 1, so a 3 bp indel is one gap rather than 
+## three. Clusters with more than ALIGN_MAXSEQS
+## seqs, or whose hits insert at the same seed position, go to muscle. 
+## Alignments are checked against muscle in tests/test_align.py.
+ALIGN_MATCH = 5
+ALIGN_MISMATCH = -4
+ALIGN_GAPOPEN = -12
+ALIGN_GAPEXTEND = -1
+ALIGN_MAXSEQS = 50
+
 
 NO_UHITS_ERROR = """\
     No clusters (.utemp hits) found for {}. If you are running preview mode and
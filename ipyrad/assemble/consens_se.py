@@ -8,7 +8,7 @@ from __future__ import print_function
 
 
 import scipy.stats
-import scipy.misc
+import scipy.special
 import itertools
 import datetime
 import numpy as np
@@ -25,51 +25,55 @@ import logging
 LOGGER = logging.getLogger(__name__)
 
 
-@memoize
-def binomprobr(base1, base2, error, het):
+## largest site depth (base1 + base2) in the binomial table. Sites with 
+## depth >= 500 are scaled to a base1 count of 500 before they are called.
+MAXBINOMDEPTH = 1000
+
+## binomial tables for the most recent [E, H] estimates on this engine
+BINOMCACHE = {}
+
+## rows per hdf5 chunk of the catg arrays, keeps each chunk well under the 
+## hdf5 4GB chunk limit. Cats are also buffered and copied in these blocks.
+CATG_CHUNK = 5000
+
+
+def binomtable(error, het):
     """
     given two bases are observed at a site n1 and n2, and the error rate e, the
     probability the site is truly aa,bb,ab is calculated using binomial 
-    distribution as in Li_et al 2009, 2011, and if coverage > 500, 500 
-    dereplicated reads were randomly sampled.
+    distribution as in Li_et al 2009, 2011. Returns tables indexed by 
+    (n1+n2, n2) of the probability of the best genotype and of whether it
+    is ab, computed in log space once for each [E, H] and kept in BINOMCACHE
+    so that all chunks run on an engine share it.
     """
-    ## major allele freq
-    mjaf = base1/float(base1+base2)
+    key = (error, het)
+    if key in BINOMCACHE:
+        return BINOMCACHE[key]
+
+    depth, base2 = np.mgrid[:MAXBINOMDEPTH+1, :MAXBINOMDEPTH//2+1]
+    base1 = depth - base2
     prior_homo = ((1.-het)/2.)
     prior_het = het
 
-    ## get probabilities. Note, b/c only allow two bases, base2 == sum-base1
-    try:
-        hetro = scipy.misc.comb(base1+base2, base1)/(2.**(base1+base2))
-    except OverflowError:
-        LOGGER.error("OVERFLOW %s %s", base1, base2)
-        hetro = 0.5
-    homoa = scipy.stats.binom.pmf(base2, base1+base2, error)
-    homob = scipy.stats.binom.pmf(base1, base1+base2, error)
-
-    ## calculate probs
-    homoa *= prior_homo
-    homob *= prior_homo
-    hetro *= prior_het
+    ## log probabilities of aa, bb and ab. Only base1 >= base2 is looked up.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        homoa = scipy.stats.binom.logpmf(base2, depth, error)
+        homob = scipy.stats.binom.logpmf(base1, depth, error)
+        hetro = scipy.special.gammaln(depth+1) \
+              - scipy.special.gammaln(base1+1) \
+              - scipy.special.gammaln(base2+1) \
+              - depth*np.log(2.)
+        logprobs = np.array([homoa + np.log(prior_homo), 
+                             homob + np.log(prior_homo), 
+                             hetro + np.log(prior_het)])
+        best = logprobs.max(axis=0)
+        bestprob = 1./np.exp(logprobs - best).sum(axis=0)
+    bestprob[base1 < base2] = 0.
+    ishet = logprobs.argmax(axis=0) == 2
 
-    ## return 
-    probabilities = [homoa, homob, hetro]
-    genotypes = ['aa', 'bb', 'ab']
-    bestprob = max(probabilities)/float(sum(probabilities))
-
-    return [bestprob, mjaf, genotypes[probabilities.index(max(probabilities))]]
-
-
-
-def simpleconsensus(base1, base2):
-    """
-    majority consensus calling for sites with too low of coverage for
-    statistical calling. Only used with 'lowcounts' option. Returns 
-    the most common base. Returns consistent alphabetical order for ties.
-    """
-    #qQn = ['aa','bb','ab']
-    maf = base1/(base1+base2)
-    return [1.0, maf, 'aa']
+    BINOMCACHE.clear()
+    BINOMCACHE[key] = (bestprob, ishet)
+    return bestprob, ishet
 
 
 
@@ -105,11 +109,12 @@ def hetero(base1, base2):
 
 
 
-def removerepeats(consens, arrayed):
+def removerepeats(consens, arrayed, reps):
     """ 
     Checks for interior Ns in consensus seqs and removes those that are at
     low depth, here defined as less than 1/3 of the average depth. The prop 1/3
     is chosen so that mindepth=6 requires 2 base calls that are not in [N,-].
+    Rows of arrayed are dereplicated reads with depths reps.
     """
 
     ## default trim no edges
@@ -132,11 +137,11 @@ def removerepeats(consens, arrayed):
     arrayed = arrayed[:, edges[0]:edges[1]]
 
     ## get column counts of Ns and -s
-    ndepths = np.sum(arrayed == 'N', axis=0) 
-    idepths = np.sum(arrayed == '-', axis=0)
+    ndepths = np.dot(reps, arrayed == 'N')
+    idepths = np.dot(reps, arrayed == '-')
 
     ## get proportion of bases that are N- at each site
-    nons = ((ndepths + idepths) / float(arrayed.shape[0])) >= 0.75
+    nons = ((ndepths + idepths) / float(reps.sum())) >= 0.75
     ## boolean of whether base was called N
     isn = consens == "N"
     ## make ridx
@@ -184,9 +189,17 @@ def consensus(args):
                                  sample.name+"_tmpcons."+str(tmpnum))
     ## h5 for data storage
     io5 = h5py.File(consenshandle.replace("_tmpcons.", "_tmpcats."), 'w')
-    catarr = io5.create_dataset("cats", (optim, maxlen, 4), dtype=np.uint32)
-    nallel = io5.create_dataset("alls", (optim, ), dtype=np.uint8)
-    #catarr = numpy.zeros([optim, maxlen, 4], dtype='uint32')
+    blocksize = max(1, min(optim, CATG_CHUNK))
+    catarr = io5.create_dataset("cats", (optim, maxlen, 4), 
+                                dtype=np.uint32, 
+                                chunks=(blocksize, maxlen, 4))
+    nallel = io5.create_dataset("alls", (optim, ), 
+                                dtype=np.uint8, 
+                                chunks=(blocksize, ))
+
+    ## cats are filled in memory a block at a time and written to the h5
+    catbuf = np.zeros((blocksize, maxlen, 4), dtype=np.uint32)
+    allbuf = np.zeros((blocksize, ), dtype=np.uint8)
 
     ## store data for stats counters
     counters = {"name" : tmpnum,
@@ -228,20 +241,20 @@ def consensus(args):
             ## apply read depth filter
             if nfilter1(data, reps):
 
-                ## get stacks of base counts
-                sseqs = [list(seq) for seq in seqs]
-                arrayed = np.concatenate(
-                          [[seq]*rep for seq, rep in zip(sseqs, reps)])
+                ## one row per dereplicated read, base counts are weighted 
+                ## by reps rather than expanding each read rep times
+                reps = np.array(reps, dtype=np.uint32)
+                arrayed = np.array(seqs).view("S1").reshape(len(seqs), -1)
 
                 ## get consens call for each site, applies paralog-x-site filter
-                consens = np.apply_along_axis(basecall, 0, arrayed, data)
+                consens = basecalls(arrayed, reps, data)
 
                 ## apply a filter to remove low coverage sites/Ns that
                 ## are likely sequence repeat errors. This is only applied to 
                 ## clusters that already passed the read-depth filter (1)
                 if "N" in consens:
                     try:
-                        consens, arrayed = removerepeats(consens, arrayed)
+                        consens, arrayed = removerepeats(consens, arrayed, reps)
 
                     except ValueError as _:
                         LOGGER.info("Caught a bad chunk w/ all Ns. Skip it.")
@@ -257,23 +270,31 @@ def consensus(args):
                     ## filter for maxN, & minlen 
                     if nfilter3(consens, maxn):
                         ## get N alleles and get lower case in consens
-                        consens, nhaps = nfilter4(consens, hidx, arrayed)
+                        consens, nhaps = nfilter4(consens, hidx, arrayed, reps)
 
                         ## store the number of alleles observed
-                        nallel[counters["nconsens"]] = nhaps
+                        bidx = counters["nconsens"] % blocksize
+                        allbuf[bidx] = nhaps
 
                         ## store a reduced array with only CATG
                         catg = np.array(\
-                            [np.sum(arrayed == i, axis=0)  \
+                            [np.dot(reps, arrayed == i)  \
                             for i in list("CATG")], 
                             dtype='uint32').T
-                        catarr[counters["nconsens"], :catg.shape[0], :] = catg
+                        catbuf[bidx, :catg.shape[0], :] = catg
 
                         ## store the seqdata for tmpchunk
                         storeseq[counters["name"]] = "".join(list(consens))
                         counters["name"] += 1
                         counters["nconsens"] += 1
-                        counters["heteros"] += nheteros                            
+                        counters["heteros"] += nheteros
+
+                        ## write a full block of cats
+                        if not counters["nconsens"] % blocksize:
+                            end = counters["nconsens"]
+                            catarr[end-blocksize:end] = catbuf
+                            nallel[end-blocksize:end] = allbuf
+                            catbuf[:] = 0
                     else:
                         #LOGGER.debug("@haplo")
                         filters['maxn'] += 1
@@ -294,7 +315,13 @@ def consensus(args):
             outfile.write("\n".join([">"+sample.name+"_"+str(key)+"\n"+\
                                    str(storeseq[key]) for key in storeseq]))
 
-    ## save tmp catg array that will be combined into hdf5 later
+    ## write the last partial block and save tmp catg array that will be 
+    ## combined into hdf5 later
+    nleft = counters["nconsens"] % blocksize
+    if nleft:
+        end = counters["nconsens"]
+        catarr[end-nleft:end] = catbuf[:nleft]
+        nallel[end-nleft:end] = allbuf[:nleft]
     io5.close()
 
     ## final counts and return
@@ -336,7 +363,7 @@ def nfilter3(consens, maxn):
 
 
 
-def nfilter4(consens, hidx, arrayed):
+def nfilter4(consens, hidx, arrayed, reps):
     """ applies max haplotypes filter returns pass and consens"""
 
     ## if less than two Hs then there is only one allele
@@ -348,11 +375,14 @@ def nfilter4(consens, hidx, arrayed):
 
     ## remove any reads that have N or - base calls at hetero sites
     ## these cannot be used when calling alleles currently.
-    harray = harray[~np.any(harray == "-", axis=1)]    
-    harray = harray[~np.any(harray == "N", axis=1)]
+    keep = ~np.any(harray == "-", axis=1) & ~np.any(harray == "N", axis=1)
+    harray = harray[keep]
+    hreps = reps[keep]
 
     ## get counts of each allele (e.g., AT:2, CG:2)
-    ccx = Counter([tuple(i) for i in harray])
+    ccx = Counter()
+    for allele, rep in zip(harray, hreps):
+        ccx[tuple(allele)] += int(rep)
 
     ## Two possibilities we would like to distinguish, but we can't. Therefore, 
     ## we just throw away low depth third alleles that are within seq. error. 
@@ -363,7 +393,7 @@ def nfilter4(consens, hidx, arrayed):
     ## sequencing errors at hetero sites, making a third allele, or a new 
     ## allelic combination that is not real.
     if len(ccx) > 2:
-        totdepth = harray.shape[0]
+        totdepth = int(hreps.sum())
         cutoff = max(1, totdepth // 10)
         alleles = [i for i in ccx if ccx[i] > cutoff]
     else:
@@ -416,90 +446,81 @@ def storealleles(consens, hidx, alleles):
 
 
 
-def basecall(rsite, data):
-    """ prepares stack for making base calls """
-    ## count em
-    site = Counter(rsite)
-
-    ## remove Ns and (-)s
-    if "N" in site:
-        site.pop("N")
-    if "-" in site:
-        site.pop("-")
-
-    ## get the two most common alleles
-    if site:
-        base1 = base2 = 0
-        comms = site.most_common(2)
-        base1 = comms[0][1]
-        if len(comms) > 1:
-            base2 = comms[1][1]
-
-        ## if site depth after removing Ns, (-s) and third bases is below limit
-        bidepth = base1 + base2
-        if bidepth < data.paramsdict["mindepth_majrule"]:
-            cons = "N"
-
-        ## speedhack: make the base call using a method depending on depth
-        ## if highdepth and invariable just call the only base
-        elif (bidepth > 10) and (not base2):
-            cons = comms[0][0]
-
-        else:
-            ## if depth > 500 reduce to <500 at same proportion to avoid 
-            ## large memerror in scipy.misc.comb function
-            if bidepth >= 500: 
-                sbase1 = int(500 * (base1 / float(base1)))
-                sbase2 = int(500 * (base2 / float(base1)))
-            else:
-                sbase1 = base1
-                sbase2 = base2
-
-            ## And then use basecaller
-            cons = basecaller(data, sbase1, sbase2, comms)
+def basecalls(arrayed, reps, data):
+    """ 
+    Makes base calls for all sites of a cluster at once from the count of 
+    each base at each site, where rows of arrayed are dereplicated reads with
+    depths reps. Ns and (-)s are not counted, and calls use the two most 
+    common bases at each site. 
+    """
+    ## sites are N unless they can be called
+    nsites = arrayed.shape[1]
+    consens = np.zeros(nsites, dtype="S1")
+    consens.fill("N")
+
+    ## (nsites, nbases) count matrix of the observed bases
+    bases = np.array([i for i in np.unique(arrayed) if i not in ("N", "-")])
+    if not bases.size:
+        return consens
+    counts = np.array([np.dot(reps, arrayed == i) for i in bases]).T
+
+    ## the two most common bases at each site
+    order = np.argsort(-counts.astype(np.int64), axis=1, kind="mergesort")
+    sidx = np.arange(nsites)
+    base1 = counts[sidx, order[:, 0]].astype(np.int64)
+    if bases.size > 1:
+        base2 = counts[sidx, order[:, 1]].astype(np.int64)
+        second = bases[order[:, 1]]
     else:
-        cons = "N"
-
-    return cons
-
-
-
-def basecaller(data, base1, base2, comms):
-    """ inputs data to binomprobr and gets alleles correctly oriented """
-
-    ## make statistical base call
-    if base1+base2 >= data.paramsdict["mindepth_statistical"]:
-        prob, _, who = binomprobr(base1, base2, data._este, data._esth)
-
-    elif base1+base2 >= data.paramsdict["mindepth_majrule"]:
-        prob, _, who = simpleconsensus(base1, base2)
-
-    #else:
-    #    LOGGER.error("gap in mindepth settings")
+        base2 = np.zeros(nsites, dtype=np.int64)
+        second = np.zeros(nsites, dtype="S1")
+        second.fill("N")
+    first = bases[order[:, 0]]
+
+    ## if site depth after removing Ns, (-s) and third bases is below limit
+    ## it stays N. speedhack: if highdepth and invariable call the only base
+    bidepth = base1 + base2
+    called = bidepth >= data.paramsdict["mindepth_majrule"]
+    invar = called & (bidepth > 10) & (base2 == 0)
+    consens[invar] = first[invar]
+
+    ## make statistical base calls on the rest, if depth > 500 reduce 
+    ## to <500 at same proportion so sites fall within the binomial table
+    tocall = np.where(called & ~invar)[0]
+    if not tocall.size:
+        return consens
+    sbase1 = base1[tocall]
+    sbase2 = base2[tocall]
+    big = bidepth[tocall] >= 500
+    sbase2[big] = (500 * sbase2[big]) // sbase1[big]
+    sbase1[big] = 500
+
+    ## sites below mindepth_statistical get a majority rule call
+    prob = np.ones(tocall.size)
+    ishet = np.zeros(tocall.size, dtype=np.bool_)
+    stat = (sbase1 + sbase2) >= data.paramsdict["mindepth_statistical"]
+    bestprob, hetgeno = binomtable(data._este, data._esth)
+    prob[stat] = bestprob[sbase1[stat] + sbase2[stat], sbase2[stat]]
+    ishet[stat] = hetgeno[sbase1[stat] + sbase2[stat], sbase2[stat]]
 
     ## if the base could be called with 95% probability
-    if float(prob) >= 0.95:
-        if who != "ab":
-            ## site is homozygous
-            cons = comms[0][0]
-        else:
-            ## site is heterozygous
-            cons = hetero(*[i[0] for i in comms])
-            #LOGGER.info("GIVE: %s, GET: %s", [i[0] for i in comms], cons)
-    else:
-        cons = "N"
-    return cons
+    good = prob >= 0.95
+    homo = tocall[good & ~ishet]
+    consens[homo] = first[homo]
+    for site in tocall[good & ishet]:
+        consens[site] = hetero(first[site], second[site])
+    return consens
 
 
-## TODO: Why isn't this parallelized?
-def cleanup(args):
+
+def merge_chunks(data, sample):
     """ 
-    cleaning up. optim is the size (nloci) of tmp arrays 
+    Merges the tmp catg arrays and consens reads of a sample's chunks into 
+    its .catg h5 database and consens.gz file. This is submitted as an 
+    engine job that waits on the sample's consensus jobs, so it overlaps 
+    with the base calling of other samples. Returns the two file paths.
     """
-
-    ## parse args list
-    data, sample, statsdicts = args
-    LOGGER.info("in cleanup for: %s", sample.name)
+    LOGGER.info("in merge_chunks for: %s", sample.name)
 
     ## collect consens chunk files
     combs1 = glob.glob(os.path.join(
@@ -513,36 +534,71 @@ def cleanup(args):
                         sample.name+"_tmpcats.*"))
     tmpcats.sort(key=lambda x: int(x.split(".")[-1]))
 
-    ## get shape info from the first cat, (optim, maxlen, 4)
-    optim, maxlen, _ = h5py.File(tmpcats[0], 'r')['cats'].shape
+    ## get shape info from the cats, each is (nclusters in chunk, maxlen, 4)
+    ## and goes at the row of its first cluster, so rows match consens names
+    starts = [int(i.split(".")[-1]) for i in tmpcats]
+    shapes = []
+    for icat in tmpcats:
+        io5 = h5py.File(icat, 'r')
+        shapes.append(io5['cats'].shape)
+        io5.close()
+    maxlen = shapes[0][1]
 
-    ## save as a chunked compressed hdf5 array
+    ## save as a chunked compressed hdf5 array, with a bounded chunk size
     handle1 = os.path.join(data.dirs.consens, sample.name+".catg")
     ioh5 = h5py.File(handle1, 'w')
-    nloci = len(tmpcats) * optim
+    nloci = max([i + j[0] for i, j in zip(starts, shapes)])
+    blocksize = max(1, min(nloci, CATG_CHUNK))
     dcat = ioh5.create_dataset("catg", (nloci, maxlen, 4), 
                                dtype=np.uint32,
-                               chunks=(optim, maxlen, 4),
+                               chunks=(blocksize, maxlen, 4),
                                compression="gzip")
     dall = ioh5.create_dataset("nalleles", (nloci, ),
                                dtype=np.uint8,
-                               chunks=(optim, ),
+                               chunks=(blocksize, ),
                                compression="gzip")
 
-    ## Combine all those tmp cats into the big cat
-    start = 0
-    for icat in tmpcats:
+    ## Combine all those tmp cats into the big cat, copied in blocks that 
+    ## end on chunk boundaries of the big cat so that each chunk is 
+    ## compressed once per tmp cat.
+    for icat, start, shape in zip(tmpcats, starts, shapes):
         io5 = h5py.File(icat, 'r')
-        end = start + optim        
-        dcat[start:end] = io5['cats'][:]
-        dall[start:end] = io5['alls'][:]
-        start += optim
+        end = start + shape[0]
+        bstart = start
+        while bstart < end:
+            bend = min(end, (bstart // blocksize + 1) * blocksize)
+            dcat[bstart:bend] = io5['cats'][bstart-start:bend-start]
+            dall[bstart:bend] = io5['alls'][bstart-start:bend-start]
+            bstart = bend
         io5.close()
         os.remove(icat)
     ioh5.close()
 
-    ## store the handle to the Sample
-    sample.files.database = handle1
+    ## merge consens read files
+    handle2 = os.path.join(data.dirs.consens, sample.name+".consens.gz")
+    with gzip.open(handle2, 'wb') as out:
+        for fname in combs1:
+            with open(fname) as infile:
+                out.write(infile.read()+"\n")
+            os.remove(fname)
+
+    return handle1, handle2
+
+
+
+def cleanup(args):
+    """ 
+    cleaning up. Stores the merged files and the summed chunk stats to 
+    the Sample. 
+    """
+
+    ## parse args list
+    data, sample, statsdicts, handles = args
+    LOGGER.info("in cleanup for: %s", sample.name)
+
+    ## store the handles to the Sample
+    sample.files.database = handles[0]
+    sample.files.consens = [handles[1]]
 
     ## record results
     xcounters = {"nconsens": 0,
@@ -553,23 +609,13 @@ def cleanup(args):
                "maxn": 0}
 
     ## merge finished consens stats
-    for i in range(len(combs1)):
-        counters, filters = statsdicts[i]
+    for counters, filters in statsdicts:
         ## sum individual counters
         for key in xcounters:
             xcounters[key] += counters[key]
         for key in xfilters:
             xfilters[key] += filters[key]
 
-    ## merge consens read files
-    handle1 = os.path.join(data.dirs.consens, sample.name+".consens.gz")
-    with gzip.open(handle1, 'wb') as out:
-        for fname in combs1:
-            with open(fname) as infile:
-                out.write(infile.read()+"\n")
-            os.remove(fname)
-    sample.files.consens = [handle1]
-
     ## set Sample stats_dfs values
     if int(xcounters['nsites']):
         prop = int(xcounters["heteros"]) / float(xcounters['nsites'])
@@ -598,21 +644,41 @@ def cleanup(args):
 
 
 def run_full(data, sample, lbview):
-    """ split job into bits and pass to the client """
-
-    ## counter for split job submission
-    num = 0
-
-    ## set optim size for chunks in N clusters. The first few chunks take longer
-    ## because they contain larger clusters, so we create 4X as many chunks as
-    ## processors so that they are split more evenly.
-    ncpus = detect_cpus()
-    optim = int((sample.stats.clusters_total // ncpus) + \
-                (sample.stats.clusters_total % ncpus))
-    #LOGGER.info("ncpus %s, optim %s", ncpus, optim)
+    """ 
+    Splits the clusters of a sample into one chunk per connected engine and
+    passes them to the client. Chunk boundaries are set so that each chunk 
+    holds about the same total read depth, measured from the cluster sizes 
+    recorded in step 3, so that chunks of deep clusters do not become 
+    stragglers. 
+    """
+    ## one chunk per engine connected to the client
+    nchunks = max(1, len(lbview.client.ids))
+
+    ## cumulative depth of clusters. Those outside the depth filters are 
+    ## skipped in consensus, so they add ~nothing. If no sizes were 
+    ## recorded split evenly by cluster count. 
+    sizehandle = clust_sizes_path(sample.files.clusters)
+    if os.path.exists(sizehandle):
+        depths = np.load(sizehandle)[:, 1].astype(np.float64)
+        passed = (depths >= data.paramsdict["mindepth_majrule"]) & \
+                 (depths <= data.paramsdict["maxdepth"])
+        cost = np.cumsum(np.where(passed, depths, 1.))
+    else:
+        cost = np.arange(1, int(sample.stats.clusters_total)+1, \
+                         dtype=np.float64)
+
+    ## number of clusters in each chunk, leftovers go in the last chunk
+    if cost.shape[0]:
+        targets = cost[-1] * np.arange(1, nchunks) / nchunks
+        bounds = np.searchsorted(cost, targets, side="right")
+        optims = np.diff(np.concatenate([[0], bounds])).tolist() + [np.inf]
+    else:
+        optims = [np.inf]
+    LOGGER.debug("consens chunk sizes: %s", optims)
 
     ## break up the file into smaller tmp files for each engine
-    ## chunking by cluster is a bit trickier than chunking by N lines
+    ## chunking by cluster is a bit trickier than chunking by N lines.
+    ## Each is named by the index of its first cluster.
     chunkslist = []
 
     ## open to clusters
@@ -621,24 +687,26 @@ def run_full(data, sample, lbview):
     pairdealer = itertools.izip(*[iter(clusters)]*2)
 
     ## Use iterator to sample til end of cluster
-    done = 0
-    while not done:
+    start = 0
+    for optim in optims:
         ## grab optim clusters and write to file. Clustdealer breaks by clusters
         done, chunk = clustdealer(pairdealer, optim)
-        chunkhandle = os.path.join(data.dirs.clusts, 
-                                   "tmp_"+str(sample.name)+"."+str(num*optim))
         if chunk:
-            chunkslist.append(chunkhandle)            
+            chunkhandle = os.path.join(data.dirs.clusts, 
+                                   "tmp_"+str(sample.name)+"."+str(start))
+            chunkslist.append((chunkhandle, len(chunk)))
             with open(chunkhandle, 'wb') as outchunk:
                 outchunk.write("//\n//\n".join(chunk)+"//\n//\n")
-            num += 1
+            start += len(chunk)
+        if done:
+            break
 
     ## close clusters handle
     clusters.close()
 
     ## send chunks across engines, will delete tmps if failed
     asyncs = []
-    for chunkhandle in chunkslist:
+    for chunkhandle, optim in chunkslist:
         ## used to increment names across processors
         args = [data, sample, chunkhandle, optim]
         async = lbview.apply_async(consensus, args)
@@ -717,8 +785,9 @@ def run(data, samples, force, ipyclient):
     start = time.time()
     lbview = ipyclient.load_balanced_view()
 
-    ## store asyncs for consens call functions
+    ## store asyncs for consens call functions and for merging their chunks
     lasyncs = {}
+    masyncs = {}
 
     ## first progress bar 
     elapsed = datetime.timedelta(seconds=int(time.time()-start))                        
@@ -731,6 +800,12 @@ def run(data, samples, force, ipyclient):
         lasyncs[sample.name] = run_full(data, sample, lbview)
         njobs += len(lasyncs[sample.name])
 
+        ## merge this sample's chunks as soon as they are finished
+        with lbview.temp_flags(after=lasyncs[sample.name]):
+            masyncs[sample.name] = lbview.apply(merge_chunks, 
+                                                *[data, sample])
+        njobs += 1
+
         ## print progress post-slice
         elapsed = datetime.timedelta(seconds=int(time.time()-start))                        
         progressbar(10, 0, " consensus calling     | {}".format(elapsed))
@@ -749,6 +824,7 @@ def run(data, samples, force, ipyclient):
                 nfinished = 0
                 for joblist in lasyncs.values():
                     nfinished += sum([i.ready() for i in joblist])
+                nfinished += sum([i.ready() for i in masyncs.values()])
 
                 ## print progress bars while we wait
                 elapsed = datetime.timedelta(seconds=int(time.time()-start))
@@ -761,7 +837,8 @@ def run(data, samples, force, ipyclient):
         ## get clean samples
         for sample in subsamples:
             statsdicts = [i.get() for i in lasyncs[sample.name]]
-            cleanup([data, data.samples[sample.name], statsdicts])
+            handles = masyncs[sample.name].get()
+            cleanup([data, data.samples[sample.name], statsdicts, handles])
 
         ## build Assembly stats
         data.stats_dfs.s5 = data.build_stat("s5")
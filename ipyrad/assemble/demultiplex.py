@@ -10,6 +10,7 @@ from __future__ import print_function
 
 import os
 import gzip
+import zlib
 import glob
 import time
 import shutil
@@ -175,6 +176,41 @@ def make_stats(data, perfile, fsamplehits, fbarhits, fmisses, fdbars):
 
 
 
+def match_barcodes(barcodes, bararr, maxmismatch):
+    """
+    Vectorized barcode lookup. Takes a list of observed fixed-width barcode
+    strings and a (nbarcodes, barlen) uint8 array of the true barcodes and 
+    returns an array with the index of the closest true barcode for each 
+    observed barcode, or -1 if it differs at more than maxmismatch sites. 
+    Barcodes equally close to two or more true barcodes are ambiguous and 
+    are also returned as -1 (unmatched), rather than assigned arbitrarily.
+    """
+    ## nothing to match
+    nbars, barlen = bararr.shape
+    if not barcodes:
+        return np.zeros(0, dtype=np.int64)
+
+    ## pack observed barcodes into a (nreads, barlen) byte array. Barcodes
+    ## from reads that are too short are padded with Ns (mismatches).
+    joined = "".join(barcodes)
+    if len(joined) != len(barcodes) * barlen:
+        joined = "".join([i[:barlen].ljust(barlen, "N") for i in barcodes])
+    obs = np.fromstring(joined, dtype=np.uint8).reshape(-1, barlen)
+
+    ## count mismatches between every observed and every true barcode
+    diffs = (obs[:, np.newaxis, :] != bararr[np.newaxis, :, :])\
+            .sum(axis=2, dtype=np.uint16)
+
+    ## get closest barcode, and mask those with too many mismatches or 
+    ## that are tied for closest with another barcode
+    best = diffs.argmin(axis=1)
+    mins = diffs[np.arange(best.shape[0]), best]
+    ties = (diffs == mins[:, np.newaxis]).sum(axis=1) > 1
+    best[(mins > maxmismatch) | ties] = -1
+    return best
+
+
+
 def barmatch(data, tups, cutters, longbar, matchdict, fnum):
     """
     We are going to take a single-writer many-readers approach. Barmatch 
@@ -184,15 +220,14 @@ def barmatch(data, tups, cutters, longbar, matchdict, fnum):
 
     Matches reads to barcodes in barcode file and writes to individual temp 
     files, after all read files have been split, temp files are collated into 
-    .fastq files
+    .fastq files. Reads are processed in blocks, and if barcodes are all the 
+    same length (and not 3rad) then the barcodes in each block are matched 
+    in a single vectorized pass by match_barcodes(), otherwise they are 
+    looked up one at a time in the matchdict.
     """
 
-    ## longlist stores sample index (1-indexed) for each read, 
-    ## indexed at 1 because 0 means no match to sample.
-    waitchunk = int(1e6)
-    #sample_index = np.zeros(waitchunk, dtype=np.uint32)
-    #trim_index = np.zeros(waitchunk, dtype=np.uint32)
-    #snames = data.barcodes.keys()
+    ## number of reads to match at a time
+    blocksize = 10000
 
     ## pid name for this engine
     epid = os.getpid()
@@ -231,14 +266,17 @@ def barmatch(data, tups, cutters, longbar, matchdict, fnum):
         quarts = itertools.izip(quart1, iter(int, 1))
     
     ## dictionaries to store first and second reads until writing to file
+    ## and the number of bytes held for each sample
     dsort1 = {} 
     dsort2 = {} 
+    dsize = {}
 
     ## dictionary for all bars matched in sample
     dbars = {} 
     for sample in data.barcodes:
         dsort1[sample] = []
         dsort2[sample] = []
+        dsize[sample] = 0
         dbars[sample] = set()
     
     ## get func for finding barcode
@@ -256,103 +294,114 @@ def barmatch(data, tups, cutters, longbar, matchdict, fnum):
             """ finds barcode for variable barcode lengths"""
             return findbcode(cutters, longbar, read1)
 
+    ## fixed width barcodes are matched as blocks of byte arrays
+    vectorized = (longbar[1] == 'same') and \
+                 ('3rad' not in data.paramsdict["datatype"])
+    if vectorized:
+        snames = data.barcodes.keys()
+        bararr = np.fromstring("".join([data.barcodes[i] for i in snames]), 
+                               dtype=np.uint8).reshape(len(snames), longbar[0])
+
     ## go until end of the file
+    held = 0
     while 1:
-        try:
-            read1, read2 = quarts.next()
-            read1 = list(read1)
-            filestat[0] += 1
-        except StopIteration:
+        block = list(itertools.islice(quarts, blocksize))
+        if not block:
             break
-    
-        barcode = ""
-        ## Get barcode_R2 and check for matching sample name
-        if '3rad' in data.paramsdict["datatype"]:
-            ## Here we're just reusing the findbcode function
-            ## for R2, and reconfiguring the longbar tuple to have the
-            ## maxlen for the R2 barcode
-            ## Parse barcode. Use the parsing function selected above.
-            barcode1 = find3radbcode(cutters=cutters, 
-                                longbar=longbar, read1=read1)
-            barcode2 = find3radbcode(cutters=cutters, 
-                                longbar=(longbar[2], longbar[1]), read1=read2)
-            barcode = barcode1 + "+" + barcode2
+        filestat[0] += len(block)
+
+        ## find the sample (or None) that matches each read in the block
+        if vectorized:
+            barcodes = [getbarcode(cutters, i[0], longbar) for i in block]
+            sidxs = match_barcodes(barcodes, bararr, 
+                                   data.paramsdict["max_barcode_mismatch"])
+            smatches = [snames[i] if i >= 0 else None for i in sidxs]
         else:
-            ## Parse barcode. Uses the parsing function selected above.
-            barcode = getbarcode(cutters, read1, longbar)
-   
-        ## find if it matches 
-        sname_match = matchdict.get(barcode)
-
-        if sname_match:
-            #sample_index[filestat[0]-1] = snames.index(sname_match) + 1
-            ## record who matched
-            dbars[sname_match].add(barcode)
-            filestat[1] += 1
-            filestat[2] += 1
-            samplehits[sname_match] += 1
-            barhits[barcode] += 1
-            if barcode in barhits:
-                barhits[barcode] += 1
-            else:
-                barhits[barcode] = 1
-    
-            ## trim off barcode
-            lenbar = len(barcode)
+            barcodes = [""] * len(block)
+            smatches = [None] * len(block)
+
+        for ridx, (read1, read2) in enumerate(block):
+            read1 = list(read1)
+            barcode = barcodes[ridx]
+
+            ## Get barcode_R2 and check for matching sample name
             if '3rad' in data.paramsdict["datatype"]:
-                ## Iff 3rad trim the len of the first barcode
-                lenbar = len(barcode1)
-    
-            if data.paramsdict["datatype"] == '2brad':
-                read1[1] = read1[1][:-lenbar]
-                read1[3] = read1[3][:-lenbar]
+                ## Here we're just reusing the findbcode function
+                ## for R2, and reconfiguring the longbar tuple to have the
+                ## maxlen for the R2 barcode
+                ## Parse barcode. Use the parsing function selected above.
+                barcode1 = find3radbcode(cutters=cutters, 
+                                    longbar=longbar, read1=read1)
+                barcode2 = find3radbcode(cutters=cutters, 
+                                    longbar=(longbar[2], longbar[1]), read1=read2)
+                barcode = barcode1 + "+" + barcode2
+                sname_match = matchdict.get(barcode)
+            elif not vectorized:
+                ## Parse barcode. Uses the parsing function selected above.
+                barcode = getbarcode(cutters, read1, longbar)
+                sname_match = matchdict.get(barcode)
             else:
-                read1[1] = read1[1][lenbar:]
-                read1[3] = read1[3][lenbar:]
-    
-            ## Trim barcode off R2 and append. Only 3rad datatype
-            ## pays the cpu cost of splitting R2
-            if '3rad' in data.paramsdict["datatype"]:
-                read2 = list(read2)
-                read2[1] = read2[1][len(barcode2):]
-                read2[3] = read2[3][len(barcode2):]
-    
-            ## append to dsort
-            dsort1[sname_match].append("".join(read1))
-            if 'pair' in data.paramsdict["datatype"]:
-                dsort2[sname_match].append("".join(read2))
+                sname_match = smatches[ridx]
 
-        else:
-            misses["_"] += 1
-            if barcode:
+            if sname_match:
+                ## record who matched
+                dbars[sname_match].add(barcode)
                 filestat[1] += 1
-                # if barcode in misses:
-                #     misses[barcode] += 1
-                # else:
-                #     misses[barcode] = 1
-            #else:
-            #    misses["_"] += 1
+                filestat[2] += 1
+                samplehits[sname_match] += 1
+                if barcode in barhits:
+                    barhits[barcode] += 1
+                else:
+                    barhits[barcode] = 1
+        
+                ## trim off barcode
+                lenbar = len(barcode)
+                if '3rad' in data.paramsdict["datatype"]:
+                    ## Iff 3rad trim the len of the first barcode
+                    lenbar = len(barcode1)
+        
+                if data.paramsdict["datatype"] == '2brad':
+                    read1[1] = read1[1][:-lenbar]
+                    read1[3] = read1[3][:-lenbar]
+                else:
+                    read1[1] = read1[1][lenbar:]
+                    read1[3] = read1[3][lenbar:]
+        
+                ## Trim barcode off R2 and append. Only 3rad datatype
+                ## pays the cpu cost of splitting R2
+                if '3rad' in data.paramsdict["datatype"]:
+                    read2 = list(read2)
+                    read2[1] = read2[1][len(barcode2):]
+                    read2[3] = read2[3][len(barcode2):]
+        
+                ## append to dsort
+                rec = "".join(read1)
+                dsort1[sname_match].append(rec)
+                nbytes = len(rec)
+                if 'pair' in data.paramsdict["datatype"]:
+                    rec = "".join(read2)
+                    dsort2[sname_match].append(rec)
+                    nbytes += len(rec)
+                dsize[sname_match] += nbytes
+                held += nbytes
+
+            else:
+                misses["_"] += 1
+                if barcode:
+                    filestat[1] += 1
 
         ## how can we make it so all of the engines aren't trying to write to
         ## ~100-200 files all at the same time? This is the I/O limit we hit..
-        ## write out at 100K to keep memory low. It is fine on HPC which can 
-        ## write parallel, but regular systems might crash
-        if not filestat[0] % waitchunk:
-            ## write the remaining reads to file"
-            writetofile(data, dsort1, 1, epid)
-            if 'pair' in data.paramsdict["datatype"]:
-                writetofile(data, dsort2, 2, epid)
-            ## clear out dsorts
-            for sample in data.barcodes:
-                dsort1[sample] = []
-                dsort2[sample] = []
-            ## reset longlist
-            #longlist = np.zeros(waitchunk, dtype=np.uint32)                
+        ## When the reads held reach the memory budget only the largest 
+        ## sample buffers are written, until half of the budget is free, so 
+        ## that memory is bounded regardless of the number of samples and 
+        ## each flush writes a few large blobs instead of many small ones.
+        if held >= BUFFER_BYTES:
+            held = flush_largest(data, dsort1, dsort2, dsize, epid, 
+                                 BUFFER_BYTES // 2)
 
     ## write the remaining reads to file
-    writetofile(data, dsort1, 1, epid)
-    if 'pair' in data.paramsdict["datatype"]:
-        writetofile(data, dsort2, 2, epid)
+    flush_largest(data, dsort1, dsort2, dsize, epid, 0)
 
     ## return stats in saved pickle b/c return_queue is too small
     ## and the size of the match dictionary can become quite large
@@ -365,17 +414,23 @@ def barmatch(data, tups, cutters, longbar, matchdict, fnum):
 
 
 
-def writetofile(data, dsort, read, pid):
+def writetofile(data, dsort, read, pid, snames=None):
     """ 
-    Writes sorted data 'dsort dict' to a tmp files
+    Writes sorted data 'dsort dict' to a tmp files, for all samples or 
+    only those in snames, as one joined blob per sample.
     """
     if read == 1:
         rrr = "R1"
     else:
         rrr = "R2"
 
-    for sname in dsort:
+    if snames is None:
+        snames = dsort.keys()
+
+    for sname in snames:
         ## skip writing if empty. Write to tmpname
+        if not dsort[sname]:
+            continue
         handle = os.path.join(data.dirs.fastqs, 
                 "tmp_{}_{}_{}.fastq".format(sname, rrr, pid))
         with open(handle, 'a') as out:
@@ -383,29 +438,44 @@ def writetofile(data, dsort, read, pid):
 
 
 
-## TODO: this could be faster using 'cat file1 file2 ... | gzip > out'
-def collate_files(data, sname, tmp1s, tmp2s):
+def flush_largest(data, dsort1, dsort2, dsize, pid, target):
+    """ 
+    Writes the reads held for the samples with the most bytes held to 
+    their tmp files, largest first, until at most 'target' bytes are still
+    held, and returns the number of bytes still held.
+    """
+    held = sum(dsize.values())
+    flush = []
+    for sname in sorted(dsize, key=dsize.get, reverse=True):
+        if held <= target or not dsize[sname]:
+            break
+        flush.append(sname)
+        held -= dsize[sname]
+
+    ## write and clear out dsorts
+    writetofile(data, dsort1, 1, pid, flush)
+    if 'pair' in data.paramsdict["datatype"]:
+        writetofile(data, dsort2, 2, pid, flush)
+    for sname in flush:
+        dsort1[sname] = []
+        dsort2[sname] = []
+        dsize[sname] = 0
+    return held
+
+
+
+def collate_files(data, sname, tmp1s, tmp2s, nthreads=1):
     """ 
-    Collate temp fastq files in tmp-dir into 1 gzipped sample.
+    Collate temp fastq files in tmp-dir into 1 gzipped sample. The gzip
+    file is written as multiple members compressed by nthreads threads.
     """
     ## out handle
     out1 = os.path.join(data.dirs.fastqs, "{}_R1_.fastq.gz".format(sname))
-    with gzip.open(out1, 'w') as tmpout:
-        for incol in tmp1s:
-            with open(incol, 'r') as tmpin:
-                tmpout.write(tmpin.read())
-        tmpout.flush()
-        os.fsync(tmpout.fileno())
+    parallel_gzip(tmp1s, out1, nthreads)
 
     if 'pair' in data.paramsdict["datatype"]:
         out2 = os.path.join(data.dirs.fastqs, "{}_R2_.fastq.gz".format(sname))
-        with gzip.open(out2, 'w') as tmpout:
-            #tmp2s.sort(key=lambda x: int(x.split("_")[-3]))
-            for incol in tmp2s:
-                with open(incol, 'r') as tmpin:
-                    tmpout.write(tmpin.read())
-            tmpout.flush()
-            os.fsync(tmpout.fileno())
+        parallel_gzip(tmp2s, out2, nthreads)
 
 
 
@@ -419,7 +489,8 @@ def prechecks(data, preview, force):
     4) remove old fastq/tmp_sample_R*_ dirs/
     5) return file names as pairs (r1, r2) or fakepairs (r1, 1)
     6) get ambiguous cutter resolutions
-    7) get optim size
+    7) get optim size, or in non-preview mode the number of lines in the 
+       first file from which wrapped_run sets the optim size
     """
 
     ## check for data, do glob for fuzzy matching
@@ -493,7 +564,7 @@ def prechecks(data, preview, force):
     if preview:
         optim = ((data._hackersonly["preview_step1"]) // (data._ipcluster["cores"]))
     else:
-        optim = estimate_optim(raws[0][0], data._ipcluster["cores"])
+        optim = estimate_optim(raws[0][0], 1)
 
     ## Build full inverse barcodes dictionary
     matchdict = {}
@@ -519,9 +590,10 @@ def prechecks(data, preview, force):
                     else:
                         print("""\
         Note: barcodes {}:{} and {}:{} are within {} base change of each other
-            Ambiguous barcodes that match to both samples will arbitrarily
-            be assigned to the first sample. If you do not like this idea 
-            then lower the value of max_barcode_mismatch and rerun step 1\n"""\
+            Ambiguous barcodes that match both samples equally well are
+            discarded (or assigned to the first sample if barcodes differ
+            in length). If you do not like this idea then lower the value 
+            of max_barcode_mismatch and rerun step 1\n"""\
         .format(sname, barc, 
                 matchdict[tbar1], data.barcodes[matchdict[tbar1]],
                 data.paramsdict["max_barcode_mismatch"]))
@@ -542,9 +614,10 @@ def prechecks(data, preview, force):
                                 else:
                                     print("""\
         Note: barcodes {}:{} and {}:{} are within {} base change of each other\
-             Ambiguous barcodes that match to both samples will arbitrarily
-             be assigned to the first sample. If you do not like this idea 
-             then lower the value of max_barcode_mismatch and rerun step 1\n"""\
+             Ambiguous barcodes that match both samples equally well are
+             discarded (or assigned to the first sample if barcodes differ
+             in length). If you do not like this idea then lower the value 
+             of max_barcode_mismatch and rerun step 1\n"""\
         .format(sname, barc, 
                             matchdict[tbar2], data.barcodes[matchdict[tbar2]],
                             data.paramsdict["max_barcode_mismatch"]))
@@ -555,32 +628,45 @@ def prechecks(data, preview, force):
 
 def estimate_optim(testfile, ncpus):
     """ 
-    Estimate a reasonable optim value by grabbing a chunk of sequences, 
-    decompressing and counting them, to estimate the full file size.
+    Estimate a reasonable optim value by decompressing the first 10000 
+    reads in memory and measuring how many bytes of the (compressed) file 
+    they took up, to estimate the number of reads in the full file.
     """
     ## count the len of one file and assume all others are similar len
     insize = os.path.getsize(testfile)
-    tmp_file_name = "./tmp-step1-count.fq"
-    if testfile.endswith(".gz"):
-        infile = gzip.open(testfile)
-        outfile = gzip.open(tmp_file_name, 'wb', compresslevel=5)
-    else:
-        infile = open(testfile)
-        outfile = open(tmp_file_name, 'w')
-        
+    gzipped = testfile.endswith(".gz")
+    nlines = 0
+    consumed = 0
+
     ## We'll take the average of the size of a file based on the
     ## first 10000 reads to approximate number of reads in the main file
-    outfile.write("".join(itertools.islice(infile, 40000)))
-    outfile.close()
-    infile.close()
-
-    ## Get the size of the tmp file
-    tmp_size = os.path.getsize(tmp_file_name)
+    with open(testfile, 'rb') as infile:
+        dobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while nlines < 40000:
+            buf = infile.read(16384)
+            if not buf:
+                break
+            out = buf
+            if gzipped:
+                out = dobj.decompress(buf)
+                ## start a new decompressor if a new gzip member started
+                while dobj.unused_data:
+                    rest = dobj.unused_data
+                    dobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    out += dobj.decompress(rest)
+
+            ## only count the part of the last buffer that was needed
+            newlines = out.count("\n")
+            if nlines + newlines > 40000:
+                consumed += len(buf) * (40000 - nlines) / float(newlines)
+                nlines = 40000
+            else:
+                consumed += len(buf)
+                nlines += newlines
 
-    ## divide by the tmp file size and multiply by 10000 to approximate
-    ## the size of the input .fq files
-    inputreads = int(insize / tmp_size) * 10000
-    os.remove(tmp_file_name)
+    ## divide the file size by the size of the sample and multiply by 
+    ## the number of reads in it to approximate the reads in the file
+    inputreads = int(insize / max(1., consumed) * (nlines // 4))
 
     ## break into ncpu chunks for sending to optim lines of data to each cpu
     optim = (inputreads // (ncpus)) + (inputreads % (ncpus))
@@ -591,6 +677,72 @@ def estimate_optim(testfile, ncpus):
 
 
 
+def disk_bandwidth(data, tmpdir, nbytes=int(3.2e7)):
+    """ 
+    Returns the disk write bandwidth (MB/s) in tmpdir measured by writing 
+    and syncing a test file of nbytes. The result is cached in the project
+    dir (which holds tmpdir) so that it is only measured once.
+    """
+    cache = os.path.join(data.paramsdict["project_dir"], ".ipyrad_diskio")
+    if os.path.exists(cache):
+        try:
+            with open(cache) as infile:
+                return float(infile.read())
+        except ValueError:
+            pass
+
+    handle = os.path.join(tmpdir, "tmp-iotest")
+    block = os.urandom(1024 * 1024)
+    start = time.time()
+    with open(handle, 'wb') as out:
+        for _ in xrange(max(1, nbytes // len(block))):
+            out.write(block)
+        out.flush()
+        os.fsync(out.fileno())
+    elapsed = time.time() - start
+    os.remove(handle)
+    bandwidth = (nbytes / 1e6) / max(elapsed, 1e-3)
+
+    with open(cache, 'w') as out:
+        out.write(str(bandwidth))
+    return bandwidth
+
+
+
+def plan_engines(data, raws, nlines, ipyclient, tmpdir):
+    """ 
+    Returns the number of engines to sort reads on and the number of lines
+    (optim) to split raw files into, given the estimated number of lines in
+    each raw file. The number of engines is capped by the number connected,
+    so that the tmp files written (one per sample, read and engine) stay 
+    below MAX_TMPFILES, and, if _hackersonly["demux_engine_mbps"] is set to
+    the rate (MB/s) at which one engine writes sorted reads, by the disk 
+    write bandwidth. Chunks are sized to make about CHUNKS_PER_ENGINE 
+    chunks for each engine, but at least MINCHUNK lines.
+    """
+    ## engines connected
+    ncap = len(ipyclient.ids)
+
+    ## engines the disk can keep up with
+    engine_mbps = data._hackersonly["demux_engine_mbps"]
+    if engine_mbps:
+        bandwidth = disk_bandwidth(data, tmpdir)
+        ncap = min(ncap, max(1, int(bandwidth // engine_mbps)))
+        LOGGER.info("disk bandwidth %.1f MB/s", bandwidth)
+
+    ## engines before there are too many tmp files
+    nreads = 1 + int('pair' in data.paramsdict["datatype"])
+    ncap = min(ncap, max(1, MAX_TMPFILES // (len(data.barcodes) * nreads)))
+
+    ## chunk size, rounded up so it is divisible by 4
+    optim = (nlines * len(raws)) // (ncap * CHUNKS_PER_ENGINE)
+    optim = max(MINCHUNK, optim)
+    optim += (-optim) % 4
+    LOGGER.info("%s engines, optim %s", ncap, optim)
+    return ncap, optim
+
+
+
 def run(data, preview, ipyclient, force):
     """
     The try statement ensures we cleanup tmpdirs, and the keyboard interrupt
@@ -657,101 +809,87 @@ def wrapped_run(data, preview, ipyclient, force):
     ## initial progress bar
     start = time.time()
 
-    ## set up parallel client. Don't allow more than 10 processors here.
-    lbview = ipyclient.load_balanced_view()#threads=[:20])
-    limited = ipyclient.load_balanced_view(targets=ipyclient.ids[:10])
+    ## Decide how many engines to sort reads on and how many lines to put
+    ## in each chunk, given the engines, disk and size of input files. The
+    ## estimated number of lines in each file is used to decide whether 
+    ## to split it. In preview mode files are not split.
+    if preview:
+        nlines = 0
+        ncap = len(ipyclient.ids)
+    else:
+        nlines = optim
+        ncap, optim = plan_engines(data, raws, nlines, ipyclient, tmpdir)
+    LOGGER.info("sorting reads on %s engines", ncap)
+
+    ## set up parallel client. Big files are split on one engine, which is 
+    ## kept out of the view that sorts reads (if there are others) so that
+    ## chunks are not queued behind the splitter.
+    lbview = ipyclient.load_balanced_view()
+    sorters = ipyclient.ids
+    splitid = sorters[0]
+    if (nlines > optim) and (len(sorters) > 1):
+        sorters = sorters[1:]
+    limited = ipyclient.load_balanced_view(targets=sorters[:ncap])
 
     ## Each engine will use os.getpid() to get its pid number and will
     ## only write to outfiles with that pid suffix
 
-    ## ensure optim is divisible by 4
-    while optim % 4:
-        optim += 1
-
     ### progress
-    LOGGER.info("chunks size = %s lines, on %s cpus", 
-                optim, data._ipcluster["cores"])
+    LOGGER.info("chunks size = %s lines, on %s cpus", optim, ncap)
 
     ## dictionary to store asyncresults for sorting jobs
     filesort = {}
 
-    #####################################################################
-    ## Decide based on file size whether to chunk it to run among engines
-    ## vs whether to just submit it straight to an engine as is. This is 
-    ## decided based on file sizes and number of files. If few files, then
-    ## chunk them up, if many, then raise the limit for splitting.
-    #####################################################################
-
-    ## if more files than cpus: no chunking
-    if len(raws) > data._ipcluster["cores"]:
-        splitlimit = int(12e9)
-    else:
-        ## a general good rule for splitting
-        splitlimit = int(12e6)
-        ## but if many files then up the ante
-        if len(raws) > 20:
-            splitlimit = int(20e6)
-
-    ## send slices N at a time. The dict chunkfiles stores a tuple of rawpairs
-    ## for each input file. So two files and 4 cpus:
-    ## chunkfiles[0] = [(a11,b11),(a12,b12),(a13,b13),(a14,b14)]
-    ## chunkfiles[1] = [(a21,b21),(a22,b22),(a23,b23),(a24,b24)]    
-    chunkfiles = {}
+    ## Files that are small enough are submitted straight to an engine. Big
+    ## files are split into chunks by zcat_make_temps on engine splitid, and
+    ## each chunk is sent to an engine as soon as it has been written, so 
+    ## that sorting reads overlaps with decompressing and splitting the file.
+    ## The dict submitted stores the chunk tuples sent for each input file.
+    splitters = {}
+    submitted = {}
     start = time.time()
 
     for fidx, tups in enumerate(raws):
-        ## if number of lines is > 20M then just submit it
-        if optim * data._ipcluster["cores"] < int(splitlimit):
-            chunkfiles[fidx] = [tups]
-            ## make an empty list for when we analyze this chunk            
-            filesort[fidx] = []
+        ## make an empty list for when we analyze this file
+        filesort[fidx] = []
+        submitted[fidx] = []
+
+        ## if the file would only make one chunk then just submit it
+        if nlines <= optim:
+            args = [data, tups, cutters, longbar, matchdict, fidx]
+            filesort[fidx].append(limited.apply(barmatch, *args))
+            submitted[fidx].append(tups)
 
         else:
             ## chunk the file using zcat_make_temps
             ## this can't really be parallelized unless I/O is parallelized, 
-            ## we just pass it one engine so we can keep the timer counting
-            async = ipyclient[0].apply(zcat_make_temps, 
-                                       [data, tups, fidx, tmpdir, optim])
-
-            ## get the chunk names
-            ## TODO: this progress bar could be improved to update when it finds
-            ## more files in the tmpdir, and count until the num it expects will
-            ## be created.
-            while not async.ready():
-                elapsed = datetime.timedelta(seconds=int(time.time()-start))
-                progressbar(data._ipcluster["cores"], fidx, 
-                    ' chunking large files  | {}'.format(elapsed))        
-                time.sleep(0.1)
-            chunkfiles[fidx] = async.result()
-            ## make an empty list for when we analyze this chunk
-            filesort[fidx] = []
-
-    ## finished
-    elapsed = datetime.timedelta(seconds=int(time.time()-start))
-    progressbar(10, 10, ' chunking large files  | {}'.format(elapsed))        
-    print("")
-
-    #####################################
-    ## send chunkfiles to engines
-    #####################################
-    total = sum([len(i) for i in chunkfiles.values()])
-
-    LOGGER.info("chunkfiles %s", chunkfiles)
-    for fidx, tuplist in chunkfiles.items():
-        for tups in tuplist:
-            LOGGER.info("tups %s", tups)
-            args = [data, tups, cutters, longbar, matchdict, fidx]
-            filesort[fidx].append(limited.apply(barmatch, *args))
+            ## so all of the files are split one at a time on one engine.
+            splitters[fidx] = ipyclient[splitid].apply(zcat_make_temps, 
+                                          [data, tups, fidx, tmpdir, optim])
 
     ########################################
     ## collect finished results as they come
     ########################################    
-    start = time.time()
     done = 0
     while 1:
+        ## send chunks to engines as soon as they are finished being written
+        for fidx, splitter in splitters.items():
+            finished = splitter.ready()
+            if finished and not splitter.successful():
+                raise IPyradWarningExit(splitter.metadata.error)
+            for tups in ready_chunks(data, tmpdir, fidx, finished):
+                if tups not in submitted[fidx]:
+                    LOGGER.info("tups %s", tups)
+                    args = [data, tups, cutters, longbar, matchdict, fidx]
+                    filesort[fidx].append(limited.apply(barmatch, *args))
+                    submitted[fidx].append(tups)
+            if finished:
+                splitters.pop(fidx)
+
         ## progress report
+        total = sum([len(i) for i in submitted.values()])
         elapsed = datetime.timedelta(seconds=int(time.time()-start))
-        progressbar(total, done, 
+        progressbar(max(1, total), done, 
         ' sorting reads         | {}'.format(elapsed))
 
         ## get the finished jobs
@@ -769,7 +907,7 @@ def wrapped_run(data, preview, ipyclient, force):
                     filesort[fidx].remove(async)
                 
         ## are we done yet?
-        if done == total:
+        if (not splitters) and (done == total):
             break
         else:
             time.sleep(0.1)
@@ -801,16 +939,19 @@ def wrapped_run(data, preview, ipyclient, force):
         else:
             r2dict[sname].append(ftmp)
 
-    ## concatenate files
+    ## concatenate files. Each engine already holds a core, so samples are
+    ## compressed in extra threads only when there are fewer samples than 
+    ## engines, to spread the idle engines' cores over them.
     total = len(data.barcodes)
     done = 0
     writers = []
+    nengines = len(ipyclient.ids)
+    nthreads = max(1, nengines // max(1, min(total, nengines)))
     for sname in data.barcodes:
         tmp1s = sorted(r1dict[sname])
         tmp2s = sorted(r2dict[sname])
-        #async = ipyclient[0].apply(collate_files, *[data, sname, tmp1s, tmp2s])
         writers.append(lbview.apply(collate_files, 
-                       *[data, sname, tmp1s, tmp2s]))
+                       *[data, sname, tmp1s, tmp2s, nthreads]))
 
     while 1:
         ready = [i.ready() for i in writers]
@@ -870,7 +1011,9 @@ def zcat_make_temps(args):
     """ 
     Call bash command 'cat' and 'split' to split large files. The goal
     is to create N splitfiles where N is a multiple of the number of processors
-    so that each processor can work on a file in parallel.
+    so that each processor can work on a file in parallel. R1 and R2 files 
+    are split at the same time so that ready_chunks() can hand out pairs of
+    chunks as soon as both are written.
     """
 
     ## split args
@@ -897,41 +1040,36 @@ def zcat_make_temps(args):
     ### The -a flag tells split how long the suffix for each split file
     ### should be. It uses lowercase letters of the alphabet, so `-a 4`
     ### will have 26^4 possible tmp file names.
+    procs = []
     proc1 = sps.Popen(cmd1, stderr=sps.STDOUT, stdout=sps.PIPE)
     proc3 = sps.Popen(cmd3, stderr=sps.STDOUT, stdout=sps.PIPE, stdin=proc1.stdout)
-
-    ## wrap the actual call so we can kill it if anything goes awry
-    try:
-        res = proc3.communicate()[0]
-        proc1.stdout.close()
-    except KeyboardInterrupt:
-        proc3.kill()
-
-    if proc3.returncode:
-        raise IPyradWarningExit(" error in %s: %s", cmd3, res)
-
-    ## grab output handles
-    chunks1 = glob.glob(os.path.join(tmpdir, "chunk1_"+str(num)+"_*"))
-    chunks1.sort()
+    procs.append((cmd3, proc1, proc3))
 
     if "pair" in data.paramsdict["datatype"]:
         proc2 = sps.Popen(cmd2, stderr=sps.STDOUT, stdout=sps.PIPE)
         proc4 = sps.Popen(cmd4, stderr=sps.STDOUT, stdout=sps.PIPE, stdin=proc2.stdout)
+        procs.append((cmd4, proc2, proc4))
 
-        ## wrap the call so we can kill it if interrupted
+    ## wrap the actual calls so we can kill them if anything goes awry
+    for cmd, catproc, splitproc in procs:
         try:
-            res = proc4.communicate()[0]
-            proc2.stdout.close()
+            res = splitproc.communicate()[0]
+            catproc.stdout.close()
         except KeyboardInterrupt:
-            proc4.kill()
+            for _, _, proc in procs:
+                proc.kill()
+            raise
 
-        if proc4.returncode:
-            raise IPyradWarningExit(" error in %s: %s", cmd4, res)
+        if splitproc.returncode:
+            raise IPyradWarningExit(" error in %s: %s", cmd, res)
 
-        ## grab output handles
+    ## grab output handles
+    chunks1 = glob.glob(os.path.join(tmpdir, "chunk1_"+str(num)+"_*"))
+    chunks1.sort()
+
+    if "pair" in data.paramsdict["datatype"]:
         chunks2 = glob.glob(os.path.join(tmpdir, "chunk2_"+str(num)+"_*"))
         chunks2.sort()
-    
     else:
         chunks2 = [0]*len(chunks1)
 
@@ -942,6 +1080,39 @@ def zcat_make_temps(args):
 
 
 
+def ready_chunks(data, tmpdir, num, finished):
+    """ 
+    Returns the (R1, R2) chunk file pairs of raw file 'num' that 
+    zcat_make_temps has finished writing. While it is still running the 
+    last chunk of each read is still being written, so is left out. 
+    """
+    tmpdir = os.path.realpath(tmpdir)
+    chunks1 = sorted(glob.glob(os.path.join(tmpdir, "chunk1_"+str(num)+"_*")))
+    if "pair" in data.paramsdict["datatype"]:
+        chunks2 = sorted(
+            glob.glob(os.path.join(tmpdir, "chunk2_"+str(num)+"_*")))
+    else:
+        chunks2 = [0]*len(chunks1)
+
+    ## only chunks that have been followed by another are complete
+    nready = min(len(chunks1), len(chunks2))
+    if not finished:
+        nready = max(0, min(len(chunks1), len(chunks2)) - 1)
+    return zip(chunks1[:nready], chunks2[:nready])
+
+
+
+## max bytes of sorted reads each engine holds in memory before writing
+BUFFER_BYTES = int(2e8)
+
+## resource model for plan_engines: max number of tmp files written, number
+## of chunks to make for each engine, and min number of lines in a chunk
+MAX_TMPFILES = 20000
+CHUNKS_PER_ENGINE = 2
+MINCHUNK = int(4e6)
+
+
+
 OVERWRITING_FASTQS = """\
     [force] overwriting fastq files previously *created by ipyrad* in:
     {}
@@ -15,7 +15,6 @@ import time
 import gzip
 import os
 
-from collections import Counter
 from util import *
 
 
@@ -53,49 +52,51 @@ def get_frequencies(stacked):
 #     return np.sum(bfreqs*prob, axis=1)
 
 
-def likelihood1(errors, bfreqs, ustacks):
+def likelihood1(errors, bfreqs, ustacks, grad=False):
     """Probability homozygous. All numpy and no loop so there was 
-    no numba improvement to speed when tested. """
+    no numba improvement to speed when tested. If grad the derivative 
+    with respect to errors is also returned."""
     ## make sure base_frequencies are in the right order
     #print uniqstackl.sum()-uniqstack, uniqstackl.sum(), 0.001
     totals = np.array([ustacks.sum(axis=1)]*4).T
     prob = scipy.stats.binom.pmf(totals-ustacks, totals, errors)
-    return np.sum(bfreqs*prob, axis=1)
-
-
-# @jit(['float32[:](float32, float32[:], int16[:,:])'])
-# def jlikelihood2(errors, bfreqs, ustacks):
-#     """probability of heterozygous. Very minimal speedup w/ numba."""
-#     returns = np.zeros(len(ustacks), dtype=np.float32)
-#     for idx, ustack in enumerate(ustacks):
-#         spair = np.array(list(itertools.combinations(ustack, 2)))
-#         bpair = np.array(list(itertools.combinations(bfreqs, 2)))
-#         one = 2.*bpair.prod(axis=1)
-#         tot = ustack.sum()
-#         atwo = tot - spair[:, 0] - spair[:, 1]
-#         two = scipy.stats.binom.pmf(atwo, tot, (2.*errors)/3.)
-#         three = scipy.stats.binom.pmf(\
-#                     spair[:, 0], spair.sum(axis=1), 0.5)
-#         four = 1.-np.sum(bfreqs**2)
-#         returns[idx] = np.sum(one*two*(three/four))
-#     return np.array(returns)
-
-
-def likelihood2(errors, bfreqs, ustacks):
-    """probability of heterozygous"""
-    returns = np.zeros([len(ustacks)])
-    for idx, ustack in enumerate(ustacks):
-        spair = np.array(list(itertools.combinations(ustack, 2)))
-        bpair = np.array(list(itertools.combinations(bfreqs, 2)))
-        one = 2.*bpair.prod(axis=1)
-        tot = ustack.sum()
-        atwo = tot - spair[:, 0] - spair[:, 1]
-        two = scipy.stats.binom.pmf(atwo, tot, (2.*errors)/3.)
-        three = scipy.stats.binom.pmf(\
-                    spair[:, 0], spair.sum(axis=1), 0.5)
-        four = 1.-np.sum(bfreqs**2)
-        returns[idx] = np.sum(one*two*(three/four))
-    return np.array(returns)
+    lik = np.sum(bfreqs*prob, axis=1)
+    if not grad:
+        return lik
+    ## d/dp pmf(k, n, p) = pmf * (k/p - (n-k)/(1-p))
+    nerr = (totals-ustacks).astype(np.float64)
+    dprob = prob*(nerr/errors - ustacks/(1.-errors))
+    return lik, np.sum(bfreqs*dprob, axis=1)
+
+
+## bounds on [H, E] for the optimizer, strictly inside (0, 1) so the 
+## log likelihood and its gradient stay finite
+HETERO_BOUNDS = (1e-9, 1.-1e-9)
+ERROR_BOUNDS = (1e-9, 0.5)
+
+## index pairs of the four bases (C,A,T,G) for the heterozygous likelihood
+PAIRS = np.array(list(itertools.combinations(range(4), 2)))
+
+
+def likelihood2(errors, bfreqs, ustacks, grad=False):
+    """probability of heterozygous. Evaluates all six base pairs of all 
+    unique stacks at once, each row of ustacks being a stack of base counts.
+    If grad the derivative with respect to errors is also returned."""
+    spair0 = ustacks[:, PAIRS[:, 0]].astype(np.float64)
+    spair1 = ustacks[:, PAIRS[:, 1]].astype(np.float64)
+    one = 2.*bfreqs[PAIRS[:, 0]]*bfreqs[PAIRS[:, 1]]
+    tot = ustacks.sum(axis=1).astype(np.float64)[:, np.newaxis]
+    atwo = tot - spair0 - spair1
+    two = scipy.stats.binom.pmf(atwo, tot, (2.*errors)/3.)
+    three = scipy.stats.binom.pmf(spair0, spair0 + spair1, 0.5)
+    four = 1.-np.sum(bfreqs**2)
+    lik = np.sum(one*two*(three/four), axis=1)
+    if not grad:
+        return lik
+    ## chain rule through p = 2e/3
+    perr = (2.*errors)/3.
+    dtwo = two*(atwo/perr - (tot-atwo)/(1.-perr))*(2./3.)
+    return lik, np.sum(one*dtwo*(three/four), axis=1)
 
 
 
@@ -149,18 +150,48 @@ def get_haploid_lik(errors, bfreqs, ustacks, counts):
 
 
 
+def get_diploid_lik_grad(pstart, bfreqs, ustacks, counts):
+    """ Log likelihood score and its gradient given values [H,E] """
+    hetero, errors = pstart
+    lik1, dlik1 = likelihood1(errors, bfreqs, ustacks, grad=True)
+    lik2, dlik2 = likelihood2(errors, bfreqs, ustacks, grad=True)
+    liks = (1.-hetero)*lik1 + hetero*lik2
+    mask = liks > 0
+    score = -np.sum(np.log(liks[mask])*counts[mask])
+    ## d(-log L)/dH and d(-log L)/dE summed over unique stacks
+    dhet = -np.sum(counts[mask]*(lik2[mask]-lik1[mask])/liks[mask])
+    derr = -np.sum(counts[mask]*((1.-hetero)*dlik1[mask] + \
+                                 hetero*dlik2[mask])/liks[mask])
+    return score, np.array([dhet, derr])
+
+
+
+def get_haploid_lik_grad(errors, bfreqs, ustacks, counts):
+    """ Log likelihood score and its gradient given values [E] """
+    lik1, dlik1 = likelihood1(errors[0], bfreqs, ustacks, grad=True)
+    mask = lik1 > 0
+    score = -np.sum(np.log(lik1[mask])*counts[mask])
+    derr = -np.sum(counts[mask]*dlik1[mask]/lik1[mask])
+    return score, np.array([derr])
+
+
+
+## structured dtype used to hash each site's [C,A,T,G] counts as one item
+STACKDTYPE = np.dtype([("C", np.uint32), ("A", np.uint32), 
+                       ("T", np.uint32), ("G", np.uint32)])
+
+
 def tablestack(rstack):
-    """ makes a count dict of each unique array element """
-    ## goes by 10% at a time to minimize memory overhead. 
-    ## Check on the last chunk.
-    # table = Counter()
-    # for i in xrange(0, rstack.shape[0], rstack.shape[0]//10):
-    #     tmp = Counter([j.tostring() for j in rstack[i:i+rstack.shape[0]//10]])
-    #     table.update(tmp)
-    # return table
-    table = Counter([j.tostring() for j in rstack])
-    #LOGGER.info('table %s', table)
-    return table
+    """ 
+    Returns the unique rows of a (nsites, 4) uint32 count array and the 
+    number of times each occurs. Rows are compared through a structured
+    view so each is hashed as a single item.
+    """
+    rstack = np.ascontiguousarray(rstack, dtype=np.uint32)
+    keys, counts = np.unique(rstack.view(STACKDTYPE).ravel(), 
+                             return_counts=True)
+    ustacks = keys.view(np.uint32).reshape(-1, 4)
+    return ustacks, counts
 
 
 
@@ -213,16 +244,13 @@ def stackarray(data, sample, sub):
             if any(merged):
                 reps = [i*2 if j else i for i, j in zip(reps, merged)]
 
-            sseqs = [list(seq) for seq in seqs]
-            try:
-                arrayed = np.concatenate(
-                      [[seq]*rep for seq, rep in zip(sseqs, reps)])
-            except ValueError:
-                LOGGER.info("sseqs %s, reps %s", 
-                    "\n".join(["".join(i) for i in sseqs]), reps)
+            ## one row per dereplicated read, counts are weighted by reps
+            ## below rather than expanding each read rep times
+            reps = np.array(reps, dtype=np.uint32)
+            arrayed = np.array(seqs).view("S1").reshape(len(seqs), -1)
             
             ## enforce minimum depth for estimates
-            if arrayed.shape[0] >= data.paramsdict["mindepth_statistical"]:
+            if reps.sum() >= data.paramsdict["mindepth_statistical"]:
                 ## remove edge columns
                 arrayed = arrayed[:, cutlens[0]:cutlens[1]]
                 ## remove cols that are pair separator
@@ -232,7 +260,7 @@ def stackarray(data, sample, sub):
                 arrayed = arrayed[:, ~np.all(arrayed == "N", axis=0)]
                 ## store in stacked dict
                 catg = np.array(\
-                    [np.sum(arrayed == i, axis=0) for i in list("CATG")], 
+                    [np.dot(reps, arrayed == i) for i in list("CATG")], 
                     dtype=np.uint32).T
                 
                 try:
@@ -284,37 +312,35 @@ def optim(args):
     ## reshape to concatenate all site rows
     #rstack = stacked.reshape(stacked.shape[0]*stacked.shape[1],
     #                         stacked.shape[2])
-    rstack = stacked.astype(np.uint32)
-    ## put into array, count array items as Byte strings
-    tstack = tablestack(rstack)
-    ## drop emtpy count [0,0,0,0] <- no longer needed, since we drop 0s earlier
-    #tstack.pop(np.zeros(4, dtype=np.uint32).tostring())
-    ## get keys back as arrays and store vals as separate arrays
-    ustacks = np.array([np.fromstring(i, dtype=np.uint32) \
-                        for i in tstack.iterkeys()])
-    counts = np.array(tstack.values())
-    ## cleanup    
-    del rstack
-    del tstack
+    ## get unique count rows and the number of sites with each
+    ustacks, counts = tablestack(stacked)
     LOGGER.info(bfreqs)
     LOGGER.info(ustacks)
     LOGGER.info(counts)    
 
-    ## if data are haploid fix H to 0
+    ## bounded quasi-Newton search using the analytic gradient of the 
+    ## log likelihood. If data are haploid fix H to 0
     if data.paramsdict["max_alleles_consens"] == 1:
-        pstart = np.array([0.001], dtype=np.float32)
+        pstart = np.array([0.001], dtype=np.float64)
         hetero = 0.
-        errors = scipy.optimize.fmin(get_haploid_lik, pstart,
-                                    (bfreqs, ustacks, counts),
-                                     disp=False,
-                                     full_output=False)
+        fit = scipy.optimize.minimize(get_haploid_lik_grad, pstart,
+                                      args=(bfreqs, ustacks, counts),
+                                      jac=True,
+                                      method="L-BFGS-B",
+                                      bounds=[ERROR_BOUNDS])
+        errors = fit.x[0]
     ## or do joint diploid estimates
     else:
-        pstart = np.array([0.01, 0.001], dtype=np.float32)
-        hetero, errors = scipy.optimize.fmin(get_diploid_lik, pstart,
-                                            (bfreqs, ustacks, counts), 
-                                             disp=False,
-                                             full_output=False)
+        pstart = np.array([0.01, 0.001], dtype=np.float64)
+        fit = scipy.optimize.minimize(get_diploid_lik_grad, pstart,
+                                      args=(bfreqs, ustacks, counts),
+                                      jac=True,
+                                      method="L-BFGS-B",
+                                      bounds=[HETERO_BOUNDS, ERROR_BOUNDS])
+        hetero, errors = fit.x
+    if not fit.success:
+        LOGGER.warn("optimizer did not converge for %s: %s", 
+                    sample.name, fit.message)
     return hetero, errors
 
 
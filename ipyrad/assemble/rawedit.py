@@ -14,6 +14,9 @@ import os
 import glob
 import gzip
 import math
+import zlib
+import hashlib
+import tempfile
 import time
 import datetime
 import itertools
@@ -27,16 +30,104 @@ LOGGER = logging.getLogger(__name__)
 
 
 ## define globals for afilter
+## adapter stubs searched for anywhere in reads
+ADAPTER1 = "AGATCGG"
+ADAPTER2 = "AGAGCGT"
+## start of the Illumina adapter (common to R1 and R2) that is searched for
+## as a partial overlap with the 3' end of reads if filter_adapters == 2. 
+## Overlaps must be >= PARTIAL_MINLEN and can have one mismatch for every
+## PARTIAL_DIFFLEN bases of overlap. A read without adapter ends in a chance
+## match about once in 17,000 reads with these values (see find_partial).
+ADAPTER_PARTIAL = "AGATCGGAAGAGC"
+PARTIAL_MINLEN = 8
+PARTIAL_DIFFLEN = 10
 
-def afilter(data, sample, bases, cuts1, cuts2, read):
+## min number of reads in a chunk, and min number of chunks per engine
+MINCHUNK = 50000
+CHUNKS_PER_ENGINE = 4
+
+## max number of chunks for files without restart points (single-member 
+## gzip), where every chunk must decompress all of the chunks before it
+MAXSLICES = 10
+
+## gzipped fastqs with no gzip member boundary in the first GZIP_PROBE bytes
+## are treated as single-member files, which have no restart points to index
+GZIP_PROBE = 16*1024*1024
+
+
+
+def seq_matrix(arr, starts, ends):
+    """ 
+    Returns the sequences between starts and ends in a packed block as a 
+    (nreads, maxlen) uint8 matrix padded with zeros, and their lengths.
+    """
+    lens = ends - starts
+    maxlen = lens.max() if lens.size else 0
+    mat = np.zeros((lens.shape[0], maxlen), dtype=np.uint8)
+    readidx, pos = ragged_index(starts, ends)
+    mat[readidx, pos] = arr[starts[readidx] + pos]
+    return mat, lens
+
+
+
+def find_all(mat, lookfor):
+    """ 
+    Returns a boolean array the shape of a seq_matrix that is True at every
+    position where the string lookfor starts in a read. The zero padding 
+    never matches so hits cannot run past the end of a read.
+    """
+    nreads, maxlen = mat.shape
+    klen = len(lookfor)
+    hits = np.zeros((nreads, maxlen + 1), dtype=np.bool_)
+    if klen <= maxlen:
+        win = hits[:, :maxlen - klen + 1]
+        win[:] = True
+        for idx, char in enumerate(lookfor):
+            win &= mat[:, idx:maxlen - klen + 1 + idx] == ord(char)
+    return hits
+
+
+
+def find_partial(mat, lens, adapter):
+    """ 
+    Finds the longest prefix of adapter that overlaps the 3' end of each
+    read in a seq_matrix, allowing one mismatch per PARTIAL_DIFFLEN bases. 
+    Returns the position where the overlap starts, or -1 if none is found.
+
+    Random sequence also matches the adapter prefix by chance. The chance 
+    that a read without adapter is trimmed is at most the sum over overlap 
+    lengths of P(<= allowed mismatches), which is ~1/17,000 for overlaps of 
+    8-13 bases with exact matches below 10 bases (it was ~1/1,200 for 
+    6 bases with one mismatch per 8).
+    """
+    found = np.zeros(lens.shape[0], dtype=np.int64) - 1
+    rows = np.arange(lens.shape[0])
+    aarr = np.fromstring(adapter, dtype=np.uint8)
+    for olen in xrange(len(adapter), PARTIAL_MINLEN - 1, -1):
+        ## reads long enough and not yet assigned a longer overlap
+        mask = (lens >= olen) & (found < 0)
+        if not mask.any():
+            continue
+        tails = mat[rows[mask, np.newaxis], 
+                    (lens[mask] - olen)[:, np.newaxis] + np.arange(olen)]
+        ndiffs = (tails != aarr[:olen]).sum(axis=1)
+        hit = ndiffs <= (olen // PARTIAL_DIFFLEN)
+        found[np.where(mask)[0][hit]] = lens[mask][hit] - olen
+    return found
+
+
+
+def afilter(data, sample, mat, lens, cuts1, cuts2, read):
     """ 
-    Applies filter for primers & adapters. Does three checks in order from 
-    left to right of seq. Checks cut+adapter, adapter, and part of adapter
+    Applies filter for primers & adapters to a block of reads in a 
+    seq_matrix. Does three checks in order from left to right of seq. 
+    Checks cut+adapter, adapter, and part of adapter. If filter_adapters 
+    is 2 it also checks for partial adapters overlapping the 3' end. 
+    Returns an array of where to trim each read, 0 means no trim.
     """
     ## set empty
-    where1 = where2 = where3 = check1 = check2 = None
-    adapter1 = "AGATCGG"
-    adapter2 = "AGAGCGT"
+    nreads = lens.shape[0]
+    where1 = where2 = where3 = where4 = np.zeros(nreads, dtype=np.int64)
 
     ## if ddrad we're looking for the second cutter on read1
     rvcuts = [comp(i)[::-1] for i in cuts1]
@@ -56,7 +147,6 @@ def afilter(data, sample, bases, cuts1, cuts2, read):
         else:
             ## read 2 will have the barcode between: rvcut+[barcode]+[adapter]
             ## and so should only be checked for if barcode info is available
-            #if sample.name in data.barcodes:
             try:
                 barcode = data.barcodes[sample.name]
             except KeyError:
@@ -68,118 +158,91 @@ def afilter(data, sample, bases, cuts1, cuts2, read):
         if data.paramsdict["filter_adapters"] == 2:
             lookfor1 = lookfor1[:-3]
             lookfor2 = lookfor2[:-3]
-        ## if cutter has ambiguous base (2 in cuts) look for both 
-        ## otherwise just one
-        try: 
-            check1 = max(0, bases[1].tostring().find(lookfor1))
-        except Exception as inst:
-            LOGGER.error("EXCEPTION %s", [bases, lookfor1, inst])
-        
-        ### looks for second resolution
-        if sum([1 for i in rvcuts]) == 2:
-            check2 = max(0, bases[1].tostring().find(lookfor2))
-        ### CHECK FOR FIRST FILTER
-        if check1 or check2:
-            where1 = min([i for i in [check1, check2] if i])
-
-    #LOGGER.debug("where1:%s, ch1:%s, ch2:%s, read:%s", 
-    #              where1, check1, check2, read)
+
+        ## look for both resolutions of the cutter, first hit (or 0) of each
+        check1 = find_all(mat, lookfor1).argmax(axis=1)
+        check2 = find_all(mat, lookfor2).argmax(axis=1)
+
+        ### CHECK FOR FIRST FILTER, the first nonzero hit
+        where1 = np.where((check1 != 0) & (check2 != 0), 
+                          np.minimum(check1, check2), 
+                          np.maximum(check1, check2))
 
     ## look for adapter sequence directly in two parts: "AGATCGG.AGAGCGTC"
     ## if strict then shorten the lookfor string
     dist = None
     if data.paramsdict["filter_adapters"] == 2:
         dist = -2    
-    lookfor1 = adapter1[:dist]
-    lookfor2 = adapter2[:dist]
+    check1 = find_all(mat, ADAPTER1[:dist]).argmax(axis=1)
+    check2 = find_all(mat, ADAPTER2[:dist]).argmax(axis=1)
 
-    check1 = max(0, bases[1].tostring().find(lookfor1))
-    check2 = max(0, bases[1].tostring().find(lookfor2))
     ### CHECK FOR SECOND FILTER
-    mincheck = max(check1, check2)
+    mincheck = np.maximum(check1, check2)
 
     ## How far back from adapter to trim to remove cutsite and barcodes
-    if mincheck:
-        ## trim further for check2
-        backup = 1
-        if not check1:
-            backup = 9
-        ## find where to trim
-        if read == 1:
-            where2 = max(0, mincheck - (len(cuts2[0]) + backup))
-        else:
-            if "ddrad" in data.paramsdict["datatype"]:
-                trim = mincheck - ((len(cuts1[0]) + len(cuts2[0])) + backup)
-                where2 = max(0, trim)
-            else:
-                trim = mincheck - ((len(cuts1[0]) + len(cuts1[0])) + backup)
-                where2 = max(0, trim)
+    if read == 1:
+        trimlen = len(cuts2[0])
+    elif "ddrad" in data.paramsdict["datatype"]:
+        trimlen = len(cuts1[0]) + len(cuts2[0])
     else:
-        where2 = 0
+        trimlen = len(cuts1[0]) + len(cuts1[0])
 
-    #LOGGER.debug("where2:%s, ch1:%s, ch2:%s, read:%s",
-    #              where2, check1, check2, read)
+    ## trim further if only found the second part
+    backup = np.where(check1, 1, 9)
+    where2 = np.where(mincheck, 
+                      np.maximum(0, mincheck - (trimlen + backup)), 0)
 
     ## CHECK FOR THIRD FILTER
-    ## if strict filter, do additional search for cut site near edges
-    if any(rvcuts):
-        where3 = 0
-        if data.paramsdict["filter_adapters"] == 2:
-            if not (where1 or where2):
-                if read == 1:
-                    cutback = -15
-                    tail = bases[1].tostring()[cutback:]
-                    if any([i in tail for i in rvcuts]):
-                        where3 = len(bases[1]) + cutback
-                else:
-                    cutback = -10
-                    tail = bases[1].tostring()[cutback:]
-                    if any([i in tail for i in rvcuts]):
-                        where3 = len(bases[1]) + cutback
-    
-    #LOGGER.debug("where3:%s, ......, ......, read:%s", where3, read)
-    try:
-        where = min([i for i in [where1, where2, where3] if i])
-    except (TypeError, ValueError):
-        where = 0
-    return where 
+    ## if strict filter, do additional search for partial adapters at 
+    ## the 3' end and for cut site near edges
+    if data.paramsdict["filter_adapters"] == 2:
+        unfound = (where1 == 0) & (where2 == 0)
+
+        ## partial adapter overlapping 3' end
+        ## A read that is all adapter is trimmed to 1, too short to keep.
+        partial = find_partial(mat, lens, ADAPTER_PARTIAL)
+        where4 = np.where(unfound & (partial >= 0), 
+                          np.maximum(1, partial - (trimlen + 1)), 0)
+
+        ## cut site in the tail
+        if any(rvcuts):
+            if read == 1:
+                cutback = -15
+            else:
+                cutback = -10
+            tailstart = np.maximum(0, lens + cutback)
+            intail = np.arange(mat.shape[1] + 1) >= tailstart[:, np.newaxis]
+            hits = np.zeros(mat.shape[0], dtype=np.bool_)
+            for rvcut in rvcuts:
+                hits |= (find_all(mat, rvcut) & intail).any(axis=1)
+            where3 = np.where(unfound & hits, lens + cutback, 0)
+
+    ## trim at the first nonzero position
+    wheres = np.array([where1, where2, where3, where4])
+    wheres[wheres == 0] = np.iinfo(np.int64).max
+    where = wheres.min(axis=0)
+    where[where == np.iinfo(np.int64).max] = 0
+    return where
 
 
 
 def adapterfilter(args):
     """ 
-    Filters one read for Illumina adapters and appends to a list for writing
+    Trims one read (pair) at the position where adapters were found, or 
+    to the same length if pairgbs, and appends to a list for writing.
     """
 
     ## parse args
-    data, sample, read1, read2, cuts1, cuts2, write1, write2, point = args
-
-    ## look for adapters in sequences
-    wheretocut1 = wheretocut2 = cutter = None
+    data, sample, read1, read2, cutter, write1, write2, point = args
 
     ## keep counter
     kept = 1
 
-    ## check for adapter
-    if data.paramsdict["filter_adapters"]:
-        ## get trim length for read1
-        wheretocut1 = afilter(data, sample, read1, cuts1, cuts2, 1)
-        if 'pair' in data.paramsdict["datatype"]:
-            wheretocut2 = afilter(data, sample, read2, cuts1, cuts2, 2)
-
-        ## cut one or both reads depending on detection of adapters
-        cutter = 0
-        if wheretocut1 and wheretocut2:
-            cutter = min(wheretocut1, wheretocut2)
-        elif wheretocut1 or wheretocut2:
-            cutter = max(wheretocut1, wheretocut2)
-
     ## pairgbs need to be trimmed to the same length. This means it will
     ## always have _c in read names
     if data.paramsdict['datatype'] == 'pairgbs':
         readlens = [len(i) for i in (read1[1], read2[1])]
         cutter = min([i for i in readlens+[cutter] if i])
-    #LOGGER.debug("@cutter w1:%s w2:%s ", wheretocut1, wheretocut2)
 
     if cutter:
         ## if trimmed frag is still long enough
@@ -188,22 +251,15 @@ def adapterfilter(args):
             sseq1 = "\n".join(["@"+sample.name+"_"+str(point)+"_c1", 
                                read1[1].tostring()[:cutter],
                                "+",
-                               #read1[2].tostring(),
                                read1[3].tostring()[:cutter]])
             write1.append(sseq1)
-            #LOGGER.debug("%s", read1[1].tostring())
-            #LOGGER.debug("%s -trim r1", read1[1].tostring()[:cutter])
 
             if len(read2):
                 sseq2 = "\n".join(["@"+sample.name+"_"+str(point)+"_c2",
                                    read2[1].tostring()[:cutter],
                                    "+",
-                                   #read2[2].tostring(),
                                    read2[3].tostring()[:cutter]])
-                                   #bases1[:cutter]+"SS"+bases2[:cutter]+"\n"
                 write2.append(sseq2)
-                #LOGGER.debug("%s", read2[1].tostring())
-                #LOGGER.debug("%s -trim r2", read2[1].tostring()[:cutter])                
         else:
             kept = 0
 
@@ -216,14 +272,12 @@ def adapterfilter(args):
         sseq1 = "\n".join(["@"+sample.name+"_"+str(point)+adapters+"_r1", 
                            read1[1].tostring(),
                            "+", 
-                           #read1[2].tostring(),
                            read1[3].tostring()])
         write1.append(sseq1)
         if len(read2):
             sseq2 = "\n".join(["@"+sample.name+"_"+str(point)+adapters+"_r2", 
                                read2[1].tostring(),
                                "+",
-                               #read2[2].tostring(),
                                read2[3].tostring()])
             write2.append(sseq2)
     return write1, write2, kept
@@ -249,10 +303,7 @@ def rawedit(args):
 
     ## get data slices as iterators and open file handles
     tups = sample.files.concat[0]
-    ## this spends a lot of time reading passed the point where
-    ## other engines read up to to get to the point where it will start...
-
-    fr1, fr2, io1, io2 = get_slice(tups, optim, num)
+    fr1, fr2, io1, io2 = get_slice(data, tups, optim, num)
     quart1 = itertools.izip(fr1, fr1, fr1, fr1)
     if "pair" in data.paramsdict["datatype"]:
         quart2 = itertools.izip(fr2, fr2, fr2, fr2)
@@ -269,32 +320,56 @@ def rawedit(args):
     write1 = []
     write2 = []
 
-    ## apply filters to each read (pair)
+    ## apply filters to blocks of reads (pairs)
+    blocksize = 10000
     while 1:
-        try: 
-            quart = quarts.next()
-        except StopIteration: 
+        block = list(itertools.islice(quarts, blocksize))
+        if not block:
             break
+        counts['orig'] += len(block)
 
-        ## strip reads
-        counts['orig'] += 1 
-        read1 = np.array([np.array(list(i.strip())) for i in quart[0]])
-        read2 = []        
+        ## pack reads into arrays, replace and count low quality bases
+        arr1, starts1, ends1 = pack_reads([i[0] for i in block])
+        nlow = nfilter(data, arr1, starts1, ends1, nreplace)
         if "pair" in data.paramsdict["datatype"]:
-            read2 = np.array([np.array(list(i.strip())) for i in quart[1]])
-
-        ## filter for Ns
-        ## base1 is only returned if both passed for paired-end reads        
-        read1, read2 = nfilter(data, read1, read2, nreplace)
-
-        if len(read1):
-            ## replace cut sites unless cuts already removed
-            if any(data.paramsdict["edit_cutsites"]):
-                read1, read2 = modify_cuts(data, read1, read2)
-
-            ## filter for adapters, and trim to size if pairgbs
-            args = [data, sample, read1, read2, 
-                    cuts1, cuts2, write1, write2, point]
+            arr2, starts2, ends2 = pack_reads([i[1] for i in block])
+            nlow = np.maximum(nlow, 
+                              nfilter(data, arr2, starts2, ends2, nreplace))
+
+        ## maxN filter applies to both reads if paired
+        passed = nlow < data.paramsdict["max_low_qual_bases"]
+        counts["quality"] += int(np.sum(~passed))
+
+        ## replace cut sites unless cuts already removed
+        if any(data.paramsdict["edit_cutsites"]):
+            cutsmod = data.paramsdict["edit_cutsites"]
+            modify_cuts(arr1, starts1, ends1, cutsmod[0])
+            if "pair" in data.paramsdict["datatype"]:
+                modify_cuts(arr2, starts2, ends2, cutsmod[1])
+
+        ## find where to trim adapters for read1 and read2. Cut one or both 
+        ## reads depending on detection of adapters
+        cutters = np.zeros(len(block), dtype=np.int64)
+        if data.paramsdict["filter_adapters"]:
+            mat1, lens1 = seq_matrix(arr1, starts1[:, 1], ends1[:, 1])
+            cutters = afilter(data, sample, mat1, lens1, cuts1, cuts2, 1)
+            if "pair" in data.paramsdict["datatype"]:
+                mat2, lens2 = seq_matrix(arr2, starts2[:, 1], ends2[:, 1])
+                where2 = afilter(data, sample, mat2, lens2, cuts1, cuts2, 2)
+                cutters = np.where((cutters != 0) & (where2 != 0), 
+                                   np.minimum(cutters, where2), 
+                                   np.maximum(cutters, where2))
+
+        for ridx in np.where(passed)[0]:
+            ## views into the packed arrays for the passed read (pair)
+            read1 = get_read(arr1, starts1[ridx], ends1[ridx])
+            read2 = []
+            if "pair" in data.paramsdict["datatype"]:
+                read2 = get_read(arr2, starts2[ridx], ends2[ridx])
+
+            ## trim adapters, and trim to size if pairgbs
+            args = [data, sample, read1, read2, int(cutters[ridx]),
+                    write1, write2, point+ridx]
             write1, write2, kept = adapterfilter(args)
 
             ## counters
@@ -302,11 +377,9 @@ def rawedit(args):
                 counts["keep"] += 1
             else:
                 counts["adapter"] += 1
-        else:
-            counts["quality"] += 1
 
         ## advance number for read names
-        point += 1
+        point += len(block)
 
     ## close file handles
     io1.close()
@@ -331,71 +404,110 @@ def rawedit(args):
 
 
 
-def modify_cuts(data, read1, read2):
-    """ fix cut sites to be error free and not carry ambiguities """
-    ## shorthand
-    cutsmod = data.paramsdict["edit_cutsites"]
+def modify_cuts(arr, starts, ends, cutmod):
+    """ 
+    Fix cut sites to be error free and not carry ambiguities, for a block 
+    of reads packed by pack_reads. If cutmod is an int then that many 
+    bases are trimmed from the start of each read, if it is a string then 
+    the start of each read is replaced with it (with high quality scores).
+    """
+    if not cutmod:
+        return
+    if isinstance(cutmod, int):
+        for line in (1, 3):
+            starts[:, line] = np.minimum(starts[:, line] + abs(cutmod), 
+                                         ends[:, line])
+    elif isinstance(cutmod, str):
+        for idx, base in enumerate(cutmod):
+            for line, char in ((1, base), (3, "B")):
+                inread = (starts[:, line] + idx) < ends[:, line]
+                arr[starts[inread, line] + idx] = ord(char)
+
 
-    ## replace cut region with a single resolution of cut w/o ambiguities
-    if len(read1) and cutsmod[0]:
-        if isinstance(cutsmod[0], int):
-            read1[1] = read1[1][abs(cutsmod[0]):]      
-            read1[3] = read1[3][abs(cutsmod[0]):]        
-        elif isinstance(cutsmod[0], str):
-            read1[1][:len(cutsmod[0])] = list(cutsmod[0])
-            read1[3][:len(cutsmod[0])] = ["B"]*len(cutsmod[0])
 
-    ## same for cut2 and end of second read
-    if len(read2) and cutsmod[1]:
-        ## fix cut sites to be error free before counting Ns
-        #LOGGER.debug("before R2: %s", "".join(read2[1]))
-        if isinstance(cutsmod[1], int):
-            read2[1] = read2[1][abs(cutsmod[1]):]   
-            read2[3] = read2[3][abs(cutsmod[1]):]
-        elif isinstance(cutsmod[1], str):
-            read2[1][:len(cutsmod[1])] = list(cutsmod[1])
-            read2[3][:len(cutsmod[1])] = ["B"]*len(cutsmod[1])
-        #LOGGER.debug("after_R2: %s", "".join(read2[1]))
+def pack_reads(quarts):
+    """ 
+    Packs a list of fastq records (tuples of 4 lines) into one contiguous
+    uint8 array. Returns the array and two (nreads, 4) arrays with the start
+    and end offsets of each line, with trailing newlines stripped.
+    """
+    lines = [line for quart in quarts for line in quart]
+    lens = np.fromiter(itertools.imap(len, lines), dtype=np.int64, 
+                       count=len(lines))
+    ends = np.cumsum(lens)
+    starts = ends - lens
+    arr = np.fromstring("".join(lines), dtype=np.uint8)
+
+    ## strip line endings (\n, then \r)
+    if arr.size:
+        for char in (10, 13):
+            strip = (ends > starts) & (arr[np.maximum(ends - 1, 0)] == char)
+            ends[strip] -= 1
+    return arr, starts.reshape(-1, 4), ends.reshape(-1, 4)
 
-    return read1, read2
 
 
+def get_read(arr, starts, ends):
+    """ returns a read as a list of 4 char array views into a packed block """
+    return [arr[i:j].view("S1") for i, j in zip(starts, ends)]
 
-def nfilter(data, read1, read2, nreplace=True):
+
+
+def nfilter(data, arr, starts, ends, nreplace=True):
     """ 
-    Filters based on max allowed Ns, and either replaces the Ns, or leaves 
-    them. Right now replaces. Also fixes cut site to be error free.
+    Counts the low quality (Q<20) bases in every read of a block packed by
+    pack_reads, and optionally replaces them with Ns in place. Returns an
+    array with the number of low quality bases in each read.
     """
-    ## get qscores
-    qscore = np.array([ord(i) for i in read1[3]])
-    phred1 = qscore - data.paramsdict["phred_Qscore_offset"]
+    ## every quality score in the block, and the read it is from
+    readidx, pos = ragged_index(starts[:, 3], ends[:, 3])
+
+    ## find low quality bases
+    low = arr[starts[readidx, 3] + pos] < \
+          (20 + data.paramsdict["phred_Qscore_offset"])
 
     ## replace low qual with N
     if nreplace:
-        read1[1][phred1 < 20] = "N"
+        mask = low & (pos < (ends[:, 1] - starts[:, 1])[readidx])
+        arr[starts[readidx[mask], 1] + pos[mask]] = ord("N")
 
-    ## maxN filter only applies to first reads if not paired
-    if not "pair" in data.paramsdict["datatype"]:
-        if sum(phred1 < 20) < data.paramsdict["max_low_qual_bases"]:
-            return read1, np.array([])
-        else:
-            return np.array([]), np.array([])
+    return np.bincount(readidx[low], minlength=starts.shape[0])
 
-    else:
-        ## get qscores
-        qscore = np.array([ord(i) for i in read2[3]])
-        phred2 = qscore - data.paramsdict["phred_Qscore_offset"]
-
-        ## replace low qual with N
-        if nreplace:
-            read2[1][phred2 < 20] = "N"
-
-        ## return passed 
-        if max([sum(phred1 < 20), sum(phred2 < 20)]) \
-               < data.paramsdict["max_low_qual_bases"]:
-            return read1, read2
-        else:
-            return np.array([]), np.array([])
+
+
+def ragged_index(starts, ends):
+    """ 
+    Returns the read index and position within the read of every base in 
+    the ragged slices between starts and ends of a packed block.
+    """
+    lens = ends - starts
+    offsets = np.cumsum(lens) - lens
+    readidx = np.repeat(np.arange(lens.shape[0]), lens)
+    pos = np.arange(readidx.shape[0]) - offsets[readidx]
+    return readidx, pos
+
+
+
+def get_optims(nreads, nengines, maxchunks=None):
+    """ 
+    Returns a dict with the chunk size (optim, in reads) and number of 
+    chunks to split each sample into, given a dict of the number of reads 
+    in each sample. Chunks are sized so that all samples together make at
+    least CHUNKS_PER_ENGINE chunks per engine, which keeps the load balanced
+    while the largest samples finish, but are never smaller than MINCHUNK 
+    reads so that small samples are not split into many tiny jobs. Samples
+    in the dict maxchunks are split into at most that many chunks.
+    """
+    chunksize = sum(nreads.values()) // max(1, nengines * CHUNKS_PER_ENGINE)
+    chunksize = max(MINCHUNK, chunksize)
+    maxchunks = maxchunks or {}
+
+    optims = {}
+    for sname, tots in nreads.items():
+        nchunks = max(1, int(math.ceil(tots / float(chunksize))))
+        nchunks = min(nchunks, maxchunks.get(sname, nchunks))
+        optims[sname] = (int(math.ceil(tots / float(nchunks))), nchunks)
+    return optims
 
 
 
@@ -435,36 +547,211 @@ def roundup(num):
 
 
 
-def get_slice(tups, optim, jnum):
+def concat_files(infiles, outfile):
     """ 
-    Slices a chunk from a fastq file and returns it as a list
+    Concatenates fastq files into outfile in bounded buffers without 
+    loading them into memory. If outfile is gzipped then the compressed 
+    data is copied directly, since concatenated gzip files are valid gzip,
+    otherwise each file is decompressed (if gzipped) as it is copied. 
     """
-    ## open file handles
-    if tups[0].endswith(".gz"):
-        io1 = gzip.open(tups[0])
-        rawr1 = iter(io1)
-        if tups[1]:
-            io2 = gzip.open(tups[1])
-            rawr2 = iter(io2)
-        else:
-            io2 = 0
+    with open(outfile, 'wb') as out:
+        for infile in infiles:
+            if infile.endswith(".gz") and not outfile.endswith(".gz"):
+                indat = gzip.open(infile, 'rb')
+            else:
+                indat = open(infile, 'rb')
+            with indat:
+                shutil.copyfileobj(indat, out, 1024*1024)
+
+
+
+def index_fastq(fname, spacing=MINCHUNK*4):
+    """ 
+    Reads through a fastq file, which can be gzipped, once and records 
+    restart points from which it can be read again without starting from 
+    the beginning. For plain files any byte offset is a restart point, for
+    gzipped files only the start of a gzip member is (multi-member files 
+    such as those written by bgzip or by step 1), so a single-member file 
+    will only have a restart point at zero, and reading stops once 
+    GZIP_PROBE bytes pass without a member boundary. Restart points are 
+    recorded at most once every 'spacing' lines. Returns an int64 array 
+    with one row for each restart point: (byte offset, nlines, partial), 
+    where nlines is the number of newlines before the offset and partial 
+    is the number of bytes of an unfinished line before the offset.
+    """
+    gzipped = fname.endswith(".gz")
+    index = [(0, 0, 0)]
+    nlines = partial = offset = nmembers = 0
+    pending = None
+    bufsize = 1024 * 1024
+
+    with open(fname, 'rb') as infile:
+        dobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while 1:
+            buf = infile.read(bufsize)
+            if not buf:
+                break
+            offset += len(buf)
+
+            ## plain text: every buffer end is a restart point
+            if not gzipped:
+                nlines += buf.count("\n")
+                if "\n" in buf:
+                    partial = len(buf) - buf.rfind("\n") - 1
+                else:
+                    partial += len(buf)
+                if nlines - index[-1][1] >= spacing:
+                    index.append((offset, nlines, partial))
+                continue
+
+            ## gzipped: decompress member by member
+            while buf:
+                try:
+                    out = dobj.decompress(buf)
+                except zlib.error:
+                    ## trailing garbage or zero padding after last member
+                    break
+
+                ## only keep a member boundary once the member is readable
+                if out and pending:
+                    index.append(pending)
+                    pending = None
+                nlines += out.count("\n")
+                if "\n" in out:
+                    partial = len(out) - out.rfind("\n") - 1
+                else:
+                    partial += len(out)
+
+                ## anything unused by the decompressor is the next member
+                buf = dobj.unused_data
+                if buf:
+                    nmembers += 1
+                    dobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    if nlines - index[-1][1] >= spacing:
+                        pending = (offset - len(buf), nlines, partial)
+
+            ## a single-member file can only be read from the start
+            if not nmembers and offset >= GZIP_PROBE:
+                return np.array(index[:1], dtype=np.int64)
+
+    return np.array(index, dtype=np.int64)
+
+
+
+def get_index_path(data, fname):
+    """ 
+    Returns the path of the restart point index for a fastq file. Indices 
+    are stored in the edits dir, not next to the (possibly read-only) raw 
+    data, and are named with a hash of the full path of the fastq file so 
+    that files with the same name in different dirs do not collide. 
+    """
+    key = hashlib.md5(os.path.realpath(fname)).hexdigest()[:10]
+    return os.path.join(data.dirs.edits, 
+                        "{}.{}.idx.npz".format(os.path.basename(fname), key))
+
+
+
+def file_stat(fname):
+    """ returns the (size, mtime) of a file that an index was built from """
+    return os.path.getsize(fname), int(os.path.getmtime(fname))
+
+
+
+def load_index(data, fname):
+    """ 
+    Returns the restart point index of a fastq file, or None if there is no
+    index or it was built from a different version of the file. 
+    """
+    handle = get_index_path(data, fname)
+    if not os.path.exists(handle):
+        return None
+    try:
+        saved = np.load(handle)
+        try:
+            if tuple(saved["stat"]) == file_stat(fname):
+                return saved["index"]
+        finally:
+            saved.close()
+    except (IOError, ValueError, KeyError) as inst:
+        LOGGER.warn("ignoring bad fastq index %s: %s", handle, inst)
+    return None
+
+
+
+def index_files(data, tups):
+    """ 
+    Builds restart point indices for the R1 (and R2) fastq file of a sample 
+    unless a current index already exists. Each is written to a tmp file 
+    and renamed into place so an interrupted run never leaves a partial one.
+    Returns the smallest number of restart points in the files, which is 
+    1 if a file can only be read from the start (single-member gzip).
+    """
+    npoints = []
+    for fname in tups:
+        if not fname:
+            continue
+        index = load_index(data, fname)
+        if index is None:
+            stat = file_stat(fname)
+            index = index_fastq(fname)
+            fd, tmphandle = tempfile.mkstemp(dir=data.dirs.edits, 
+                                             suffix=".idx.tmp")
+            with os.fdopen(fd, 'wb') as out:
+                np.savez(out, index=index, stat=np.array(stat, dtype=np.int64))
+            os.rename(tmphandle, get_index_path(data, fname))
+        npoints.append(index.shape[0])
+    return min(npoints or [1])
+
+
+
+def open_at_line(data, fname, nlines):
+    """ 
+    Opens a fastq file, which can be gzipped, at the closest restart point 
+    in its index before line 'nlines', and skips forward to that line. 
+    Returns an iterator over lines and the open file handle. If there is no 
+    index the file is read from the beginning. 
+    """
+    index = load_index(data, fname)
+    if index is None:
+        index = np.zeros((1, 3), dtype=np.int64)
+
+    ## the first full line following each restart point
+    starts = index[:, 1] + (index[:, 2] > 0)
+    ridx = max(0, np.searchsorted(starts, nlines, side='right') - 1)
+    offset, _, partial = index[ridx]
+
+    ## open the file and jump to the restart point
+    rawio = open(fname, 'rb')
+    rawio.seek(offset)
+    if fname.endswith(".gz"):
+        rawr = iter(gzip.GzipFile(fileobj=rawio))
     else:
-        io1 = open(tups[0])
-        rawr1 = iter(io1)
-        if tups[1]:
-            io2 = open(tups[1])
-            rawr2 = iter(io2)
-        else:
-            io2 = 0
+        rawr = iter(rawio)
 
-    ## skip until jnum slice 
-    ## sum takes about 5 seconds for 2M gzipped reads.
-    skip = 0
-    for _ in range(jnum):
-        skip += sum(1 for i in itertools.islice(rawr1, int(optim*4)))
-        if tups[1]:
-            _ = sum(1 for i in itertools.islice(rawr2, int(optim*4)))
-    #LOGGER.info("%s. jumped forward %s lines", jnum, skip)
+    ## discard the rest of a line that was broken at the restart point
+    if partial:
+        next(rawr, None)
+
+    ## skip the remaining lines until the start of the slice
+    for _ in itertools.islice(rawr, int(nlines - starts[ridx])):
+        pass
+    return rawr, rawio
+
+
+
+def get_slice(data, tups, optim, jnum):
+    """ 
+    Slices a chunk from a fastq file and returns it as a list. Uses the
+    restart point index built by index_files() to jump near the start of 
+    the slice instead of reading through all of the preceding slices.
+    """
+    ## open file handles at the start of this slice
+    skip = int(jnum * optim * 4)
+    rawr1, io1 = open_at_line(data, tups[0], skip)
+    if tups[1]:
+        rawr2, io2 = open_at_line(data, tups[1], skip)
+    else:
+        io2 = 0
 
     ## now return the correct slice as a generator
     dat1 = itertools.islice(rawr1, int(optim*4))
@@ -525,8 +812,7 @@ def sample_cleanup(data, sample, results):
                "keep": 0}
 
     ## merge finished edits
-    for i in range(10):
-        counts = results[i]
+    for counts in results:
         fcounts["orig"] += counts["orig"]
         fcounts["quality"] += counts["quality"]
         fcounts["adapter"] += counts["adapter"]
@@ -593,18 +879,20 @@ def run(data, samples, nreplace, force, preview, ipyclient):
             else:
                 subsamples.append(sample)
 
-    ## get optim which is used to slice a sample into 10 equal sized chunks
-    ## if preview-mode then 10 chunks are made out of 'preview' reads.
-    optims = {}
+    ## get optim which is used to slice each sample into equal sized chunks
+    ## if preview-mode then chunks are made out of 'preview' reads.
+    if preview:
+        tots = data._hackersonly["preview_step2"]
+        assert not tots % 4, \
+        "_hackersonly preview_step2 value (nlines) must be divisible by 4."
+    nreads = {}
     for sample in subsamples:
         if preview:
-            tots = data._hackersonly["preview_step2"]
-            assert not tots % 4, \
-            "_hackersonly preview_step2 value (nlines) must be divisible by 4."
-            optims[sample.name] = (tots // 10) + (tots % 10)
+            nreads[sample.name] = tots
         else:
-            tots = int(sample.stats.reads_raw)
-            optims[sample.name] = (tots // 10) + (tots % 10)
+            nreads[sample.name] = int(sample.stats.reads_raw)
+
+    optims = get_optims(nreads, len(ipyclient.ids))
 
     if preview:
         if data._headers:
@@ -633,28 +921,30 @@ def run(data, samples, nreplace, force, preview, ipyclient):
     ## save sliced asyncs
     sliced = {i.name:[] for i in subsamples}    
 
-    ## send jobs to queue to get slices and process them
+    ## send jobs to queue to index each sample's fastqs
+    indexed = {}
     for sample in subsamples:
-        ## get optim slice size for this sample
-        optim = optims[sample.name]
         ## if multiple fastq files for this sample, create a tmp concat file
-        ## TODO: This could be parallelized, for merged real data, but only if 
-        ## disk-writing is parallelized...
+        ## on an engine by streaming the files together.
+        concats = []
         if len(sample.files.fastqs) > 1:
-            ## just copy as a temporary placeholder for fastqs
-            conc1 = os.path.join(data.dirs.edits, sample.name+"_R1_concat.fq")
-            with open(conc1, 'w') as cout1:
-                for tups in sample.files.fastqs:
-                    cout1.write(gzip.open(tups[0]).read())
+            ## keep it gzipped if all of the files are gzipped
+            r1s = [i[0] for i in sample.files.fastqs]
+            suffix = ".fq"
+            if all([i.endswith(".gz") for i in r1s]):
+                suffix = ".fq.gz"
+            conc1 = os.path.join(data.dirs.edits, 
+                                 sample.name+"_R1_concat"+suffix)
+            concats.append(lbview.apply(concat_files, *[r1s, conc1]))
 
             ## Only set conc2 if R2 actually exists
             conc2 = 0
             try:
                 if os.path.exists(sample.files.fastqs[0][1]):
-                    conc2 = os.path.join(data.dirs.edits, sample.name+"_R2_concat.fq")
-                    with open(conc2, 'w') as cout2:
-                        for tups in sample.files.fastqs:
-                            cout2.write(gzip.open(tups[1]).read())
+                    r2s = [i[1] for i in sample.files.fastqs]
+                    conc2 = os.path.join(data.dirs.edits, 
+                                         sample.name+"_R2_concat"+suffix)
+                    concats.append(lbview.apply(concat_files, *[r2s, conc2]))
             except IndexError as _:
                 ## if SE then no R2 files
                 pass
@@ -664,16 +954,38 @@ def run(data, samples, nreplace, force, preview, ipyclient):
             ## just copy as a temporary placeholder for fastqs
             sample.files.concat = sample.files.fastqs
 
-        for job in range(10):
-            args = [data, sample, job, nreplace, optim]
-            async = lbview.apply(rawedit, args)
-            sliced[sample.name].append(async)
+        ## index restart points in the fastq files so that each slice can
+        ## jump to its start
+        with lbview.temp_flags(after=concats):
+            indexed[sample.name] = lbview.apply(index_files, 
+                                        *[data, sample.files.concat[0]])
 
     ## print progress
     try:
         while 1:
+            ## send jobs to process slices of each sample once it is indexed.
+            ## Files that can only be read from the start (one restart point)
+            ## get no more than MAXSLICES chunks, since each must read all 
+            ## those before it. If indexing failed the jobs fail with it.
+            for sample in subsamples:
+                if sample.name not in indexed or \
+                   not indexed[sample.name].ready():
+                    continue
+                index = indexed.pop(sample.name)
+                optim, nchunks = optims[sample.name]
+                if index.successful() and index.get() == 1 and \
+                   nchunks > MAXSLICES:
+                    optim, nchunks = get_optims(nreads, len(ipyclient.ids), 
+                                        {sample.name: MAXSLICES})[sample.name]
+                with lbview.temp_flags(after=[index]):
+                    for job in range(nchunks):
+                        args = [data, sample, job, nreplace, optim]
+                        async = lbview.apply(rawedit, args)
+                        sliced[sample.name].append(async)
+
+            ## jobs of samples still being indexed count towards the total
             asyncs = list(itertools.chain(*sliced.values()))
-            tots = len(asyncs)
+            tots = len(asyncs) + sum([optims[i][1] for i in indexed])
             done = sum([i.ready() for i in asyncs])
             elapsed = datetime.timedelta(seconds=int(time.time()-start))
             if tots != done:
@@ -710,8 +1022,11 @@ def run(data, samples, nreplace, force, preview, ipyclient):
         if all([i.completed for i in asyncs]):
             ## do final stats and cleanup
             assembly_cleanup(data)
-        ## clean up concat files (if any)
-        concats = glob.glob(os.path.join(data.dirs.edits, "*_concat.fq"))
+        ## clean up concat files and the restart point indices of all files
+        ## (finished or left unfinished by an interrupted run)
+        concats = glob.glob(os.path.join(data.dirs.edits, "*_concat.fq*"))
+        concats += glob.glob(os.path.join(data.dirs.edits, "*.idx.npz"))
+        concats += glob.glob(os.path.join(data.dirs.edits, "*.idx.tmp"))
         for concat in concats:
             os.remove(concat)
 
@@ -12,6 +12,9 @@ import os
 import gzip
 import glob
 import shutil
+import hashlib
+import tempfile
+import itertools
 import ipyrad
 import numpy as np
 import subprocess as sps
@@ -30,19 +33,76 @@ LOGGER = logging.getLogger(__name__)
 
 
 
+def get_refindex_root(data):
+    """ 
+    Returns the cache directory for reference indices. They are kept next 
+    to the reference sequence so that every assembly (and branch) using the
+    same reference shares them, or in the project dir if the reference 
+    location is not writable.
+    """
+    refdir = os.path.dirname(os.path.realpath(data.paramsdict['reference_sequence']))
+    if not os.access(refdir, os.W_OK):
+        refdir = os.path.realpath(data.paramsdict["project_dir"])
+    return os.path.join(refdir, ".ipyrad_refindex")
+
+
+
+def reference_key(refseq_file, wordlen, root):
+    """ 
+    Returns a key for the smalt index of a reference sequence built from an 
+    md5 hash of the reference file contents and the smalt index word length.
+    The hash is stored in root with the size and mtime of the reference, 
+    and only recomputed when those change.
+    """
+    stat = "{}\t{}".format(os.path.getsize(refseq_file), 
+                           int(os.path.getmtime(refseq_file)))
+    pathkey = hashlib.md5(os.path.realpath(refseq_file)).hexdigest()[:10]
+    stamp = os.path.join(root, "md5-{}".format(pathkey))
+
+    digest = None
+    if os.path.exists(stamp):
+        with open(stamp, 'r') as instamp:
+            saved = instamp.read().rsplit("\t", 1)
+        if len(saved) == 2 and saved[0] == stat:
+            digest = saved[1].strip()
+
+    if not digest:
+        md5 = hashlib.md5()
+        with open(refseq_file, 'rb') as infile:
+            for block in iter(lambda: infile.read(2**22), b""):
+                md5.update(block)
+        digest = md5.hexdigest()
+        fd, tmpstamp = tempfile.mkstemp(dir=root)
+        with os.fdopen(fd, 'w') as out:
+            out.write("{}\t{}".format(stat, digest))
+        os.rename(tmpstamp, stamp)
+
+    return "{}-k{}".format(digest, wordlen)
+
+
+
 def index_reference_sequence(data, force=False):
     """ 
-    Index the reference sequence, let smalt bail out if it already exists.
+    Index the reference sequence for smalt and samtools. The smalt index is 
+    cached under a key of the reference contents and the index word length, 
+    so branched assemblies and reruns only rebuild it when the reference or
+    word length changes, or if force is set. 
     """
 
     ## get ref file from params
     refseq_file = data.paramsdict['reference_sequence']
 
-    # These are smalt specific index files. We don't ever reference them 
-    # directly except here to make sure they exist, so we don't need to keep em
-    index_sma = refseq_file+".sma"
-    index_smi = refseq_file+".smi"
-    # samtools specific index
+    ## smalt specific index files, stored in the cache dir for this reference.
+    ## mapreads finds them through data.dirs.refindex.
+    root = get_refindex_root(data)
+    if not os.path.exists(root):
+        os.makedirs(root)
+    key = reference_key(refseq_file, 
+                        data._hackersonly["smalt_index_wordlen"], root)
+    data.dirs.refindex = os.path.join(root, key)
+    index_sma = os.path.join(data.dirs.refindex, "smalt.sma")
+    index_smi = os.path.join(data.dirs.refindex, "smalt.smi")
+    # samtools specific index, samtools expects it next to the reference
     index_fai = refseq_file+".fai"
 
     if all([os.path.isfile(i) for i in [index_sma, index_smi, index_fai]]):
@@ -60,32 +120,52 @@ def index_reference_sequence(data, force=False):
     if data._headers:
         print(msg)
 
-    ## Create smalt index for mapping
+    ## Create smalt index for mapping, written to a unique tmp dir and moved
+    ## into place when finished, so an interrupted run is never reused and 
+    ## assemblies indexing the same reference at once don't clobber it.
     ## smalt index [-k <wordlen>] [-s <stepsiz>]  <index_name> <reference_file>
-    cmd1 = [ipyrad.bins.smalt, "index", 
-            "-k", str(data._hackersonly["smalt_index_wordlen"]), 
-            refseq_file, 
-            refseq_file]
-
-    ## call the command
-    proc1 = sps.Popen(cmd1, stderr=sps.STDOUT, stdout=sps.PIPE)
-    error1 = proc1.communicate()[0]
+    if force or not all([os.path.isfile(i) for i in [index_sma, index_smi]]):
+        tmpdir = tempfile.mkdtemp(dir=root, prefix="tmp-")
+        try:
+            cmd1 = [ipyrad.bins.smalt, "index", 
+                    "-k", str(data._hackersonly["smalt_index_wordlen"]), 
+                    os.path.join(tmpdir, "smalt"), 
+                    refseq_file]
+
+            ## call the command
+            proc1 = sps.Popen(cmd1, stderr=sps.STDOUT, stdout=sps.PIPE)
+            error1 = proc1.communicate()[0]
+            if proc1.returncode:
+                raise IPyradWarningExit(error1)
+
+            ## replace any old index. If another assembly moved its new 
+            ## index into place first then keep that one.
+            if os.path.exists(data.dirs.refindex):
+                shutil.rmtree(data.dirs.refindex, ignore_errors=True)
+            try:
+                os.rename(tmpdir, data.dirs.refindex)
+            except OSError:
+                if not all([os.path.isfile(i) for i in [index_sma, index_smi]]):
+                    raise
+        finally:
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir)
 
     ## simple samtools index for grabbing ref seqs
-    cmd2 = [ipyrad.bins.samtools, "faidx", refseq_file]
-    proc2 = sps.Popen(cmd2, stderr=sps.STDOUT, stdout=sps.PIPE)
+    if force or not os.path.isfile(index_fai) or \
+        os.path.getmtime(index_fai) < os.path.getmtime(refseq_file):
+        cmd2 = [ipyrad.bins.samtools, "faidx", refseq_file]
+        proc2 = sps.Popen(cmd2, stderr=sps.STDOUT, stdout=sps.PIPE)
 
-    ## call the command:
-    error2 = proc2.communicate()[0]
+        ## call the command:
+        error2 = proc2.communicate()[0]
 
-    ## error handling
-    if proc1.returncode:
-        raise IPyradWarningExit(error1)
-    if proc2.returncode:
-        if "please use bgzip" in error2:
-            raise IPyradWarningExit(NO_ZIP_BINS.format(refseq_file))
-        else:
-            raise IPyradWarningExit(error2)
+        ## error handling
+        if proc2.returncode:
+            if "please use bgzip" in error2:
+                raise IPyradWarningExit(NO_ZIP_BINS.format(refseq_file))
+            else:
+                raise IPyradWarningExit(error2)
 
     ## print finished message
     if data._headers:
@@ -170,7 +250,7 @@ def mapreads(data, sample, nthreads):
             "-y", str(data.paramsdict['clust_threshold']), 
             "-o", os.path.join(data.dirs.refmapping, sample.name+".sam"),
             "-x",
-            data.paramsdict['reference_sequence']
+            os.path.join(data.dirs.refindex, "smalt")
             ] + sample.files.dereps
 
     ## Reads in the SAM file from cmd1. It writes the unmapped data to file
@@ -298,6 +378,15 @@ def ref_muscle_chunker(data, sample):
         msg = "No reads mapped to reference sequence - {}".format(sample.name)
         LOGGER.warn(msg)
 
+        ## write empty clusters (and sizes) so the sample still has a clust
+        ## file for the next steps. denovo+reference keeps its denovo clusters.
+        sample.files.clusters = os.path.join(data.dirs.clusts, 
+                                             sample.name+".clust.gz")
+        if data.paramsdict["assembly_method"] == "reference" or \
+           not os.path.exists(sample.files.clusters):
+            gzip.open(sample.files.clusters, 'wb').close()
+            write_clust_sizes(sample.files.clusters, [])
+
 
 
 def get_overlapping_reads(data, sample, regions):
@@ -311,19 +400,20 @@ def get_overlapping_reads(data, sample, regions):
     it calls merge_reads (vsearch) to find merged and non-merged reads. These
     are then put into clust.gz with either an nnnn separator or as merged. 
     
-    The main func being called here is 'bam_region_to_fasta', which calls
-    samtools to pull out the mapped reads. 
+    The main func being called here is 'region_clusters', which streams the
+    sorted bam file once alongside the regions and yields their clusters. 
 
     1) Coming into this function we have sample.files.mapped_reads 
         as a sorted bam file, and a passed in list of regions to evaluate.
     2) Get all reads overlapping with each individual region.
-    3) Pipe to vsearch for clustering.
+    3) For PE data merge all read pairs with one call to vsearch.
     4) Append to the clust.gz file.
     """
 
     ## storage and counter
     locus_list = []
     reads_merged = 0
+    sizes = []
 
     ## Set the write mode for opening clusters file.
     ## 1) if "reference" then only keep refmapped, so use 'wb' to overwrite 
@@ -332,8 +422,11 @@ def get_overlapping_reads(data, sample, regions):
     if data.paramsdict["assembly_method"] == "denovo+reference":
         write_flag = 'ab'
 
-    ## file handle for writing clusters
+    ## file handle for writing clusters. Sizes of the denovo clusters are
+    ## made first if missing, so that the ref cluster sizes append to them.
     sample.files.clusters = os.path.join(data.dirs.clusts, sample.name+".clust.gz")
+    if write_flag == 'ab':
+        load_clust_sizes(sample.files.clusters)
     outfile = gzip.open(sample.files.clusters, write_flag)
 
     ## write a separator if appending to clust.gz
@@ -343,28 +436,17 @@ def get_overlapping_reads(data, sample, regions):
     # Wrap this in a try so we can easily locate errors
     try:
         ## For each identified region, build the pileup and write out the fasta
-        for line in regions.strip().split("\n"):
-
-            # Blank lines returned from bedtools screw things up. Filter them.
-            if line == "":
-                continue
-
-            ## get elements from bedtools region
-            chrom, region_start, region_end = line.strip().split()[0:3]
+        for clust in region_clusters(data, sample, regions):
 
-            ## bam_region_to_fasta returns a chunk of fasta sequence
-            args = [data, sample, chrom, region_start, region_end]
-            clust = bam_region_to_fasta(*args)
-
-            ## If bam_region_to_fasta fails for some reason it'll return [], 
-            ## in which case skip the rest of this. Normally happens if reads
-            ## map successfully, but too far apart.
+            ## Regions without reads (or read pairs) return an empty string, 
+            ## normally happens if reads map successfully, but too far apart.
             if not clust:
                 continue
 
             ## Store locus in a list
             #LOGGER.info("clust from bam-region-to-fasta \n %s", clust)
             locus_list.append(clust)
+            sizes.append(clust_sizes(clust))
 
             ## write chunk of 1000 loci and clear list to minimize memory
             if not len(locus_list) % 1000:
@@ -381,6 +463,10 @@ def get_overlapping_reads(data, sample, regions):
         ## close handle
         outfile.close()
 
+        ## record cluster sizes, appending to denovo clusters if present
+        write_clust_sizes(sample.files.clusters, sizes, 
+                          append=(write_flag == 'ab'))
+
     except Exception as inst:
         LOGGER.error("Exception inside get_overlapping_reads - {}".format(inst))
         raise
@@ -565,147 +651,332 @@ def bedtools_merge(data, sample):
 
 
 
-def bam_region_to_fasta(data, sample, chrom, region_start, region_end):
+def parse_regions(regions):
+    """
+    Returns lists of chroms, starts and ends from the bedtools merge output, 
+    and a dict with the rank of each chrom in the (bam sorted) order.
+    """
+    chroms = []
+    starts = []
+    ends = []
+    ranks = {}
+    for line in regions.strip().split("\n"):
+        # Blank lines returned from bedtools screw things up. Filter them.
+        if not line.strip():
+            continue
+        chrom, region_start, region_end = line.strip().split()[0:3]
+        if chrom not in ranks:
+            ranks[chrom] = len(ranks)
+        chroms.append(chrom)
+        starts.append(int(region_start))
+        ends.append(int(region_end))
+    return chroms, starts, ends, ranks
+
+
+
+def iter_region_reads(data, sample, regions):
+    """
+    Streams the sorted mapped bam file once with a single samtools call and 
+    yields (region index, list of sam fields of its reads) for each region 
+    from bedtools_merge, in order. Regions are merged from the read intervals
+    so each read falls in the region that holds its start position.
+    """
+    bamf = sample.files.mapped_reads
+    if not os.path.exists(bamf):
+        raise IPyradWarningExit("  file not found - %s", bamf)
+
+    chroms, starts, ends, ranks = regions
+    cmd = [ipyrad.bins.samtools, "view", bamf]
+    LOGGER.info("streaming reads to regions: %s", cmd)
+    proc = sps.Popen(cmd, stderr=sps.PIPE, stdout=sps.PIPE)
+
+    ## the finally kills samtools if the consumer stops early or fails
+    try:
+        ridx = 0
+        reads = []
+        for line in proc.stdout:
+            bits = line.rstrip("\n").split("\t")
+            ## skip unmapped reads and chroms without regions
+            crank = ranks.get(bits[2])
+            if (int(bits[1]) & 0x4) or (crank is None):
+                continue
+            start = int(bits[3]) - 1
+
+            ## finish regions that end before this read starts
+            while (ridx < len(chroms)) and \
+                  ((ranks[chroms[ridx]] < crank) or \
+                   ((ranks[chroms[ridx]] == crank) and (ends[ridx] <= start))):
+                yield ridx, reads
+                reads = []
+                ridx += 1
+            ## past the last region, keep draining the pipe
+            if ridx == len(chroms):
+                continue
+            if (ranks[chroms[ridx]] == crank) and (starts[ridx] <= start):
+                reads.append(bits)
+
+        ## finish the remaining regions
+        while ridx < len(chroms):
+            yield ridx, reads
+            reads = []
+            ridx += 1
+
+        ## drain and check for errors
+        proc.stdout.close()
+        err = proc.stderr.read()
+        if proc.wait():
+            raise IPyradWarningExit("{} {}".format(cmd, err))
+
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        proc.stdout.close()
+        proc.stderr.close()
+
+
+
+def read_fai(refseq_file):
     """ 
-    Take the chromosome position, and start and end bases and return sequences
-    of all reads that overlap these sites. This is the command we're building:
+    Returns {chrom: (length, offset, linebases, linewidth)} from the 
+    samtools faidx index of the reference, or None if it's compressed.
+    """
+    if refseq_file.endswith(".gz"):
+        return None
+    fai = {}
+    with open(refseq_file+".fai", 'r') as infai:
+        for line in infai:
+            bits = line.split("\t")
+            fai[bits[0]] = tuple(int(i) for i in bits[1:5])
+    return fai
 
-    samtools view -b 1A_sorted.bam 1:116202035-116202060 | \
-             samtools bam2fq <options> -
 
-            -b      : output bam format
-            -0      : For SE, output all reads to this file
-            -1/-2   : For PE, output first and second reads to different files
-            -       : Tell samtools to read in from the pipe
 
-    Write out the sam output and parse it to return as fasta for clust.gz file. 
-    We also grab the reference sequence with a @REF header to aid in alignment
-    for single-end data. This will be removed post-alignment. 
+def fetch_reference(data, fai, refio, chrom, region_start, region_end):
+    """
+    Returns the reference seq between 0-based region_start and region_end.
+    Reads directly from the indexed fasta, or for bgzipped reference files
+    falls back to calling samtools faidx.
     """
+    if fai is None:
+        rstring_id1 = "{}:{}-{}"\
+            .format(chrom.replace("|", "_"), region_start+1, region_end)
+        cmd1 = [ipyrad.bins.samtools, "faidx", 
+                data.paramsdict["reference_sequence"], 
+                rstring_id1]
+        proc1 = sps.Popen(cmd1, stderr=sps.STDOUT, stdout=sps.PIPE)
+        ref = proc1.communicate()[0]
+        if proc1.returncode:
+            raise IPyradWarningExit("  error in %s: %s", cmd1, ref)
+        return "".join(ref.strip().split("\n")[1:])
 
-    ## output bam file handle for storing genome regions
-    bamf = sample.files.mapped_reads
-    if not os.path.exists(bamf):
-        raise IPyradWarningExit("  file not found - %s", bamf)
+    ## file positions of the first and (one past) last base
+    length, offset, lbases, lwidth = fai[chrom]
+    region_end = min(region_end, length)
+    pos0 = offset + (region_start // lbases) * lwidth + region_start % lbases
+    pos1 = offset + (region_end // lbases) * lwidth + region_end % lbases
+    refio.seek(pos0)
+    return refio.read(pos1 - pos0).replace("\n", "").replace("\r", "")
 
-    ## a string argument as input to commands, indexed at either 0 or 1, 
-    ## and with pipe characters removed from chromo names
-    rstring_id1 = "{}:{}-{}"\
-        .format(chrom.replace("|", "_"), str(int(region_start)+1), region_end)
-    rstring_id0 = "{}:{}-{}"\
-        .format(chrom.replace("|", "_"), str(region_start), region_end)
-
-    ## The "samtools faidx" command will grab this region from reference 
-    ## which we'll paste in at the top of each stack to aid alignment.
-    cmd1 = [ipyrad.bins.samtools, "faidx", 
-            data.paramsdict["reference_sequence"], 
-            rstring_id1]
-
-    ## Call the command, I found that it doesn't work with shell=False if 
-    ## the refstring is 'MT':100-200', but it works if it is MT:100-200. 
-    LOGGER.info("Grabbing bam_region_to_fasta:\n %s", cmd1)
-    proc1 = sps.Popen(cmd1, stderr=sps.STDOUT, stdout=sps.PIPE)
-    ref = proc1.communicate()[0]
-    if proc1.returncode:
-        raise IPyradWarningExit("  error in %s: %s", cmd1, ref)
 
-    ## parse sam to fasta. Save ref location to name.
-    name, seq = ref.strip().split("\n", 1)
-    seq = "".join(seq.split("\n"))
-    fasta = ["{}_REF;+\n{}".format(name, seq)]
 
-    ## if PE then you have to merge the reads here
+def region_clusters(data, sample, regions):
+    """ 
+    Yields a cluster (fasta string) of all reads that map to each region, in
+    order, from a single pass through the sorted bam file. Each read is named
+    with its mapping region inserted between its label and vsearch size.
+
+    For SE data we also grab the reference sequence with a _REF header to 
+    aid in alignment. This will be removed post-alignment. For PE data the 
+    R1s and R2s of all regions are written to one pair of files (labeled by
+    region) and merged with a single call to merge_pairs.
+    """
+    regions = parse_regions(regions)
+    chroms, starts, ends, _ = regions
+
     if "pair" in data.paramsdict["datatype"]:
-        ## TODO: Can we include the reference sequence in the PE clust.gz?
-        ## if it's longer than the merged pairs it makes hella indels
-        ## Drop the reference sequence for now...
-        fasta = []
+        for clust in region_clusters_pairs(data, sample, regions):
+            yield clust
+        return
+
+    ## open the reference to pull region seqs
+    refseq_file = data.paramsdict["reference_sequence"]
+    fai = read_fai(refseq_file)
+    refio = None
+    if fai is not None:
+        refio = open(refseq_file, 'rb')
+
+    reader = iter_region_reads(data, sample, regions)
+    try:
+        for ridx, reads in reader:
+            if not reads:
+                yield ""
+                continue
+            chrom = chroms[ridx]
+            rstring_id0 = "{}:{}-{}"\
+                .format(chrom.replace("|", "_"), starts[ridx], ends[ridx])
+            rstring_id1 = "{}:{}-{}"\
+                .format(chrom.replace("|", "_"), starts[ridx]+1, ends[ridx])
+
+            ## reference seq on top of the stack
+            seq = fetch_reference(data, fai, refio, chrom, 
+                                  starts[ridx], ends[ridx])
+            fasta = [">{}_REF;+\n{}".format(rstring_id1, seq)]
+
+            for bits in reads:
+                ## the 0x10 flag indicates revcomp
+                orient = "+"
+                if int(bits[1]) & 0x10:
+                    orient = "-"
+
+                ## Rip insert the mapping position between the seq label and
+                ## the vsearch derep size.
+                fullfast = ">{a};{b};{c};{d}\n{e}".format(
+                    a=bits[0].split(";")[0],
+                    b=rstring_id0,
+                    c=bits[0].split(";")[1], 
+                    d=orient, 
+                    e=bits[9])
+                fasta.append(fullfast)
+            yield "\n".join(fasta)
+    finally:
+        reader.close()
+        if refio:
+            refio.close()
 
-        ## Create temporary files for R1, R2 and merged, which we will pass to
-        ## the function merge_pairs() which calls vsearch to test merging.
-        prefix = os.path.join(data.dirs.refmapping, 
-                        "{}-{}".format(sample.name, rstring_id0))
-        read1 = "{}-R1".format(prefix)
-        read2 = "{}-R2".format(prefix)
-        merged = "{}-merged".format(prefix)
 
-        ## command to do the 'view' in samtools
-        cmd1 = [ipyrad.bins.samtools, "view", "-b", bamf, rstring_id0]
-        cmd2 = [ipyrad.bins.samtools, "bam2fq", "-1", read1, "-2", read2, "-"]
 
-        ## run commands, pipe 1 -> 2, then cleanup
-        proc1 = sps.Popen(cmd1, stderr=sps.STDOUT, stdout=sps.PIPE)
-        proc2 = sps.Popen(cmd2, stderr=sps.STDOUT, stdout=sps.PIPE, stdin=proc1.stdout)
-        res = proc2.communicate()[0]
-        if proc2.returncode:
-            raise IPyradWarningExit("error {}: {}".format(cmd2, res))
-        proc1.stdout.close()
+def region_clusters_pairs(data, sample, regions):
+    """
+    PE version of region_clusters. Pairs with both mates in a region are
+    written in their original orientation (like samtools bam2fq) with the 
+    region index as a label prefix, merged together, then regrouped.
+    """
+    chroms, starts, ends, _ = regions
+
+    ## temp files for R1s, R2s and merged pairs of all regions
+    prefix = os.path.join(data.dirs.refmapping, sample.name+"-regions")
+    read1 = "{}-R1.fastq".format(prefix)
+    read2 = "{}-R2.fastq".format(prefix)
+    merged = "{}-merged.fastq".format(prefix)
 
-        ## merge the pairs. 0 means don't revcomp bcz samtools already
-        ## did it for us. 1 means "actually merge".
+    reader = iter_region_reads(data, sample, regions)
+    try:
+        with open(read1, 'wb') as out1, open(read2, 'wb') as out2:
+            for ridx, reads in reader:
+                ## R1 and R2 of each read pair, skip secondary alignments.
+                ## A region with reads that can't be parsed is skipped.
+                mates = {}
+                try:
+                    for bits in reads:
+                        flag = int(bits[1])
+                        if flag & 0x900:
+                            continue
+                        seq, qual = bits[9], bits[10]
+                        if flag & 0x10:
+                            seq = comp(seq)[::-1]
+                            qual = qual[::-1]
+                        mate = 0 if flag & 0x40 else 1
+                        mates.setdefault(bits[0], [None, None])[mate] = \
+                            (seq, qual)
+                except Exception as inst:
+                    LOGGER.debug("Failed to parse reads in region %s, "\
+                                 "continuing; %s", ridx, inst)
+                    continue
+
+                ## write pairs with both mates in the region
+                pairs1 = []
+                pairs2 = []
+                for name, (mate1, mate2) in mates.iteritems():
+                    if mate1 and mate2:
+                        pairs1.append("@{}_{}\n{}\n+\n{}\n"\
+                                      .format(ridx, name, mate1[0], mate1[1]))
+                        pairs2.append("@{}_{}\n{}\n+\n{}\n"\
+                                      .format(ridx, name, mate2[0], mate2[1]))
+                out1.write("".join(pairs1))
+                out2.write("".join(pairs2))
+
+        ## merge the pairs. 0 means don't revcomp bcz they are in original 
+        ## orientation. 1 means "actually merge". If merging them all at once
+        ## fails merge each region separately, skipping those that fail.
         try:
-            ## return number of merged reads, writes merged data to 'merged'
-            ## we don't yet do anything with the returned number of merged 
             _ = merge_pairs(data, [(read1, read2)], merged, 0, 1)
-            with open(merged, 'r') as infile:
-                quatro = itertools.izip(*[iter(infile)]*4)
-                while 1:
-                    try:
-                        bits = quatro.next()
-                    except StopIteration:
-                        break
-                    ## TODO: figure out a real way to get orientation for PE
-                    orient = "+"
+        except Exception as inst:
+            LOGGER.info("Failed to merge all reads at once, merging by "\
+                        "region; %s", inst)
+            merge_regions(data, read1, read2, merged)
+
+        ## group merged and concatenated pairs by region
+        fastas = {}
+        with open(merged, 'r') as infile:
+            quatro = itertools.izip(*[iter(infile)]*4)
+            for bits in quatro:
+                ## TODO: figure out a real way to get orientation for PE
+                orient = "+"
+                try:
+                    ridx, label = bits[0][1:].split("_", 1)
+                    ridx = int(ridx)
+                    rstring_id1 = "{}:{}-{}".format(
+                        chroms[ridx].replace("|", "_"), 
+                        starts[ridx]+1, ends[ridx])
                     fullfast = ">{a};{b};{c};{d}\n{e}".format(
-                        a=bits[0].split(";")[0],
+                        a="@"+label.split(";")[0],
                         b=rstring_id1,
-                        c=bits[0].split(";")[1], 
+                        c=label.split(";")[1], 
                         d=orient,
                         e=bits[1].strip())
-                    #,e=bits[9])
-                    fasta.append(fullfast)
-            ## clean up
-            os.remove(merged)
-            os.remove(read1)
-            os.remove(read2)
+                except (ValueError, IndexError) as inst:
+                    LOGGER.debug("Skipping bad merged read %s; %s", 
+                                 bits[0].strip(), inst)
+                    continue
+                fastas.setdefault(ridx, []).append(fullfast)
 
-        except Exception as inst:
-            ## Failed merging, probably unequal number of reads in R1 and R2
-            ## Skip this locus?
-            LOGGER.debug("Failed to merge reads, continuing; %s", inst)
+        ## TODO: Can we include the reference sequence in the PE clust.gz?
+        ## if it's longer than the merged pairs it makes hella indels
+        ## Drop the reference sequence for now...
+        for ridx in xrange(len(chroms)):
+            yield "\n".join(fastas.get(ridx, []))
 
-       
-    else:
-        ## SE if faster than PE cuz it skips writing intermedidate files
-        cmd2 = [ipyrad.bins.samtools, "view", bamf, rstring_id0]
-        proc2 = sps.Popen(cmd2, stderr=sps.STDOUT, stdout=sps.PIPE)
+    finally:
+        reader.close()
+        for tmpfile in [read1, read2, merged]:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
 
-        ## run and check outputs
-        res = proc2.communicate()[0]
-        if proc2.returncode:
-            raise IPyradWarningExit("{} {}".format(cmd2, res))
 
-        ## do not join seqs that 
-        for line in res.strip().split("\n"):
-            bits = line.split("\t")
 
-            ## Read in the 2nd field (FLAGS), convert to binary
-            ## and test if the 7th bit is set which indicates revcomp
-            orient = "+"
-            if int('{0:012b}'.format(int(bits[1]))[7]):
-                orient = "-"
-
-            ## Rip insert the mapping position between the seq label and
-            ## the vsearch derep size.
-            fullfast = ">{a};{b};{c};{d}\n{e}".format(
-                a=bits[0].split(";")[0],
-                b=rstring_id0,
-                c=bits[0].split(";")[1], 
-                d=orient, 
-                e=bits[9])
-            fasta.append(fullfast)
-
-    return "\n".join(fasta)
+def merge_regions(data, read1, read2, merged):
+    """
+    Merges the read pairs of each region in read1 and read2 (labeled with 
+    the region index) separately and writes them all to merged. Regions 
+    whose merge fails are skipped, so one bad region only drops that locus.
+    """
+    tmp1 = read1+".region"
+    tmp2 = read2+".region"
+    tmpm = merged+".region"
+    try:
+        with open(read1, 'r') as in1, open(read2, 'r') as in2, \
+             open(merged, 'wb') as out:
+            pairs = itertools.izip(itertools.izip(*[iter(in1)]*4), 
+                                   itertools.izip(*[iter(in2)]*4))
+            byregion = itertools.groupby(pairs, 
+                                         key=lambda x: x[0][0].split("_", 1)[0])
+            for ridx, group in byregion:
+                group = list(group)
+                with open(tmp1, 'wb') as out1, open(tmp2, 'wb') as out2:
+                    out1.write("".join(["".join(i[0]) for i in group]))
+                    out2.write("".join(["".join(i[1]) for i in group]))
+                try:
+                    _ = merge_pairs(data, [(tmp1, tmp2)], tmpm, 0, 1)
+                    with open(tmpm, 'r') as inmerged:
+                        shutil.copyfileobj(inmerged, out)
+                except Exception as inst:
+                    LOGGER.debug("Failed to merge reads in region %s, "\
+                                 "continuing; %s", ridx[1:], inst)
+    finally:
+        for tmpfile in [tmp1, tmp2, tmpm]:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
 
 
 
@@ -10,10 +10,14 @@ parts of the pipeline
 from __future__ import print_function
 import os
 import sys
+import gzip
+import zlib
 import socket
 import tempfile
 import itertools
 import subprocess as sps
+import numpy as np
+from multiprocessing.pool import ThreadPool
 import ipyrad 
 from collections import defaultdict
 
@@ -536,6 +540,118 @@ def clustdealer(pairdealer, optim):
 
 
 
+def clust_sizes_path(clustfile):
+    """ returns the sidecar file storing cluster sizes for a clust file """
+    return clustfile.rsplit(".gz", 1)[0] + ".sizes.npy"
+
+
+
+def write_clust_sizes(clustfile, sizes, append=False):
+    """
+    Stores the number of seqs, total read depth and max seq length of each
+    cluster in a clust file, in order, as an (nclusters, 3) array next to
+    the file, so that the clusters do not need to be reread for their sizes.
+    """
+    handle = clust_sizes_path(clustfile)
+    sizes = np.array(sizes, dtype=np.uint32).reshape(-1, 3)
+    if append and os.path.exists(handle):
+        sizes = np.concatenate([np.load(handle), sizes])
+    np.save(handle, sizes)
+
+
+
+def load_clust_sizes(clustfile):
+    """
+    Returns the (nclusters, 3) array of cluster sizes of a clust file. If 
+    the sizes file is missing (e.g., clusters written by an older version)
+    the clusters are rescanned and their sizes are stored.
+    """
+    handle = clust_sizes_path(clustfile)
+    if os.path.exists(handle):
+        return np.load(handle)
+
+    LOGGER.info("no cluster sizes for %s, rescanning clusters", clustfile)
+    sizes = []
+    if os.path.exists(clustfile):
+        clust = []
+        with gzip.open(clustfile, 'rb') as infile:
+            for line in itertools.chain(infile, ["//\n"]):
+                if line == "//\n":
+                    if "".join(clust).strip():
+                        sizes.append(clust_sizes("".join(clust)))
+                    clust = []
+                else:
+                    clust.append(line)
+        write_clust_sizes(clustfile, sizes)
+    return np.array(sizes, dtype=np.uint32).reshape(-1, 3)
+
+
+
+def clust_sizes(clust):
+    """
+    Returns the number of seqs, the total read depth (size=) and the max
+    seq length of a cluster in fasta format. Reference seqs have no size 
+    and add no depth.
+    """
+    lines = clust.strip().split("\n")
+    names = lines[::2]
+    depth = sum([int(i.split("size=")[1].split(";")[0]) \
+                 for i in names if "size=" in i])
+    return len(names), depth, max([len(i) for i in lines[1::2]] or [0])
+
+
+
+def gzip_block(block, compresslevel=6):
+    """ compresses a string into a complete gzip member """
+    cobj = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return cobj.compress(block) + cobj.flush()
+
+
+
+def parallel_gzip(infiles, outfile, nthreads=2, blocksize=4*1024*1024):
+    """ 
+    Writes the concatenated contents of infiles to outfile gzipped, by 
+    compressing blocks of 'blocksize' bytes as separate gzip members in 
+    a pool of threads (zlib releases the GIL while compressing). The 
+    concatenated members are a valid gzip file that can be read by the 
+    gzip module, and the member boundaries can be used as restart points
+    by rawedit.index_fastq. Only nthreads*2 blocks are held in memory.
+    """
+    def blocks():
+        """ yields blocks of data from the infiles in order """
+        for infile in infiles:
+            with open(infile, 'rb') as indat:
+                while 1:
+                    block = indat.read(blocksize)
+                    if not block:
+                        break
+                    yield block
+
+    pool = ThreadPool(nthreads)
+    try:
+        with open(outfile, 'wb') as out:
+            nwritten = 0
+            reader = blocks()
+            while 1:
+                batch = list(itertools.islice(reader, nthreads * 2))
+                if not batch:
+                    break
+                ## members are written in input order, back to back
+                for member in pool.map(gzip_block, batch):
+                    out.write(member)
+                nwritten += len(batch)
+            ## always write at least one member so output is valid gzip
+            if not nwritten:
+                out.write(gzip_block(""))
+            out.flush()
+            os.fsync(out.fileno())
+    finally:
+        pool.close()
+        pool.join()
+
+
+
+
 def progressbar(njobs, finished, msg=""):
     """ prints a progress bar """
     progress = 100*(finished / float(njobs))
@@ -599,6 +715,29 @@ def get_threaded_view(ipyclient, split=True):
 
 
 
+def detect_memory():
+    """ 
+    Detects the physical memory (bytes) of a system, or returns 0 if it
+    can't be found.
+    """
+    # Linux, Unix:
+    if hasattr(os, "sysconf") and \
+       os.sysconf_names.has_key("SC_PHYS_PAGES"):
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    # OSX:
+    try:
+        return int(sps.check_output(["sysctl", "-n", "hw.memsize"]))
+    except Exception:
+        return 0
+
+
+
+def host_memory():
+    """ returns the hostname and physical memory of the host of an engine """
+    return socket.gethostname(), detect_memory()
+
+
+
 ##############################################################
 def detect_cpus():
     """
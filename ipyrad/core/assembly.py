@@ -192,7 +192,10 @@ class Assembly(object):
                         ("preview_step2", 100000),
                         ("output_loci_name_buffer", 5),
                         ("query_cov", None),
-                        ("smalt_index_wordlen", 8)
+                        ("smalt_index_wordlen", 8),
+                        ("align_chunks", 10),
+                        ("max_host_memory", None),
+                        ("demux_engine_mbps", None)
         ])
 
     def __str__(self):
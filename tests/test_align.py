@@ -0,0 +1,91 @@
+#!/usr/bin/env python2.7
+
+""" checks the in-process step 3 aligner (star_align) against muscle """
+
+import os
+import random
+import pytest
+import ipyrad
+import ipyrad.assemble.cluster_within as cw
+
+
+needs_muscle = pytest.mark.skipif(
+    not os.path.exists(getattr(ipyrad.bins, "muscle", "")),
+    reason="muscle binary not found")
+
+
+def mutate(seq, nsnps, indel):
+    """ adds snps and an internal insertion (>0) or deletion (<0) to seq """
+    seq = list(seq)
+    for _ in range(nsnps):
+        idx = random.randrange(len(seq))
+        seq[idx] = random.choice([i for i in "ACGT" if i != seq[idx]])
+    if indel:
+        idx = random.randrange(15, len(seq) - 15)
+        if indel > 0:
+            seq[idx:idx] = [random.choice("ACGT") for _ in range(indel)]
+        else:
+            del seq[idx:idx - indel]
+    return "".join(seq)
+
+
+def make_clusters(nclusts, seed=5):
+    """ random seeds with a few hits each that have snps and indels """
+    random.seed(seed)
+    clusters = []
+    for _ in range(nclusts):
+        cseed = "".join([random.choice("ACGT") for _ in range(80)])
+        seqs = [cseed] + [mutate(cseed, random.randint(0, 3),
+                                 random.choice([0, 0, 1, -1, 2, -3])) \
+                          for _ in range(random.randint(1, 5))]
+        names = [">s{};size=1;{}{}".format(i, "+" if i else "*", i) \
+                 for i in range(len(seqs))]
+        clusters.append((names, seqs))
+    return clusters
+
+
+def seed_distances(aseqs):
+    """ number of columns where each aligned hit differs from the seed """
+    return [sum([1 for i, j in zip(aseqs[0], hit) \
+                 if i != j and not i == j == "-"]) for hit in aseqs[1:]]
+
+
+def test_star_align_keeps_seqs():
+    for names, seqs in make_clusters(50):
+        aseqs = cw.star_align(seqs)
+        if aseqs is None:
+            continue
+        assert len(set([len(i) for i in aseqs])) == 1
+        assert [i.replace("-", "") for i in aseqs] == seqs
+
+
+def test_gapfree_is_padded():
+    names = [">a;size=2;*0", ">b;size=1;+1"]
+    _, aseqs = cw.align_cluster(None, names, ["ACGTAC", "ACGTACGG"], True)
+    assert list(aseqs) == ["ACGTAC--", "ACGTACGG"]
+
+
+def test_gapless():
+    ## identical, plain matches, or an indel only in the trailing overhang
+    for caln in ["", "=", "\n", "45M", "M", "40M5D", "40M5I", "1D"]:
+        assert cw.gapless(caln)
+    ## any internal or leading indel needs an alignment
+    for caln in ["40M2I3M", "3D40M", "3I40M", "10M1D30M2I"]:
+        assert not cw.gapless(caln)
+
+
+@needs_muscle
+def test_star_align_agrees_with_muscle():
+    ## muscle may place a gap at another position of a repeat, or split an
+    ## indel to match other hits, so compare the distance of each hit to
+    ## the seed, which must agree for nearly all clusters.
+    nsame = ntested = 0
+    for names, seqs in make_clusters(100):
+        aseqs = cw.star_align(seqs)
+        if aseqs is None:
+            continue
+        mseqs = cw.parsemuscle(None, cw.muscle_call(None, names, seqs))[1]
+        ntested += 1
+        nsame += seed_distances(aseqs) == seed_distances(mseqs)
+    assert ntested >= 90
+    assert nsame >= 0.95 * ntested
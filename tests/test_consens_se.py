@@ -0,0 +1,114 @@
+#!/usr/bin/env python2.7
+
+""" checks the vectorized step 5 base calls against the old per-site calls """
+
+import random
+import numpy as np
+import scipy.stats
+import scipy.special
+from collections import Counter
+import ipyrad.assemble.consens_se as consens_se
+
+
+class Params(object):
+    """ the parts of an Assembly used by basecalls """
+    def __init__(self, majrule=3, statistical=6, error=0.001, het=0.01):
+        self.paramsdict = {"mindepth_majrule": majrule,
+                           "mindepth_statistical": statistical}
+        self._este = error
+        self._esth = het
+
+
+def old_binomprobr(base1, base2, error, het):
+    """ the per-site binomial call that was replaced by binomtable """
+    prior_homo = ((1.-het)/2.)
+    prior_het = het
+    hetro = scipy.special.comb(base1+base2, base1)/(2.**(base1+base2))
+    homoa = scipy.stats.binom.pmf(base2, base1+base2, error)
+    homob = scipy.stats.binom.pmf(base1, base1+base2, error)
+    probabilities = [homoa*prior_homo, homob*prior_homo, hetro*prior_het]
+    genotypes = ['aa', 'bb', 'ab']
+    bestprob = max(probabilities)/float(sum(probabilities))
+    return [bestprob, genotypes[probabilities.index(max(probabilities))]]
+
+
+def old_basecall(rsite, data):
+    """ the per-site call that was replaced by basecalls """
+    site = Counter(rsite)
+    site.pop("N", None)
+    site.pop("-", None)
+    if not site:
+        return "N"
+    comms = site.most_common(2)
+    base1 = comms[0][1]
+    base2 = comms[1][1] if len(comms) > 1 else 0
+    bidepth = base1 + base2
+    if bidepth < data.paramsdict["mindepth_majrule"]:
+        return "N"
+    if (bidepth > 10) and (not base2):
+        return comms[0][0]
+    if bidepth >= 500:
+        base2 = int(500 * (base2 / float(base1)))
+        base1 = 500
+    if base1+base2 >= data.paramsdict["mindepth_statistical"]:
+        prob, who = old_binomprobr(base1, base2, data._este, data._esth)
+    else:
+        prob, who = 1.0, "aa"
+    if float(prob) >= 0.95:
+        if who != "ab":
+            return comms[0][0]
+        return consens_se.hetero(*[i[0] for i in comms])
+    return "N"
+
+
+def make_cluster(nseqs, nsites, maxrep):
+    """ dereplicated reads with errors, a few snps and some Ns and gaps """
+    seed = [random.choice("ACGT") for _ in range(nsites)]
+    snps = {random.randrange(nsites): random.choice("ACGT") for _ in range(3)}
+    seqs = []
+    for _ in range(nseqs):
+        seq = list(seed)
+        for site, base in snps.items():
+            if random.random() < 0.5:
+                seq[site] = base
+        for _ in range(random.randint(0, 2)):
+            seq[random.randrange(nsites)] = random.choice("ACGTN-")
+        seqs.append(seq)
+    reps = [random.randint(1, maxrep) for _ in range(nseqs)]
+    return np.array(seqs), np.array(reps)
+
+
+def has_tie(rsite):
+    """ sites where the two most common bases are not uniquely ordered """
+    counts = sorted([j for i, j in Counter(rsite).items() if i not in "N-"],
+                    reverse=True) + [0, 0, 0]
+    return counts[1] and (counts[0] == counts[1] or counts[1] == counts[2])
+
+
+def test_binomtable_equals_binomprobr():
+    for error, het in [(0.001, 0.01), (0.01, 0.05), (0.0005, 0.002)]:
+        consens_se.BINOMCACHE.clear()
+        bestprob, ishet = consens_se.binomtable(error, het)
+        for depth in range(1, 121):
+            for base2 in range(0, depth // 2 + 1):
+                prob, who = old_binomprobr(depth - base2, base2, error, het)
+                assert np.isclose(bestprob[depth, base2], prob, rtol=1e-6)
+                assert ishet[depth, base2] == (who == "ab")
+
+
+def test_basecalls_equals_basecall():
+    random.seed(7)
+    ncalled = 0
+    for data in [Params(), Params(2, 2), Params(6, 6, 0.01, 0.05)]:
+        for maxrep in [1, 3, 10, 150]:
+            for _ in range(20):
+                arrayed, reps = make_cluster(random.randint(1, 12), 40, maxrep)
+                new = consens_se.basecalls(arrayed, reps, data)
+                stack = np.concatenate([[seq]*rep \
+                                        for seq, rep in zip(arrayed, reps)])
+                for site in range(stack.shape[1]):
+                    if has_tie(stack[:, site]):
+                        continue
+                    assert new[site] == old_basecall(stack[:, site], data)
+                    ncalled += new[site] != "N"
+    assert ncalled
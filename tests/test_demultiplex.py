@@ -0,0 +1,60 @@
+#!/usr/bin/env python2.7
+
+""" checks vectorized barcode matching against the old matchdict lookup """
+
+import random
+import numpy as np
+from ipyrad.assemble.demultiplex import match_barcodes
+
+
+def old_matchdict(barcodes):
+    """ exact and 1-base mismatch lookup as built by inverse_barcodes """
+    matchdict = {}
+    for sname, barc in barcodes.items():
+        matchdict[barc] = sname
+        for idx, base in enumerate(barc):
+            for diff in set("CATGN").difference(base):
+                tbar = barc[:idx] + diff + barc[idx+1:]
+                if tbar not in matchdict:
+                    matchdict[tbar] = sname
+    return matchdict
+
+
+def make_barcodes(nbars, barlen, mindist, seed=1):
+    """ random barcodes that differ at >= mindist sites from each other """
+    random.seed(seed)
+    bars = []
+    while len(bars) < nbars:
+        new = "".join([random.choice("ACGT") for _ in range(barlen)])
+        if all([sum([i != j for i, j in zip(new, b)]) >= mindist \
+                for b in bars]):
+            bars.append(new)
+    return {"s{}".format(i): j for i, j in enumerate(bars)}
+
+
+def test_match_barcodes_equals_matchdict():
+    barcodes = make_barcodes(24, 8, 3)
+    snames = barcodes.keys()
+    bararr = np.fromstring("".join([barcodes[i] for i in snames]),
+                           dtype=np.uint8).reshape(len(snames), 8)
+    matchdict = old_matchdict(barcodes)
+
+    ## observed barcodes with 0-3 errors
+    obs = []
+    for _ in range(5000):
+        barc = list(barcodes[random.choice(snames)])
+        for _ in range(random.choice([0, 0, 1, 1, 2, 3])):
+            barc[random.randrange(8)] = random.choice("ACGTN")
+        obs.append("".join(barc))
+
+    new = [snames[i] if i >= 0 else None \
+           for i in match_barcodes(obs, bararr, 1)]
+    old = [matchdict.get(i) for i in obs]
+    assert new == old
+
+
+def test_match_barcodes_rejects_ties():
+    bararr = np.fromstring("AAAACCCCAAAT", dtype=np.uint8).reshape(3, 4)
+    obs = ["AAAA", "CCCC", "AAAG", "AAAT", "GGGG", "CCCA", "AAA"]
+    assert match_barcodes(obs, bararr, 1).tolist() == [0, 1, -1, 2, -1, 1, -1]
+    assert match_barcodes([], bararr, 1).shape == (0,)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python2.7
+
+""" checks the vectorized step 4 likelihoods against the old loop versions """
+
+import itertools
+import numpy as np
+import scipy.stats
+from collections import Counter
+import ipyrad.assemble.jointestimate as jointestimate
+
+
+def old_likelihood2(errors, bfreqs, ustacks):
+    """ the per-stack heterozygous likelihood replaced by likelihood2 """
+    returns = np.zeros([len(ustacks)])
+    for idx, ustack in enumerate(ustacks):
+        spair = np.array(list(itertools.combinations(ustack, 2)))
+        bpair = np.array(list(itertools.combinations(bfreqs, 2)))
+        one = 2.*bpair.prod(axis=1)
+        tot = ustack.sum()
+        atwo = tot - spair[:, 0] - spair[:, 1]
+        two = scipy.stats.binom.pmf(atwo, tot, (2.*errors)/3.)
+        three = scipy.stats.binom.pmf(spair[:, 0], spair.sum(axis=1), 0.5)
+        four = 1.-np.sum(bfreqs**2)
+        returns[idx] = np.sum(one*two*(three/four))
+    return returns
+
+
+def make_stacks(nsites, seed=11):
+    """ base counts at sites that are homozygous, heterozygous or errors """
+    rng = np.random.RandomState(seed)
+    rstack = np.zeros((nsites, 4), dtype=np.uint32)
+    depths = rng.randint(6, 40, nsites)
+    for site, depth in enumerate(depths):
+        bases = rng.choice(4, 2, replace=False)
+        if rng.rand() < 0.2:
+            rstack[site, bases[0]] = rng.binomial(depth, 0.5)
+            rstack[site, bases[1]] = depth - rstack[site, bases[0]]
+        else:
+            rstack[site, bases[0]] = depth
+        if rng.rand() < 0.1:
+            rstack[site, rng.randint(4)] += rng.randint(1, 3)
+    return rstack
+
+
+def test_tablestack_equals_counter():
+    rstack = make_stacks(3000)
+    ustacks, counts = jointestimate.tablestack(rstack)
+    table = Counter([i.tostring() for i in rstack])
+    assert sum(counts) == rstack.shape[0]
+    assert len(counts) == len(table)
+    for ustack, count in zip(ustacks, counts):
+        assert table[ustack.tostring()] == count
+
+
+def test_likelihood2_equals_old():
+    ustacks, _ = jointestimate.tablestack(make_stacks(500))
+    bfreqs = jointestimate.get_frequencies(ustacks)
+    for errors in [0.0001, 0.001, 0.01, 0.1]:
+        new = jointestimate.likelihood2(errors, bfreqs, ustacks)
+        old = old_likelihood2(errors, bfreqs, ustacks)
+        assert np.allclose(new, old, rtol=1e-10, atol=0)
+
+
+def test_diploid_lik_grad():
+    ustacks, counts = jointestimate.tablestack(make_stacks(500))
+    bfreqs = jointestimate.get_frequencies(ustacks)
+    for pstart in [(0.01, 0.001), (0.05, 0.01), (0.2, 0.002)]:
+        score, grad = jointestimate.get_diploid_lik_grad(
+            pstart, bfreqs, ustacks, counts)
+        old = jointestimate.get_diploid_lik(pstart, bfreqs, ustacks, counts)
+        assert np.isclose(score, old, rtol=1e-10)
+
+        ## central differences of the old score
+        numeric = []
+        for idx in range(2):
+            step = np.zeros(2)
+            step[idx] = pstart[idx] * 1e-5
+            numeric.append(
+                (jointestimate.get_diploid_lik(pstart + step, bfreqs,
+                                               ustacks, counts) -
+                 jointestimate.get_diploid_lik(pstart - step, bfreqs,
+                                               ustacks, counts)) / \
+                (2 * step[idx]))
+        assert np.allclose(grad, numeric, rtol=1e-4)
+
+
+def test_haploid_lik_grad():
+    ustacks, counts = jointestimate.tablestack(make_stacks(500))
+    bfreqs = jointestimate.get_frequencies(ustacks)
+    for errors in [0.001, 0.01]:
+        score, grad = jointestimate.get_haploid_lik_grad(
+            np.array([errors]), bfreqs, ustacks, counts)
+        old = jointestimate.get_haploid_lik(errors, bfreqs, ustacks, counts)
+        assert np.isclose(score, old, rtol=1e-10)
+        step = errors * 1e-5
+        numeric = (jointestimate.get_haploid_lik(errors + step, bfreqs,
+                                                 ustacks, counts) -
+                   jointestimate.get_haploid_lik(errors - step, bfreqs,
+                                                 ustacks, counts)) / (2*step)
+        assert np.isclose(grad[0], numeric, rtol=1e-4)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python2.7
+
+""" checks the vectorized step 2 adapter filters against the old ones """
+
+import random
+import numpy as np
+import pytest
+import ipyrad.assemble.rawedit as rawedit
+from ipyrad.assemble.util import comp
+
+
+class Params(object):
+    """ the parts of an Assembly and Sample used by afilter """
+    def __init__(self, datatype, filter_adapters):
+        self.paramsdict = {"datatype": datatype,
+                           "filter_adapters": filter_adapters}
+        self.barcodes = {"s1": "CATCAT"}
+        self.name = "s1"
+
+
+def old_afilter(data, sample, bases, cuts1, cuts2, read):
+    """ the per-read afilter that was replaced by rawedit.afilter """
+    where1 = where2 = where3 = check1 = check2 = None
+    adapter1 = "AGATCGG"
+    adapter2 = "AGAGCGT"
+    rvcuts = [comp(i)[::-1] for i in cuts1]
+    if "ddrad" in data.paramsdict["datatype"]:
+        rvcuts = [comp(i)[::-1] for i in cuts2]
+    if not rvcuts[1]:
+        rvcuts[1] = "Z"*4
+    if any(rvcuts) and (data.barcodes):
+        if read == 1:
+            lookfor1 = rvcuts[0]+"AGA"
+            lookfor2 = rvcuts[1]+"AGA"
+        else:
+            try:
+                barcode = data.barcodes[sample.name]
+            except KeyError:
+                barcode = ""
+            lookfor1 = rvcuts[0]+comp(barcode)[::-1][:3]
+            lookfor2 = rvcuts[1]+comp(barcode)[::-1][:3]
+        if data.paramsdict["filter_adapters"] == 2:
+            lookfor1 = lookfor1[:-3]
+            lookfor2 = lookfor2[:-3]
+        check1 = max(0, bases[1].tostring().find(lookfor1))
+        if sum([1 for i in rvcuts]) == 2:
+            check2 = max(0, bases[1].tostring().find(lookfor2))
+        if check1 or check2:
+            where1 = min([i for i in [check1, check2] if i])
+    dist = None
+    if data.paramsdict["filter_adapters"] == 2:
+        dist = -2
+    check1 = max(0, bases[1].tostring().find(adapter1[:dist]))
+    check2 = max(0, bases[1].tostring().find(adapter2[:dist]))
+    mincheck = max(check1, check2)
+    if mincheck:
+        backup = 1
+        if not check1:
+            backup = 9
+        if read == 1:
+            where2 = max(0, mincheck - (len(cuts2[0]) + backup))
+        else:
+            if "ddrad" in data.paramsdict["datatype"]:
+                trim = mincheck - ((len(cuts1[0]) + len(cuts2[0])) + backup)
+                where2 = max(0, trim)
+            else:
+                trim = mincheck - ((len(cuts1[0]) + len(cuts1[0])) + backup)
+                where2 = max(0, trim)
+    else:
+        where2 = 0
+    if any(rvcuts):
+        where3 = 0
+        if data.paramsdict["filter_adapters"] == 2:
+            if not (where1 or where2):
+                cutback = -15 if read == 1 else -10
+                tail = bases[1].tostring()[cutback:]
+                if any([i in tail for i in rvcuts]):
+                    where3 = len(bases[1]) + cutback
+    try:
+        where = min([i for i in [where1, where2, where3] if i])
+    except (TypeError, ValueError):
+        where = 0
+    return where
+
+
+def old_partial(seq, adapter):
+    """ scalar search for the longest adapter prefix at the end of seq """
+    for olen in range(len(adapter), rawedit.PARTIAL_MINLEN - 1, -1):
+        if len(seq) >= olen:
+            ndiffs = sum([i != j for i, j in zip(seq[-olen:], adapter)])
+            if ndiffs <= olen // rawedit.PARTIAL_DIFFLEN:
+                return len(seq) - olen
+    return -1
+
+
+def make_reads(nreads, seed=3):
+    """ random reads, some with cut sites, adapters and adapter tails """
+    random.seed(seed)
+    parts = ["TGCAGAGA", "AATTAGA", "AGATCGGAAGAGC", "AGAGCGTCGT", "CTGCA",
+             "ATGATG", "AGATCG", "AGATCGGAA"]
+    reads = []
+    for _ in range(nreads):
+        read = [random.choice("ACGTN") for _ in range(random.randint(20, 90))]
+        for _ in range(random.choice([0, 0, 1, 2])):
+            idx = random.randrange(len(read))
+            read[idx:idx] = list(random.choice(parts))
+        reads.append("".join(read))
+    return reads
+
+
+def as_matrix(reads):
+    """ packs reads into a zero padded seq_matrix like rawedit """
+    lens = np.array([len(i) for i in reads], dtype=np.int64)
+    mat = np.zeros((len(reads), lens.max()), dtype=np.uint8)
+    for idx, read in enumerate(reads):
+        mat[idx, :len(read)] = np.fromstring(read, dtype=np.uint8)
+    return mat, lens
+
+
+def test_find_partial():
+    reads = make_reads(2000) + ["AGATCGGAAGAGC", "ACGTACGTAGATCG",
+                                "ACGTACGTTTTTAGATCGGTAGAG"]
+    mat, lens = as_matrix(reads)
+    new = rawedit.find_partial(mat, lens, rawedit.ADAPTER_PARTIAL)
+    old = [old_partial(i, rawedit.ADAPTER_PARTIAL) for i in reads]
+    assert new.tolist() == old
+    assert new[-3:].tolist() == [0, -1, 12]
+
+
+@pytest.mark.parametrize("datatype", ["rad", "ddrad", "pairddrad"])
+def test_afilter_equals_old(datatype):
+    cuts1 = ["TGCAG", ""]
+    cuts2 = ["AATT", ""]
+    reads = make_reads(2000)
+    mat, lens = as_matrix(reads)
+    for filter_adapters in [1, 2]:
+        data = Params(datatype, filter_adapters)
+        for read in [1, 2]:
+            new = rawedit.afilter(data, data, mat, lens, cuts1, cuts2, read)
+            old = np.array([old_afilter(data, data, [None, np.array(list(i))],
+                                        cuts1, cuts2, read) for i in reads])
+            ## partial adapter tails are only searched for by the new filter
+            keep = np.ones(len(reads), dtype=np.bool_)
+            if filter_adapters == 2:
+                keep = rawedit.find_partial(mat, lens,
+                                            rawedit.ADAPTER_PARTIAL) < 0
+            assert new[keep].tolist() == old[keep].tolist()
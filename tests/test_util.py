@@ -0,0 +1,99 @@
+#!/usr/bin/env python2.7
+
+""" checks the cluster size and gzip helpers in assemble.util """
+
+import os
+import gzip
+import random
+import numpy as np
+from ipyrad.assemble.util import clust_sizes, clust_sizes_path, \
+                                  load_clust_sizes, parallel_gzip
+
+
+def make_clusters(nclusts, seed=2):
+    """ aligned clusters in the clustS format, with depths in the names """
+    random.seed(seed)
+    clusts = []
+    for _ in range(nclusts):
+        nseqs = random.randint(1, 6)
+        seqlen = random.randint(30, 120)
+        lines = []
+        for idx in range(nseqs):
+            lines.append(">r{};size={};{}".format(idx, random.randint(1, 50),
+                                                  "+" if idx else "*"))
+            lines.append("".join([random.choice("ACGT-") \
+                                  for _ in range(seqlen)]))
+        clusts.append("\n".join(lines))
+    return clusts
+
+
+def old_sizes(loci):
+    """ the depth and maxlen loop of the old cluster_within.sample_cleanup """
+    maxlen = np.zeros(len(loci), dtype=np.uint32)
+    depths = np.zeros(len(loci), dtype=np.uint32)
+    for iloc in xrange(depths.shape[0]):
+        lines = loci[iloc].strip().split("\n")
+        maxlen[iloc] = np.uint32(len(lines[1]))
+        tdepth = np.uint32(0)
+        for line in lines[::2]:
+            tdepth += np.uint32(line.split(";")[-2][5:])
+        depths[iloc] = tdepth
+    return depths, maxlen
+
+
+def test_clust_sizes():
+    assert clust_sizes(">a;size=3;*\nACGT\n>b;size=2;+\nAC-T\n") == (2, 5, 4)
+    assert clust_sizes(">ref_1\nACGTAA\n>a;size=4;+\nACGTA-") == (2, 4, 6)
+    clusts = make_clusters(200)
+    depths, maxlen = old_sizes(clusts)
+    sizes = np.array([clust_sizes(i) for i in clusts])
+    assert sizes[:, 1].tolist() == depths.tolist()
+    assert sizes[:, 2].tolist() == maxlen.tolist()
+    assert sizes[:, 0].tolist() == [i.count(">") for i in clusts]
+
+
+def test_load_clust_sizes_rescans(tmpdir):
+    clustfile = os.path.join(str(tmpdir), "s1.clustS.gz")
+    clusts = make_clusters(100)
+    with gzip.open(clustfile, 'wb') as out:
+        out.write("\n//\n//\n".join(clusts) + "\n//\n//\n")
+
+    ## no sidecar: clusters are rescanned and the sidecar is written
+    assert not os.path.exists(clust_sizes_path(clustfile))
+    sizes = load_clust_sizes(clustfile)
+    depths, maxlen = old_sizes(clusts)
+    assert sizes.shape == (100, 3)
+    assert sizes[:, 1].tolist() == depths.tolist()
+    assert sizes[:, 2].tolist() == maxlen.tolist()
+    assert os.path.exists(clust_sizes_path(clustfile))
+    assert load_clust_sizes(clustfile).tolist() == sizes.tolist()
+
+    ## a missing clust file has no clusters
+    missing = os.path.join(str(tmpdir), "s2.clustS.gz")
+    assert load_clust_sizes(missing).shape == (0, 3)
+
+
+def test_parallel_gzip_round_trip(tmpdir):
+    random.seed(4)
+    infiles = []
+    for idx in range(3):
+        infiles.append(os.path.join(str(tmpdir), "in{}.fastq".format(idx)))
+        with open(infiles[-1], 'wb') as out:
+            out.write("".join([random.choice("ACGTN\n") \
+                               for _ in range(random.randint(0, 20000))]))
+    outfile = os.path.join(str(tmpdir), "out.fastq.gz")
+    parallel_gzip(infiles, outfile, nthreads=3, blocksize=1000)
+
+    expect = "".join([open(i, 'rb').read() for i in infiles])
+    with gzip.open(outfile, 'rb') as indat:
+        assert indat.read() == expect
+
+    ## each block is its own gzip member
+    with open(outfile, 'rb') as indat:
+        nmembers = indat.read().count("\x1f\x8b\x08")
+    assert nmembers >= len(expect) // 1000
+
+    ## empty input is still a valid gzip file
+    parallel_gzip([], outfile)
+    with gzip.open(outfile, 'rb') as indat:
+        assert indat.read() == ""